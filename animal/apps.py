@@ -1,5 +1,54 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models import signals
 
 
 class AnimalConfig(AppConfig):
     name = 'animal'
+
+    def ready(self):
+        from animal import catalog, display, fragments, profiling, sqlite
+        from animal.models import Animal, AnimalType, Activity
+
+        for model in (Animal, AnimalType, Activity):
+            signals.post_save.connect(
+                catalog.on_model_changed, sender=model,
+                dispatch_uid="animal_version_save")
+            signals.post_delete.connect(
+                catalog.on_model_changed, sender=model,
+                dispatch_uid="animal_version_delete")
+        signals.m2m_changed.connect(
+            catalog.on_m2m_changed, sender=Animal.activities.through,
+            dispatch_uid="animal_version_m2m")
+
+        signals.post_save.connect(
+            display.on_animal_saved, sender=Animal,
+            dispatch_uid="animal_display_save")
+        signals.post_save.connect(
+            display.on_animal_type_saved, sender=AnimalType,
+            dispatch_uid="animal_display_save")
+        signals.post_save.connect(
+            display.on_activity_saved, sender=Activity,
+            dispatch_uid="animal_display_save")
+        signals.pre_delete.connect(
+            display.on_activity_deleting, sender=Activity,
+            dispatch_uid="animal_display_deleting")
+        signals.post_delete.connect(
+            display.on_activity_deleted, sender=Activity,
+            dispatch_uid="animal_display_delete")
+        signals.m2m_changed.connect(
+            display.on_activities_changed, sender=Animal.activities.through,
+            dispatch_uid="animal_display_m2m")
+
+        profiling.profiler.configure(
+            getattr(settings, "ANIMAL_FORM_PROFILING", {}))
+        fragments.fragments.configure(
+            getattr(settings, "ANIMAL_FRAGMENT_CACHE", {}))
+        catalog.catalog.configure(
+            getattr(settings, "ANIMAL_SHARED_CATALOG", {}))
+
+        if getattr(settings, "ANIMAL_SQLITE_PROFILE", False):
+            connection_created.connect(
+                sqlite.on_connection_created,
+                dispatch_uid="animal_sqlite_profile")
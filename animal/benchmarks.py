@@ -0,0 +1,483 @@
+"""Benchmarks the form variants and the coercion strategies, and the SQLite
+profile of animal.sqlite.
+
+Each fixture size is benchmarked in a new test database, so the development
+database is never modified. For each measurement, the wall time of several
+runs, the number of queries and the peak memory (traced by tracemalloc) of one
+run are recorded.
+"""
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, NamedTuple
+
+import django
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connection, connections, reset_queries
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from animal import forms, generate, sqlite
+from animal.catalog import bump, catalog
+from animal.dictvalidation import dict_validator
+from animal.loader import Loader, activate, deactivate
+from animal.models import Animal, AnimalType, Activity
+
+
+Variant = NamedTuple("Variant", [
+    ("name", str),
+    ("form_class", type),
+    ("url_name", str),
+    ("save_method", str),
+])
+"""A form and the view using it."""
+
+
+VARIANTS = [
+    Variant("Form1", forms.Form1, "animal:home", "save"),
+    Variant("DynamicRequired1", forms.DynamicRequired1,
+            "animal:dynamic_required_1", "save"),
+    Variant("DynamicRequired2", forms.DynamicRequired2,
+            "animal:dynamic_required_2", "save"),
+    Variant("DynamicRequired3", forms.DynamicRequired3,
+            "animal:dynamic_required_3", "save"),
+    Variant("DynamicRequired4", forms.DynamicRequired4,
+            "animal:dynamic_required_4", "save_instance"),
+]
+
+COERCIONS = {
+    "get_animal_type": lambda sample: forms.get_animal_type(sample.type),
+    "get_activity": lambda sample: forms.get_activity(sample.activity),
+    "get_lazy_activity": lambda sample: forms.get_lazy_activity(
+        sample.activity),
+    "get_catalog_activity": lambda sample: forms.get_catalog_activity(
+        sample.activity),
+    "get_activities": lambda sample: forms.get_activities(sample.activities),
+}
+"""Coercion of the sample values, by coercion function."""
+
+OPERATIONS = [
+    "construct", "validate", "validate_dict", "save", "get", "post",
+    "coerce"]
+
+
+class Sample(NamedTuple):
+    """Valid values submitted by the benchmarked operations."""
+    type: str
+    activity: str
+    activities: List[str]
+
+    def as_data(self):
+        return {
+            "name": "Benchmark",
+            "age": "1",
+            "type": self.type,
+            "favorite_activity": self.activity,
+            "activities": self.activities,
+        }
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def get_sample() -> Sample:
+    snapshot = catalog.snapshot()
+    pks = [str(pk) for pk, label in snapshot.activity_choices_for_type("dog")]
+    if not pks:
+        raise BenchmarkError("No activity for dog")
+    return Sample(type="dog", activity=pks[0], activities=pks[:3])
+
+
+def in_request(func):
+    """Runs func with a new loader, like LoaderMiddleware."""
+    def run():
+        activate(Loader())
+        try:
+            return func()
+        finally:
+            deactivate()
+    return run
+
+
+def get_operation(variant: Variant, operation: str, sample: Sample,
+                  client: Client) -> Callable[[], Any]:
+    form_class = variant.form_class
+    data = sample.as_data()
+
+    def validate():
+        form = form_class(data=data)
+        if not form.is_valid():
+            raise BenchmarkError("Invalid form: %s" % form.errors.as_json())
+        return form
+
+    if operation == "construct":
+        return in_request(form_class)
+    elif operation == "validate":
+        return in_request(validate)
+    elif operation == "validate_dict":
+        validator = dict_validator(form_class)
+        return in_request(lambda: validator(data))
+    elif operation == "save":
+        return in_request(
+            lambda: getattr(validate(), variant.save_method)())
+    elif operation == "get":
+        url = reverse(variant.url_name)
+        return lambda: client.get(url)
+    elif operation == "post":
+        url = reverse(variant.url_name)
+
+        def post():
+            response = client.post(url, data)
+            if response.status_code != 302:
+                raise BenchmarkError(
+                    "Status %d instead of a redirect" % response.status_code)
+        return post
+    raise ValueError(operation)
+
+
+def measure(func, repeat: int, max_time: float) -> Dict[str, Any]:
+    """Runs func once to count the queries, once to trace the memory, and up
+    to repeat times (or until max_time is exceeded) to time it.
+    """
+    with CaptureQueriesContext(connection) as context:
+        func()
+    queries = len(context.captured_queries)
+    tracemalloc.start()
+    try:
+        func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    times = []
+    total = 0.0
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        times.append(elapsed)
+        total += elapsed
+        if total > max_time:
+            break
+    return {
+        "queries": queries,
+        "peak_memory": peak_memory,
+        "wall_time_min": min(times),
+        "wall_time_median": statistics.median(times),
+        "runs": len(times),
+    }
+
+
+def get_metadata() -> Dict[str, Any]:
+    try:
+        revision = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "revision": revision,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "machine": platform.platform(),
+    }
+
+
+def run_benchmarks(activity_counts: List[int], animal_counts: List[int],
+                   variants: List[Variant], operations: List[str],
+                   types: int = 10, repeat: int = 5, max_time: float = 1.0,
+                   seed: int = 0, report=None) -> List[Dict[str, Any]]:
+    """Runs the operations for every fixture size and returns the results.
+    Each result is also given to report, if any.
+    """
+    results = []
+    creation = connection.creation
+    # Each request would empty the log of the captured queries.
+    request_started.disconnect(reset_queries)
+    try:
+        for activities in activity_counts:
+            old_name = creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False)
+            try:
+                with override_settings(
+                        DEBUG=False, ALLOWED_HOSTS=["testserver"]):
+                    results.extend(_run_size(
+                        activities, sorted(animal_counts), variants,
+                        operations, types, repeat, max_time, seed, report))
+            finally:
+                creation.destroy_test_db(old_name, verbosity=0)
+                catalog.clear()
+    finally:
+        request_started.connect(reset_queries)
+    return results
+
+
+def _run_size(activities, animal_counts, variants, operations, types, repeat,
+              max_time, seed, report):
+    generate.clear()
+    animal_types = generate.create_types(types)
+    activities_by_type = generate.create_activities(
+        animal_types, max(1, activities // types))
+    for Model in (AnimalType, Activity):
+        bump(Model)
+    sample = get_sample()
+    client = Client()
+    results = []
+    for animals in animal_counts:
+        # The save and post operations also add animals.
+        generate.create_animals(
+            animal_types, activities_by_type,
+            animals - Animal.objects.count(), seed=seed + animals)
+        bump(Animal)
+        for name, func in _iter_operations(
+                variants, operations, sample, client):
+            result = {
+                "variant": name[0],
+                "operation": name[1],
+                "activities": activities,
+                "animals": animals,
+            }
+            try:
+                result.update(measure(func, repeat, max_time))
+            except Exception as e:
+                result["error"] = "%s: %s" % (type(e).__name__, e)
+            results.append(result)
+            if report is not None:
+                report(result)
+    return results
+
+
+def _iter_operations(variants, operations, sample, client):
+    for variant in variants:
+        for operation in operations:
+            if operation != "coerce":
+                yield ((variant.name, operation),
+                       get_operation(variant, operation, sample, client))
+    if "coerce" in operations:
+        for name, coerce in COERCIONS.items():
+            yield (name, "coerce"), in_request(
+                lambda coerce=coerce: coerce(sample))
+
+
+def result_key(result):
+    return (result["variant"], result["operation"], result["activities"],
+            result["animals"])
+
+
+def compare(results, previous_results, threshold: float = 1.2):
+    """Yields (result, previous result, ratio of the minimum wall times) for
+    the results slower than threshold times the previous ones, or doing more
+    queries.
+    """
+    previous = {result_key(result): result for result in previous_results}
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None or "error" in result or "error" in old:
+            continue
+        ratio = result["wall_time_min"] / old["wall_time_min"]
+        if ratio > threshold or result["queries"] > old["queries"]:
+            yield result, old, ratio
+
+
+SQLITE_QUERIES = {
+    "activities_of_type": lambda animal_type, activity, animal: (
+        Activity.objects.filter(animal_type_id=animal_type).order_by(
+            "label").values_list("pk", "label")),
+    "animals_of_activity": lambda animal_type, activity, animal: (
+        Animal.activities.through.objects.filter(
+            activity_id=activity).values_list("animal_id", flat=True)),
+    "activities_of_animal": lambda animal_type, activity, animal: (
+        Animal.activities.through.objects.filter(
+            animal_id=animal).values_list("activity_id", flat=True)),
+}
+"""Queries of the access patterns indexed by migration 0004."""
+
+INDEXES = [
+    "animal_acti_type_label_idx",
+    "animal_anim_acts_animal_idx",
+    "animal_anim_acts_activity_idx",
+]
+"""Indexes created by migration 0004."""
+
+SQLITE_PROFILES = {
+    "default": (sqlite.DEFAULT_PRAGMAS, 0, False),
+    "profile": (sqlite.PRAGMAS, 600, True),
+}
+"""Pragmas, CONN_MAX_AGE and use of immediate transactions of each
+profile."""
+
+
+def _drop_indexes(names):
+    """Drops the indexes and returns the SQL recreating them."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND name IN "
+            "(%s)" % ", ".join(["%s"] * len(names)), names)
+        statements = [row[0] for row in cursor.fetchall()]
+        for name in names:
+            cursor.execute("DROP INDEX IF EXISTS %s" % (
+                connection.ops.quote_name(name)))
+    return statements
+
+
+def _query_plan(query):
+    sql, params = query.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return "; ".join(row[-1] for row in cursor.fetchall())
+
+
+def run_sqlite_benchmarks(activities: int = 1000, animals: int = 100000,
+                          types: int = 10, threads: int = 8, posts: int = 25,
+                          repeat: int = 20, max_time: float = 1.0,
+                          seed: int = 0, report=None) -> List[Dict[str, Any]]:
+    """Times the indexed queries without and with the indexes, then the
+    concurrent POSTs of DynamicRequired3 with each SQLite profile. Runs in a
+    test database stored in a temporary file, like a real database.
+    """
+    if connection.vendor != "sqlite":
+        raise BenchmarkError("Only for SQLite")
+    results = []
+    creation = connection.creation
+    test_settings = connection.settings_dict.setdefault("TEST", {})
+    old_test_name = test_settings.get("NAME")
+    directory = tempfile.mkdtemp()
+    test_settings["NAME"] = os.path.join(directory, "benchmark.sqlite3")
+    # Each request would empty the log of the captured queries.
+    request_started.disconnect(reset_queries)
+    connection_created.disconnect(dispatch_uid="animal_sqlite_profile")
+    try:
+        old_name = creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(
+                    DEBUG=False, ALLOWED_HOSTS=["testserver"]):
+                generate.generate(
+                    types, max(1, activities // types), animals, seed=seed)
+                sample = get_sample()
+                animal = Animal.objects.order_by("pk").values_list(
+                    "pk", flat=True).first()
+                params = (sample.type, int(sample.activity), animal)
+                for name, result in _run_queries(params, repeat, max_time):
+                    results.append(result)
+                    if report is not None:
+                        report(result)
+                for name in SQLITE_PROFILES:
+                    result = _run_posts(name, sample, threads, posts)
+                    results.append(result)
+                    if report is not None:
+                        report(result)
+        finally:
+            connections.close_all()
+            creation.destroy_test_db(old_name, verbosity=0)
+            catalog.clear()
+    finally:
+        request_started.connect(reset_queries)
+        if getattr(settings, "ANIMAL_SQLITE_PROFILE", False):
+            connection_created.connect(
+                sqlite.on_connection_created,
+                dispatch_uid="animal_sqlite_profile")
+        if old_test_name is None:
+            del test_settings["NAME"]
+        else:
+            test_settings["NAME"] = old_test_name
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def _run_queries(params, repeat, max_time):
+    statements = _drop_indexes(INDEXES)
+    try:
+        for name, query in SQLITE_QUERIES.items():
+            yield name, _measure_query(
+                "no_indexes", name, query, params, repeat, max_time)
+    finally:
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+    for name, query in SQLITE_QUERIES.items():
+        yield name, _measure_query(
+            "indexes", name, query, params, repeat, max_time)
+
+
+def _measure_query(variant, name, query, params, repeat, max_time):
+    result = {"variant": variant, "operation": name}
+    result.update(measure(lambda: list(query(*params)), repeat, max_time))
+    result["plan"] = _query_plan(query(*params))
+    return result
+
+
+def _run_posts(profile, sample, threads, posts):
+    """POSTs DynamicRequired3 posts times from each thread, at the same time.
+    Connections are closed after each request, unless persistent, like
+    Django does at the end of a request.
+    """
+    pragmas, max_age, immediate = SQLITE_PROFILES[profile]
+    connections.close_all()
+    old_max_age = connection.settings_dict["CONN_MAX_AGE"]
+    connection.settings_dict["CONN_MAX_AGE"] = max_age
+
+    def set_pragmas(sender, connection, **kwargs):
+        sqlite.apply_pragmas(connection, pragmas)
+        if immediate:
+            sqlite.use_immediate_transactions(connection)
+
+    connection_created.connect(set_pragmas, weak=False)
+    # Applies the journal mode while no other connection is open.
+    connection.ensure_connection()
+    url = reverse("animal:dynamic_required_3")
+    data = sample.as_data()
+    errors = []
+    barrier = threading.Barrier(threads + 1)
+
+    def post():
+        client = Client()
+        barrier.wait()
+        try:
+            for i in range(posts):
+                try:
+                    response = client.post(url, data)
+                    if response.status_code != 302:
+                        errors.append("Status %d" % response.status_code)
+                except Exception as e:
+                    errors.append("%s: %s" % (type(e).__name__, e))
+                for thread_connection in connections.all():
+                    thread_connection.close_if_unusable_or_obsolete()
+        finally:
+            connections.close_all()
+
+    workers = [threading.Thread(target=post) for i in range(threads)]
+    try:
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        wall_time = time.perf_counter() - start
+    finally:
+        connection_created.disconnect(set_pragmas)
+        connection.settings_dict["CONN_MAX_AGE"] = old_max_age
+        connections.close_all()
+    total = threads * posts
+    return {
+        "variant": profile,
+        "operation": "concurrent_post",
+        "threads": threads,
+        "posts": total,
+        "wall_time": wall_time,
+        "posts_per_second": total / wall_time,
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+    }
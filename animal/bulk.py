@@ -0,0 +1,162 @@
+"""Creates many animals with a constant number of queries per batch.
+"""
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from django.db import connection, transaction
+
+from animal.catalog import bump, catalog
+from animal.models import Animal, format_animal_label
+
+
+class AnimalRow(NamedTuple):
+    """Values of an animal to create. Cheaper to send to another process than
+    the model instances of a cleaned_data.
+    """
+    name: str
+    age: Optional[int]
+    type_id: str
+    favorite_activity_id: int
+    activity_ids: List[int]
+    internal_notes: str = ""
+
+    @classmethod
+    def from_cleaned_data(cls, cleaned_data):
+        """cleaned_data is the cleaned_data of an AnimalImportForm."""
+        return cls(
+            name=cleaned_data["name"],
+            age=cleaned_data["age"],
+            type_id=cleaned_data["type"].pk,
+            favorite_activity_id=cleaned_data["favorite_activity"].pk,
+            activity_ids=[
+                activity.pk for activity in cleaned_data["activities"] or []],
+            internal_notes=cleaned_data["internal_notes"])
+
+
+def validate_rows(
+        rows: Iterable[Tuple[int, Dict[str, Any]]]) -> List[tuple]:
+    """Validates numbered rows like AnimalImportForm. Returns, for each row,
+    (number, AnimalRow, None) if the row is valid or (number, None, errors)
+    otherwise.
+
+    Validation only uses the catalog so it can run in a worker process.
+    """
+    from animal.dictvalidation import dict_validator
+    from animal.forms import AnimalImportForm
+
+    validate = dict_validator(AnimalImportForm)
+    results = []
+    for number, data in rows:
+        cleaned_data, errors = validate(data)
+        if not errors:
+            results.append(
+                (number, AnimalRow.from_cleaned_data(cleaned_data), None))
+        else:
+            results.append((number, None, {
+                field: list(messages)
+                for field, messages in errors.items()
+            }))
+    return results
+
+
+def display_label(snapshot, row: AnimalRow, count: int) -> str:
+    """Returns the display_label of the animal described by row, with count
+    activities, computed from the catalog snapshot."""
+    return format_animal_label(
+        snapshot.type_labels.get(row.type_id, ""), row.name, row.age,
+        snapshot.activity_index[row.favorite_activity_id][0], count,
+        row.internal_notes)
+
+
+def _bulk_create_returns_pks() -> bool:
+    """Returns True if the pks of the animals inserted by bulk_create can be
+    known: the backend returns them (PostgreSQL) or they are read with
+    last_insert_rowid() (SQLite). Other backends (e.g., MySQL with
+    interleaved auto-increment locks) may not assign consecutive pks to the
+    rows of one INSERT.
+    """
+    return (connection.features.can_return_ids_from_bulk_insert or
+            connection.vendor == "sqlite")
+
+
+def _save_animals(animals: List[Animal],
+                  activity_pks: List[List[int]]) -> List[int]:
+    """Saves the animals and their activities one by one, when the pks of a
+    bulk_create are unknown. The signals refresh the display columns: a few
+    queries per animal instead of a few per batch.
+    """
+    for animal, pks in zip(animals, activity_pks):
+        animal.save(force_insert=True)
+        animal.activities.add(*pks)
+    return [animal.pk for animal in animals]
+
+
+def _get_inserted_pks(count: int) -> List[int]:
+    """Returns the pks of the count animals just inserted by bulk_create on
+    SQLite.
+
+    last_insert_rowid() is the rowid of the last row inserted by this
+    connection. The transaction holds the write lock of the database since
+    its first insert, so no other connection could insert rows between ours:
+    their rowids are consecutive.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT last_insert_rowid()")
+        last_pk = cursor.fetchone()[0]
+    animal_pks = list(range(last_pk - count + 1, last_pk + 1))
+    if count == 1:
+        return animal_pks
+    # Sanity check: the range must only contain our rows.
+    found = Animal.objects.filter(
+        pk__gte=animal_pks[0], pk__lte=last_pk).count()
+    if found != count:
+        raise RuntimeError(
+            "Expected %d new animals in pks %d..%d, found %d" % (
+                count, animal_pks[0], last_pk, found))
+    return animal_pks
+
+
+def create_animals(rows: List[AnimalRow]) -> List[int]:
+    """Creates the animals described by rows and returns their pks.
+
+    The animals are inserted with bulk_create and their activities with a
+    single bulk_create on the through table. The display columns are computed
+    from the catalog since bulk_create does not send signals. On backends
+    where the pks of a bulk_create are unknown, the animals are saved one by
+    one instead (see _save_animals).
+    """
+    if not rows:
+        return []
+
+    snapshot = catalog.snapshot()
+    animals = []
+    activity_pks = []
+    for row in rows:
+        pks = list(dict.fromkeys(row.activity_ids))
+        activity_pks.append(pks)
+        animals.append(Animal(
+            name=row.name,
+            age=row.age,
+            type_id=row.type_id,
+            favorite_activity_id=row.favorite_activity_id,
+            internal_notes=row.internal_notes,
+            activity_count=len(pks),
+            display_label=display_label(snapshot, row, len(pks))))
+
+    with transaction.atomic():
+        if not _bulk_create_returns_pks():
+            return _save_animals(animals, activity_pks)
+        animals = Animal.objects.bulk_create(animals)
+        if animals[0].pk is not None:
+            animal_pks = [animal.pk for animal in animals]
+        else:
+            animal_pks = _get_inserted_pks(len(animals))
+
+        Through = Animal.activities.through
+        Through.objects.bulk_create([
+            Through(animal_id=animal_pk, activity_id=activity_pk)
+            for animal_pk, pks in zip(animal_pks, activity_pks)
+            for activity_pk in pks])
+
+        bump(Animal)
+
+    return animal_pks
@@ -0,0 +1,605 @@
+"""In-process catalog of the lookup tables (AnimalType and Activity).
+
+Views and forms read their choices from the catalog instead of querying the
+lookup tables on every request. The catalog is rebuilt lazily when the data
+version of one of its models changes. Versions are bumped by the model signals
+connected in AnimalConfig.ready().
+
+The versions are per process: a write made by another process (another WSGI
+worker, a management command) is not seen until this process bumps the
+version itself or is restarted. The lookup tables are the exception: the
+catalog checks them periodically, or the file shared between processes (see
+ChoiceCatalog).
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+import uuid
+from typing import (  # noqa: F401 (only used in annotations)
+    Dict, FrozenSet, List, Optional, Sequence, Tuple)
+
+from django.db import connection, transaction
+from django.db.models import Count, Max
+
+from animal.compact import (
+    ActivityIndex, ActivityKeys, ActivitySequence, CompactCatalog, pack)
+from animal.models import AnimalType, Activity
+from animal.search import LabelIndex
+
+logger = logging.getLogger(__name__)
+
+
+class DataVersions:
+    """Version counter per model. Bumped by the post_save, post_delete and
+    m2m_changed signals.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {}
+        self.origin = uuid.uuid4().hex
+        """Identifies these counters: versions of different processes are not
+        comparable."""
+
+    def bump(self, model):
+        label = model._meta.label
+        with self._lock:
+            self._counters[label] = self._counters.get(label, 0) + 1
+
+    def get(self, *models) -> Tuple[int, ...]:
+        counters = self._counters
+        return tuple(counters.get(model._meta.label, 0) for model in models)
+
+
+versions = DataVersions()
+
+
+_pending = threading.local()
+"""Models bumped by the transaction of this thread (connections are per
+thread), bumped again on commit."""
+
+
+def bump(model):
+    """Bumps the version of model. Signals call this, but code writing
+    without sending signals (e.g., bulk_create) must call it itself.
+    """
+    # Bump right away so that this thread sees its own writes, and again on
+    # commit so that a snapshot rebuilt by another thread before the commit
+    # does not stay around with uncommitted data missing.
+    versions.bump(model)
+    pending = getattr(_pending, "models", None)
+    if pending is None:
+        pending = _pending.models = set()
+    pending.add(model)
+    transaction.on_commit(_on_commit)
+
+
+def _on_commit():
+    # The first callback of the transaction handles all its models: the
+    # others find nothing left. Models left by a rolled back transaction
+    # are handled with the next one, which is only redundant.
+    pending = _pending.models
+    if not pending:
+        return
+    _pending.models = set()
+    for model in pending:
+        versions.bump(model)
+    if not pending.isdisjoint(catalog.models):
+        # The other processes only see the changes of the shared file.
+        catalog.publish()
+
+
+def on_model_changed(sender, **kwargs):
+    """post_save and post_delete receiver."""
+    bump(sender)
+
+
+def on_m2m_changed(sender, action, **kwargs):
+    """m2m_changed receiver. The version of the model declaring the m2m field
+    is bumped, whatever side of the relation was modified.
+    """
+    if action.startswith("post_"):
+        # Auto-created through models point to the model declaring the field.
+        bump(sender._meta.auto_created or kwargs["instance"].__class__)
+
+
+def encode_json(data) -> bytes:
+    """Encodes data as compact JSON that can also be inlined in a <script>
+    element.
+    """
+    text = json.dumps(data, separators=(",", ":"))
+    text = text.replace("<", "\\u003c").replace(">", "\\u003e").replace(
+        "&", "\\u0026")
+    return text.encode("utf-8")
+
+
+PAYLOADS = {
+    "types": lambda snapshot: [
+        {"value": code, "label": label}
+        for (code, label) in snapshot.types],
+    "activities": lambda snapshot: [
+        {"value": pk, "label": label, "for_type": type_id}
+        for (pk, label, type_id) in snapshot.activities],
+    "activity_choices": lambda snapshot: [
+        {"value": pk, "label": label}
+        for (pk, label) in snapshot.activity_choices],
+}
+"""JSON payloads that can be built from a snapshot, by name."""
+
+
+class IndexedChoices:
+    """Lazy choice source with a hashed index of the choice keys.
+
+    choices is a list of (value, label) tuples or a callable returning one.
+    The list is only built when the choices are first iterated, e.g., by a
+    widget, then kept: unlike Django's CallableChoiceIterator, the callable is
+    called once. It builds static choices lazily, e.g., from a snapshot, not
+    choices changing over time.
+    The index contains the keys as strings, like the comparison done by
+    ChoiceField.valid_value.
+
+    Instances are never modified once built so they are shared instead of
+    copied when a form deep-copies its fields.
+    """
+
+    def __init__(self, choices, empty_label=None, index=None, payload=None):
+        self._choices = choices
+        self.empty_label = empty_label
+        self._index = index
+        self.payload = payload
+        """Callable returning the choices encoded as JSON, if available."""
+
+    def _get_choices(self):
+        choices = self._choices
+        if callable(choices):
+            choices = self._choices = list(choices())
+        return choices
+
+    @property
+    def index(self) -> FrozenSet[str]:
+        if self._index is None:
+            keys = set()
+            for key, label in self._get_choices():
+                if isinstance(label, (list, tuple)):
+                    # Optgroup
+                    keys.update(str(k) for k, v in label)
+                else:
+                    keys.add(str(key))
+            self._index = frozenset(keys)
+        return self._index
+
+    def __iter__(self):
+        if self.empty_label is not None:
+            yield ("", self.empty_label)
+        yield from self._get_choices()
+
+    def __contains__(self, value):
+        if value == "" and self.empty_label is not None:
+            return True
+        return str(value) in self.index
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class LookupChoices(IndexedChoices):
+    """Choice source checking and labelling values with a lookup function
+    instead of a list of choices.
+
+    lookup returns the label of a value, or None if the value is not a valid
+    choice. Iterating only yields the empty choice: widgets must only render
+    the selected values, e.g., SearchSelect.
+    """
+
+    def __init__(self, lookup, empty_label=None):
+        super().__init__([], empty_label)
+        self.lookup = lookup
+
+    def label(self, value) -> Optional[str]:
+        if value == "" and self.empty_label is not None:
+            return self.empty_label
+        return self.lookup(value)
+
+    def __contains__(self, value):
+        return self.label(value) is not None
+
+
+class CatalogSnapshot:
+    """Immutable view of the lookup tables at a given data version, read from
+    a CompactCatalog.
+
+    Choices are sequences of tuples that can be given to a ChoiceField. They
+    are decoded from the compact catalog when iterated, so the memory of a
+    snapshot does not grow with the number of activities until its payloads
+    or search index are built. JSON payloads are encoded once per snapshot.
+    """
+
+    def __init__(self, version, compact: CompactCatalog):
+        self.version = version
+        self.compact = compact
+        self.types: List[Tuple[str, str]] = compact.types
+        """(code, label) of every AnimalType"""
+        self.activities: Sequence[Tuple[int, str, str]] = ActivitySequence(
+            compact)
+        """(pk, label, animal_type_id) of every Activity, in pk order"""
+
+        self.type_choices = self.types
+        self.type_labels = dict(self.types)
+        self.activity_choices = ActivitySequence(compact, with_type=False)
+        self.activity_index = ActivityIndex(compact)
+
+        self._payloads: Dict[str, bytes] = {}
+        self._etags: Dict[str, str] = {}
+        self._sources: Dict[tuple, IndexedChoices] = {}
+        self._type_payloads: Dict[str, Tuple[bytes, str]] = {}
+        self._activity_search: Optional[LabelIndex] = None
+
+    @property
+    def activities_tag(self) -> str:
+        """Changes when an activity changes. Unlike version, it is derived from
+        the data so it stays the same across processes and restarts. Can be
+        used in URLs.
+        """
+        return self.etag("activities")[:16]
+
+    def activity_choices_for_type(self, animal_type):
+        numbers = self.compact.of_type(animal_type)
+        if numbers is None:
+            return []
+        return ActivitySequence(self.compact, numbers, with_type=False)
+
+    def type_source(self, empty_label=None, extra=()) -> IndexedChoices:
+        """Returns the AnimalType choices, followed by the extra choices.
+
+        The source and its index are shared by all forms using this snapshot.
+        """
+        key = ("types", empty_label, tuple(extra))
+        source = self._sources.get(key)
+        if source is None:
+            if extra:
+                source = IndexedChoices(
+                    self.type_choices + list(extra), empty_label)
+            else:
+                source = IndexedChoices(
+                    self.type_choices, empty_label,
+                    payload=lambda: self.payload("types", empty_label))
+            self._sources[key] = source
+        return source
+
+    def activity_source(self, animal_type=None,
+                        empty_label=None) -> IndexedChoices:
+        """Returns the Activity choices, only for animal_type if given.
+        """
+        key = ("activities", animal_type, empty_label)
+        source = self._sources.get(key)
+        if source is None:
+            index = ActivityKeys(self.compact, animal_type)
+            if animal_type is None:
+                source = IndexedChoices(
+                    self.activity_choices, empty_label, index=index,
+                    payload=lambda: self.payload(
+                        "activity_choices", empty_label))
+            else:
+                source = IndexedChoices(
+                    self.activity_choices_for_type(animal_type), empty_label,
+                    index=index)
+            self._sources[key] = source
+        return source
+
+    def activity_lookup_source(self, animal_type=None,
+                               empty_label=None) -> LookupChoices:
+        """Returns the Activity choices, only for animal_type if given, as a
+        LookupChoices: values are checked with a pk lookup and the list of
+        choices is never built.
+        """
+        key = ("activity_lookup", animal_type, empty_label)
+        source = self._sources.get(key)
+        if source is None:
+            activity_index = self.activity_index
+
+            def lookup(value):
+                try:
+                    pk = int(value)
+                except (TypeError, ValueError):
+                    return None
+                activity = activity_index.get(pk)
+                if activity is None or (
+                        animal_type is not None and
+                        activity[1] != animal_type):
+                    return None
+                return activity[0]
+            source = LookupChoices(lookup, empty_label)
+            self._sources[key] = source
+        return source
+
+    @property
+    def activity_search(self) -> LabelIndex:
+        """Prefix index of the activity labels, grouped by animal type. Built
+        on first use.
+        """
+        index = self._activity_search
+        if index is None:
+            index = self._activity_search = LabelIndex(self.activities)
+        return index
+
+    def payload(self, name: str, empty_label: Optional[str] = None) -> bytes:
+        """Returns the JSON payload called name. If empty_label is given, an
+        empty choice is added at the beginning.
+
+        Only the payload without empty choice is cached: empty_label can come
+        from the query string of a request.
+        """
+        payload = self._payloads.get(name)
+        if payload is None:
+            payload = encode_json(PAYLOADS[name](self))
+            self._payloads[name] = payload
+        if empty_label is None:
+            return payload
+        empty = encode_json({"value": "", "label": empty_label})
+        if payload == b"[]":
+            return b"[" + empty + b"]"
+        return b"[" + empty + b"," + payload[1:]
+
+    def type_activities_payload(self, animal_type: str) -> Tuple[bytes, str]:
+        """Returns the JSON payload of the activities of animal_type, and its
+        strong ETag (unquoted). Each type is encoded once per snapshot.
+        """
+        payload = self._type_payloads.get(animal_type)
+        if payload is None:
+            data = encode_json([
+                {"value": pk, "label": label}
+                for (pk, label) in self.activity_choices_for_type(
+                    animal_type)])
+            payload = (data, hashlib.sha1(data).hexdigest())
+            self._type_payloads[animal_type] = payload
+        return payload
+
+    def etag(self, name: str, empty_label: Optional[str] = None) -> str:
+        """Returns a strong ETag (unquoted) for the payload."""
+        etag = self._etags.get(name)
+        if etag is None:
+            etag = hashlib.sha1(self.payload(name)).hexdigest()
+            self._etags[name] = etag
+        if empty_label is None:
+            return etag
+        # Derived from the payload without empty choice instead of hashing
+        # (and caching) each variant.
+        return hashlib.sha1(
+            (etag + "\0" + empty_label).encode("utf-8")).hexdigest()
+
+
+class ChoiceCatalog:
+    """Builds and keeps the latest CatalogSnapshot.
+
+    Lookup tables changed by another process do not bump the versions of this
+    one. Every CHECK_INTERVAL seconds, the snapshot is thus compared with a
+    cheap fingerprint of the tables (see _matches_tables) and rebuilt if they
+    differ. Changes the fingerprint misses, like a label edited elsewhere,
+    are seen when the snapshot is rebuilt anyway, after MAX_AGE seconds::
+
+        ANIMAL_SHARED_CATALOG = {
+            "CHECK_INTERVAL": 1.0,
+            "MAX_AGE": 60.0,  # None to only rely on the fingerprint
+        }
+
+    A rebuilt snapshot with other data bumps the versions of the models, so
+    the caches of this process are refreshed too.
+
+    With a DIRECTORY in the ANIMAL_SHARED_CATALOG setting, the compact catalog
+    is also written to a file there and memory-mapped, so the worker processes
+    of a server share one copy of it::
+
+        ANIMAL_SHARED_CATALOG = {
+            "DIRECTORY": "/var/run/animal",
+            "CHECK_INTERVAL": 1.0,  # Seconds between checks of the file
+        }
+
+    A process maps the file when it starts instead of reading the lookup
+    tables. A process changing AnimalType or Activity writes a new file on
+    commit, and replaces it atomically: the other processes map it at their
+    next check, and bump their versions so their own caches are refreshed.
+    The last process to write wins. A transaction writes the file once,
+    whatever the number of rows it changed.
+
+    A process mapping the file for the first time checks it against the
+    lookup tables (see _matches_tables) and replaces it if they differ, e.g.,
+    rows were added by a process which stopped before publishing them. A
+    change keeping the number and the last pk of the activities, like a
+    label edited without Django, is not detected: delete the file then.
+    """
+
+    models = (AnimalType, Activity)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.directory: Optional[str] = None
+        self.check_interval = 1.0
+        self.max_age: Optional[float] = 60.0
+        self._next_check = 0.0
+        self._expires = 0.0
+        """When the private snapshot is rebuilt, whatever the checks."""
+        self._file_id = None
+        """Identifies the mapped file, if any."""
+        self._data = None
+        """Packed tables of the private snapshot."""
+
+    def configure(self, config: dict):
+        """Configures the shared file from the ANIMAL_SHARED_CATALOG setting.
+        """
+        self.directory = config.get("DIRECTORY")
+        self.check_interval = config.get("CHECK_INTERVAL", 1.0)
+        self.max_age = config.get("MAX_AGE", 60.0)
+        self.clear()
+
+    def snapshot(self) -> CatalogSnapshot:
+        version = versions.get(*self.models)
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version or (
+                time.monotonic() >= self._next_check):
+            with self._lock:
+                if self.directory:
+                    snapshot = self._refresh_shared(versions.get(*self.models))
+                else:
+                    snapshot = self._refresh_private(
+                        versions.get(*self.models))
+        return snapshot
+
+    def _refresh_private(self, version) -> CatalogSnapshot:
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and snapshot.version == version:
+            if now < self._next_check:
+                return snapshot
+            self._next_check = now + self.check_interval
+            expired = self.max_age is not None and now >= self._expires
+            if not expired and self._matches_tables(snapshot.compact):
+                return snapshot
+            data = self._pack()
+            if data == self._data:
+                self._expires = now + (self.max_age or 0.0)
+                return snapshot
+            # Changed by another process.
+            for model in self.models:
+                versions.bump(model)
+            version = versions.get(*self.models)
+        else:
+            data = self._pack()
+        self._data = data
+        self._snapshot = CatalogSnapshot(version, CompactCatalog(data))
+        self._next_check = now + self.check_interval
+        self._expires = now + (self.max_age or 0.0)
+        return self._snapshot
+
+    def _pack(self) -> bytes:
+        types = list(AnimalType.objects.values_list("code", "label"))
+        activities = list(Activity.objects.values_list(
+            "pk", "label", "animal_type_id"))
+        return pack(types, activities)
+
+    def _refresh_shared(self, version, rebuild=False) -> CatalogSnapshot:
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if not rebuild and snapshot is not None and (
+                snapshot.version == version and now < self._next_check):
+            return snapshot
+        self._next_check = now + self.check_interval
+        path = self.path()
+
+        if snapshot is None and not rebuild:
+            try:
+                compact, self._file_id = self._map(path)
+            except (OSError, ValueError):
+                pass
+            else:
+                if self._matches_tables(compact):
+                    self._snapshot = CatalogSnapshot(version, compact)
+                    return self._snapshot
+                # Left by a process which did not publish its last changes,
+                # or by another database: replaced below.
+                self._file_id = None
+
+        if rebuild or snapshot is None or snapshot.version != version:
+            data = self._pack()
+            if connection.in_atomic_block:
+                # Might be rolled back: not shared. Published on commit.
+                self._file_id = None
+                self._snapshot = CatalogSnapshot(version, CompactCatalog(data))
+                return self._snapshot
+            try:
+                self._publish(path, data)
+                compact, self._file_id = self._map(path)
+            except (OSError, ValueError):
+                logger.warning(
+                    "Cannot share the catalog in %s", path, exc_info=True)
+                compact, self._file_id = CompactCatalog(data), None
+            self._snapshot = CatalogSnapshot(version, compact)
+            return self._snapshot
+
+        # Periodic check: map the file written by another process.
+        try:
+            file_id = self._get_file_id(os.stat(path))
+        except OSError:
+            return snapshot
+        if file_id == self._file_id:
+            return snapshot
+        try:
+            compact, file_id = self._map(path)
+        except (OSError, ValueError):
+            return snapshot
+        for model in self.models:
+            versions.bump(model)
+        self._file_id = file_id
+        self._snapshot = CatalogSnapshot(versions.get(*self.models), compact)
+        return self._snapshot
+
+    def _matches_tables(self, compact: CompactCatalog) -> bool:
+        """Compares the mapped file with a cheap fingerprint of the lookup
+        tables: all the types, and the number and last pk of the activities.
+        Only done when a process maps the file for the first time.
+        """
+        types = list(AnimalType.objects.values_list("code", "label"))
+        activities = Activity.objects.aggregate(
+            count=Count("pk"), last=Max("pk"))
+        return (
+            sorted(types) == sorted(compact.types) and
+            activities["count"] == len(compact) and
+            activities["last"] == (compact.pks[-1] if len(compact) else None))
+
+    def path(self) -> str:
+        """Returns the path of the shared file. Each database has its own,
+        e.g., the test databases.
+        """
+        settings_dict = connection.settings_dict
+        digest = hashlib.sha1(repr(
+            (connection.vendor, settings_dict["NAME"], settings_dict["HOST"])
+        ).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, "catalog-{0}.bin".format(digest))
+
+    @staticmethod
+    def _get_file_id(stat):
+        return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _map(self, path):
+        with open(path, "rb") as file:
+            file_id = self._get_file_id(os.fstat(file.fileno()))
+            # The mapping stays valid after the file is closed or replaced.
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return CompactCatalog(buffer), file_id
+
+    def _publish(self, path, data):
+        """Replaces the file at path by data, atomically."""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".catalog-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def publish(self):
+        """Writes the shared file, if configured, from the lookup tables."""
+        if self.directory:
+            with self._lock:
+                self._refresh_shared(
+                    versions.get(*self.models), rebuild=True)
+
+    def clear(self):
+        self._snapshot = None
+        self._data = None
+        self._file_id = None
+
+
+catalog = ChoiceCatalog()
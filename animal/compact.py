@@ -0,0 +1,258 @@
+"""Compact, read-only encoding of the catalog (see animal.catalog).
+
+The lookup tables are packed in one buffer: arrays of pks, of offsets and of
+type numbers, and one blob of UTF-8 text in which each distinct label is
+stored once. A CompactCatalog reads the buffer in place, e.g., a memory-mapped
+file shared by the workers of a server: an activity is only decoded when it is
+accessed, and nothing is copied per process but the animal types.
+
+Activities are stored in pk order and found by binary search. Integers are in
+the native byte order: a buffer is only read on the machine that packed it.
+"""
+import array
+import bisect
+import struct
+from collections.abc import Mapping, Sequence
+from typing import (  # noqa: F401 (only used in annotations)
+    Iterable, List, Optional, Tuple)
+
+MAGIC = b"ANCAT001"
+
+SECTIONS = [
+    # (name, array typecode)
+    ("type_codes", "I"),  # Start and end in blob of each type code
+    ("type_labels", "I"),  # Start and end in blob of each type label
+    ("pks", "q"),  # Activity pks, sorted
+    ("labels", "I"),  # Start and end in blob of each activity label
+    ("types", "I"),  # Type number of each activity
+    ("by_type", "I"),  # Activity numbers grouped by type, in pk order
+    ("type_starts", "I"),  # Start in by_type of each type, and the end
+    ("blob", "B"),
+]
+
+_HEADER = struct.Struct("=8sII" + "QQ" * len(SECTIONS))
+"""Magic, number of types and of activities, then the offset and size in
+bytes of each section."""
+
+_ALIGNMENT = 8
+
+
+def pack(types: Iterable[Tuple[str, str]],
+         activities: Iterable[Tuple[int, str, str]]) -> bytes:
+    """Packs the (code, label) of the animal types and the (pk, label,
+    animal_type_id) of the activities.
+    """
+    types = list(types)
+    activities = sorted(activities)
+    blob = bytearray()
+    spans = {}
+
+    def intern(text):
+        span = spans.get(text)
+        if span is None:
+            data = text.encode("utf-8")
+            span = spans[text] = (len(blob), len(blob) + len(data))
+            blob.extend(data)
+        return span
+
+    type_numbers = {code: number for number, (code, _) in enumerate(types)}
+    activity_types = [
+        type_numbers[type_id] for (_, _, type_id) in activities]
+    by_type = sorted(
+        range(len(activities)), key=activity_types.__getitem__)
+    type_starts = [0] * (len(types) + 1)
+    for number in activity_types:
+        type_starts[number + 1] += 1
+    for number in range(len(types)):
+        type_starts[number + 1] += type_starts[number]
+
+    data = {
+        "type_codes": [n for code, _ in types for n in intern(code)],
+        "type_labels": [n for _, label in types for n in intern(label)],
+        "pks": [pk for (pk, _, _) in activities],
+        "labels": [n for (_, label, _) in activities for n in intern(label)],
+        "types": activity_types,
+        "by_type": by_type,
+        "type_starts": type_starts,
+        "blob": blob,
+    }
+    body = bytearray()
+    offsets = []
+    for name, typecode in SECTIONS:
+        body.extend(bytes(-(_HEADER.size + len(body)) % _ALIGNMENT))
+        section = array.array(typecode, data[name]).tobytes()
+        offsets.extend((_HEADER.size + len(body), len(section)))
+        body.extend(section)
+    header = _HEADER.pack(MAGIC, len(types), len(activities), *offsets)
+    return header + bytes(body)
+
+
+class CompactCatalog:
+    """Reads a buffer made by pack(). Raises ValueError if it is not one,
+    e.g., a truncated file.
+    """
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if len(view) < _HEADER.size:
+            raise ValueError("Truncated catalog")
+        magic, type_count, activity_count, *offsets = _HEADER.unpack_from(
+            view)
+        if magic != MAGIC:
+            raise ValueError("Not a compact catalog")
+        self._sections = {}
+        for index, (name, typecode) in enumerate(SECTIONS):
+            offset, size = offsets[2 * index:2 * index + 2]
+            if offset + size > len(view):
+                raise ValueError("Truncated catalog")
+            self._sections[name] = view[offset:offset + size].cast(typecode)
+        self.pks = self._sections["pks"]
+        self._labels = self._sections["labels"]
+        self._types = self._sections["types"]
+        self._blob = self._sections["blob"]
+        if len(self.pks) != activity_count:
+            raise ValueError("Truncated catalog")
+
+        self.types: List[Tuple[str, str]] = [
+            (self._text(self._sections["type_codes"], number),
+             self._text(self._sections["type_labels"], number))
+            for number in range(type_count)]
+        """(code, label) of every AnimalType. Decoded once: there are few."""
+        self._type_codes = [code for code, _ in self.types]
+        self._type_numbers = {
+            code: number for number, code in enumerate(self._type_codes)}
+
+    def _text(self, spans, number) -> str:
+        return str(self._blob[spans[2 * number]:spans[2 * number + 1]],
+                   "utf-8")
+
+    def __len__(self):
+        return len(self.pks)
+
+    def find(self, pk: int) -> int:
+        """Returns the number of the activity pk, or -1."""
+        pks = self.pks
+        number = bisect.bisect_left(pks, pk)
+        if number < len(pks) and pks[number] == pk:
+            return number
+        return -1
+
+    def pk(self, number: int) -> int:
+        return self.pks[number]
+
+    def label(self, number: int) -> str:
+        return self._text(self._labels, number)
+
+    def type_code(self, number: int) -> str:
+        return self._type_codes[self._types[number]]
+
+    def entries(self, numbers: Iterable[int], with_type=True):
+        """Yields the (pk, label, animal_type_id) of the activities numbers,
+        or their (pk, label) if with_type is False.
+        """
+        # Same as calling pk(), label() and type_code(), without the calls.
+        pks, labels, blob = self.pks, self._labels, self._blob
+        types, type_codes = self._types, self._type_codes
+        for number in numbers:
+            label = str(
+                blob[labels[2 * number]:labels[2 * number + 1]], "utf-8")
+            if with_type:
+                yield pks[number], label, type_codes[types[number]]
+            else:
+                yield pks[number], label
+
+    def of_type(self, animal_type: str) -> Optional[memoryview]:
+        """Returns the numbers of the activities of animal_type, in pk order,
+        or None if the type does not exist.
+        """
+        number = self._type_numbers.get(animal_type)
+        if number is None:
+            return None
+        starts = self._sections["type_starts"]
+        return self._sections["by_type"][starts[number]:starts[number + 1]]
+
+
+class ActivitySequence(Sequence):
+    """The (pk, label, animal_type_id) of activities of a CompactCatalog, or
+    their (pk, label) if with_type is False. Decoded when accessed.
+
+    numbers selects activities, e.g., the ones of a type. All of them by
+    default.
+    """
+
+    def __init__(self, compact: CompactCatalog, numbers=None,
+                 with_type=True):
+        self.compact = compact
+        self.numbers = range(len(compact)) if numbers is None else numbers
+        self.with_type = with_type
+
+    def _get(self, number):
+        compact = self.compact
+        if self.with_type:
+            return (compact.pk(number), compact.label(number),
+                    compact.type_code(number))
+        return (compact.pk(number), compact.label(number))
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(number) for number in self.numbers[index]]
+        return self._get(self.numbers[index])
+
+    def __iter__(self):
+        return self.compact.entries(self.numbers, self.with_type)
+
+
+class ActivityIndex(Mapping):
+    """Maps the pk of an activity of a CompactCatalog to its (label,
+    animal_type_id).
+    """
+
+    def __init__(self, compact: CompactCatalog):
+        self.compact = compact
+
+    def _find(self, pk):
+        if not isinstance(pk, int):
+            return -1
+        return self.compact.find(pk)
+
+    def __getitem__(self, pk):
+        number = self._find(pk)
+        if number < 0:
+            raise KeyError(pk)
+        return self.compact.label(number), self.compact.type_code(number)
+
+    def __contains__(self, pk):
+        return self._find(pk) >= 0
+
+    def __len__(self):
+        return len(self.compact)
+
+    def __iter__(self):
+        return iter(self.compact.pks)
+
+
+class ActivityKeys:
+    """Index of the activity pks as strings, like IndexedChoices.index, for
+    the activities of animal_type if given. Looks the pks up instead of
+    holding a set of strings.
+    """
+
+    def __init__(self, compact: CompactCatalog, animal_type=None):
+        self.compact = compact
+        self.animal_type = animal_type
+
+    def __contains__(self, key):
+        try:
+            pk = int(key)
+        except (TypeError, ValueError):
+            return False
+        if str(pk) != key:
+            # Same keys as str(pk), e.g., "01" is not one
+            return False
+        number = self.compact.find(pk)
+        return number >= 0 and (
+            self.animal_type is None or
+            self.compact.type_code(number) == self.animal_type)
@@ -0,0 +1,141 @@
+"""Validates dict input (e.g., decoded JSON) without the HTML form machinery.
+
+dict_validator(form_class) returns a function validating a dict with the same
+field cleaning, clean_<field> methods, clean() rules, model validation and
+error messages as form_class(data=data).is_valid(). Each validation builds
+a form instance, so the form sets its fields up in __init__ as usual. The
+validation then skips what an API write does not need: the bound fields, the
+widgets when they would only read data[name] and, if the model has no other
+rule, the model instance built by the model validation.
+
+Forms using PrototypeFormMixin build their fields cheaply: the others
+deep-copy them for each validation, like any form instance.
+"""
+import functools
+from typing import Any, Callable, Dict, Tuple
+
+from django import forms
+from django.db import models
+from django.forms.utils import ErrorDict
+
+ValidationResult = Tuple[Dict[str, Any], ErrorDict]
+
+_DICT_GETTERS = (
+    forms.Widget.value_from_datadict,
+    forms.SelectMultiple.value_from_datadict,
+)
+"""value_from_datadict implementations equivalent to data.get(name) when data
+is a dict."""
+
+
+def _make_getter(name, field):
+    """Returns a function extracting the raw value of field from data."""
+    if field.disabled:
+        initial = field.initial
+
+        def get_initial(data):
+            return initial() if callable(initial) else initial
+        return get_initial
+    widget = field.widget
+    if type(widget).value_from_datadict in _DICT_GETTERS:
+        return lambda data: data.get(name)
+    return lambda data: widget.value_from_datadict(data, {}, name)
+
+
+def _has_model_rules(model) -> bool:
+    """Returns True if the validation of a new instance of model does more
+    than validating its fields one by one.
+    """
+    if model.clean is not models.Model.clean:
+        return True
+    unique_checks, date_checks = model()._get_unique_checks()
+    pk_check = (model, (model._meta.pk.name,))
+    return bool(date_checks) or any(
+        check != pk_check for check in unique_checks) or any(
+        isinstance(field, models.FileField) for field in model._meta.fields)
+
+
+class DictValidator:
+    """Validation function of a form class. See dict_validator.
+    """
+
+    def __init__(self, form_class):
+        self.form_class = form_class
+        get_prototypes = getattr(form_class, "get_prototypes", None)
+        self.base_fields = (
+            get_prototypes() if get_prototypes else form_class.base_fields)
+        self.model = self.model_fields = None
+        if issubclass(form_class, forms.BaseModelForm):
+            self.model = form_class._meta.model
+            if not _has_model_rules(self.model):
+                self.model_fields = [
+                    field for field in self.model._meta.fields
+                    if field.name in self.base_fields]
+        self.steps = [
+            (name, _make_getter(name, field),
+             getattr(form_class, "clean_%s" % name, None))
+            for name, field in self.base_fields.items()
+        ]
+
+    def __call__(self, data: Dict[str, Any]) -> ValidationResult:
+        """Returns (cleaned_data, errors). The data is valid if errors is
+        empty.
+        """
+        form = self.form_class(data=data)
+        # Like the start of Form.full_clean
+        form._errors = ErrorDict()
+        form.cleaned_data = {}
+        fields = form.fields
+        cleaned_data = form.cleaned_data
+        for name, get_value, clean_method in self.steps:
+            try:
+                cleaned_data[name] = fields[name].clean(get_value(data))
+                if clean_method is not None:
+                    cleaned_data[name] = clean_method(form)
+            except forms.ValidationError as e:
+                form.add_error(name, e)
+        form._clean_form()
+        if self.model_fields is not None:
+            self._clean_model_fields(form)
+        else:
+            form._post_clean()
+        return form.cleaned_data, form._errors
+
+    def _clean_model_fields(self, form):
+        """Same validation as ModelForm._post_clean, without building the
+        model instance. Only used when the model has no other rule than the
+        validation of its fields.
+        """
+        exclude = form._get_validation_exclusions()
+        cleaned_data = form.cleaned_data
+        errors = {}
+        for field in self.model_fields:
+            name = field.name
+            if name in exclude or name not in cleaned_data:
+                continue
+            if field.has_default() and form.fields[
+                    name].widget.value_omitted_from_data(form.data, {}, name):
+                # construct_instance keeps the default value.
+                value = field.get_default()
+            else:
+                value = cleaned_data[name]
+                if field.is_relation and isinstance(value, models.Model):
+                    value = getattr(value, field.target_field.attname)
+            if field.blank and value in field.empty_values:
+                continue
+            try:
+                field.clean(value, None)
+            except forms.ValidationError as e:
+                errors[name] = e.error_list
+        if errors:
+            form._update_errors(forms.ValidationError(errors))
+
+
+@functools.lru_cache(maxsize=None)
+def dict_validator(
+        form_class) -> Callable[[Dict[str, Any]], ValidationResult]:
+    """Returns the validation function of form_class. Built once per class.
+
+    The fields of the class must not change after the first call.
+    """
+    return DictValidator(form_class)
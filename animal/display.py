@@ -0,0 +1,78 @@
+"""Maintains the denormalized display columns of Animal (activity_count and
+display_label).
+
+The columns are refreshed by the signal receivers connected in
+AnimalConfig.ready(). Code writing animals without sending signals (e.g.,
+bulk_create or queryset.update()) must call refresh_display_columns itself.
+"""
+from django.db import models
+
+from animal.models import Animal
+
+CHUNK_SIZE = 150
+"""Each animal uses 5 query parameters. Stays below the SQLite limit of 999."""
+
+
+def refresh_display_columns(pks, chunk_size=CHUNK_SIZE):
+    """Recomputes the display columns of the animals, with one SELECT and one
+    UPDATE per chunk of animals.
+    """
+    pks = list(pks)
+    for start in range(0, len(pks), chunk_size):
+        chunk = pks[start:start + chunk_size]
+        animals = list(Animal.objects.filter(pk__in=chunk).for_display())
+        if not animals:
+            continue
+        counts = []
+        labels = []
+        for animal in animals:
+            counts.append(models.When(
+                pk=animal.pk, then=models.Value(animal.num_activities)))
+            labels.append(models.When(
+                pk=animal.pk, then=models.Value(str(animal))))
+        Animal.objects.filter(pk__in=[animal.pk for animal in animals]).update(
+            activity_count=models.Case(
+                *counts, output_field=models.PositiveIntegerField()),
+            display_label=models.Case(
+                *labels, output_field=models.TextField()))
+
+
+def on_animal_saved(sender, instance, **kwargs):
+    refresh_display_columns([instance.pk])
+
+
+def on_animal_type_saved(sender, instance, created, **kwargs):
+    if not created:
+        refresh_display_columns(
+            instance.animals.values_list("pk", flat=True))
+
+
+def on_activity_saved(sender, instance, created, **kwargs):
+    if not created:
+        refresh_display_columns(
+            instance.favored_by_animals.values_list("pk", flat=True))
+
+
+def on_activity_deleting(sender, instance, **kwargs):
+    # The through rows are deleted without m2m_changed.
+    instance._display_animal_pks = list(
+        instance.animals.values_list("pk", flat=True))
+
+
+def on_activity_deleted(sender, instance, **kwargs):
+    refresh_display_columns(getattr(instance, "_display_animal_pks", []))
+
+
+def on_activities_changed(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    if action == "pre_clear" and reverse:
+        instance._display_animal_pks = list(
+            instance.animals.values_list("pk", flat=True))
+    elif action in ("post_add", "post_remove", "post_clear"):
+        if not reverse:
+            refresh_display_columns([instance.pk])
+        elif action == "post_clear":
+            refresh_display_columns(
+                getattr(instance, "_display_animal_pks", []))
+        else:
+            refresh_display_columns(pk_set)
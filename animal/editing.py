@@ -0,0 +1,106 @@
+"""Updates animals with a constant number of queries.
+
+The activities of an animal are updated by difference: only the through rows
+of the removed activities are deleted and only the added ones are inserted,
+instead of replacing the whole set.
+
+Edits are checked with Animal.version: an update made from an old version of
+the animal raises ConcurrentUpdate instead of overwriting the changes made
+since.
+"""
+from typing import Iterable, List, Optional, Tuple
+
+from django.db import connection, models, transaction
+
+from animal.bulk import AnimalRow, display_label
+from animal.catalog import bump, catalog
+from animal.models import Animal
+
+
+class ConcurrentUpdate(Exception):
+    """The animal was modified (or deleted) since the version being
+    edited."""
+
+
+def update_activities(animal_pk: int, activity_pks: Iterable[int],
+                      current_pks: Optional[Iterable[int]] = None
+                      ) -> Tuple[List[int], List[int]]:
+    """Makes activity_pks the activities of the animal and returns the added
+    and removed pks.
+
+    Runs one SELECT (skipped if current_pks, the stored activities, is given),
+    then at most one DELETE and one INSERT per batch. No m2m_changed signal is
+    sent: the caller refreshes the display columns and bumps the version of
+    Animal.
+    """
+    Through = Animal.activities.through
+    wanted = list(dict.fromkeys(activity_pks))
+    if current_pks is None:
+        current_pks = Through.objects.filter(
+            animal_id=animal_pk).values_list("activity_id", flat=True)
+    current = set(current_pks)
+    added = [pk for pk in wanted if pk not in current]
+    wanted_set = set(wanted)
+    removed = sorted(current - wanted_set)
+
+    if removed:
+        # A DELETE statement: QuerySet.delete() would SELECT the rows first
+        # since Through has m2m_changed receivers, which prevent the fast
+        # delete.
+        quote_name = connection.ops.quote_name
+        sql = "DELETE FROM {0} WHERE {1} = %s AND {2} IN ({{0}})".format(
+            quote_name(Through._meta.db_table),
+            quote_name(Through._meta.get_field("animal").column),
+            quote_name(Through._meta.get_field("activity").column))
+        size = connection.ops.bulk_batch_size(["activity_id"], removed) or 1
+        with connection.cursor() as cursor:
+            for start in range(0, len(removed), size):
+                batch = removed[start:start + size]
+                cursor.execute(
+                    sql.format(", ".join(["%s"] * len(batch))),
+                    [animal_pk] + batch)
+    if added:
+        Through.objects.bulk_create([
+            Through(animal_id=animal_pk, activity_id=pk) for pk in added])
+    return added, removed
+
+
+def update_animal(animal_pk: int, version: int, row: AnimalRow) -> int:
+    """Updates the animal to the values of row if it is still at version, in
+    one transaction. Returns the new version.
+
+    The display columns are computed from the catalog. Raises
+    ConcurrentUpdate if the animal changed since version.
+    """
+    snapshot = catalog.snapshot()
+    activity_pks = list(dict.fromkeys(row.activity_ids))
+    with transaction.atomic():
+        updated = Animal.objects.filter(pk=animal_pk, version=version).update(
+            name=row.name,
+            age=row.age,
+            type_id=row.type_id,
+            favorite_activity_id=row.favorite_activity_id,
+            internal_notes=row.internal_notes,
+            activity_count=len(activity_pks),
+            display_label=display_label(snapshot, row, len(activity_pks)),
+            version=models.F("version") + 1)
+        if not updated:
+            raise ConcurrentUpdate(
+                "Animal %s is no longer at version %s" % (animal_pk, version))
+        update_activities(animal_pk, activity_pks)
+        bump(Animal)
+    return version + 1
+
+
+def claim_version(animal_pk: int, version: int):
+    """Increments the version of the animal if it is still at version, like
+    update_animal. Raises ConcurrentUpdate otherwise.
+
+    Must run in the transaction saving the animal: Animal.save() then writes
+    the same version.
+    """
+    updated = Animal.objects.filter(pk=animal_pk, version=version).update(
+        version=models.F("version") + 1)
+    if not updated:
+        raise ConcurrentUpdate(
+            "Animal %s is no longer at version %s" % (animal_pk, version))
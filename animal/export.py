@@ -0,0 +1,75 @@
+"""Streams animals as NDJSON or CSV, in the format read by import_animals.
+
+Animals are read chunk by chunk with one prefetch query per chunk for their
+activities, so memory usage does not depend on the number of animals.
+"""
+import csv
+import io
+import json
+
+from django.db.models import Prefetch, prefetch_related_objects
+
+from animal.models import Animal, Activity
+
+CHUNK_SIZE = 500
+"""The prefetch query has one parameter per animal: stays below the SQLite
+limit of 999."""
+
+FIELDS = ["id", "name", "age", "type", "favorite_activity", "activities",
+          "internal_notes"]
+
+
+def export_chunks(queryset=None, chunk_size=CHUNK_SIZE):
+    """Yields lists of rows (dicts with FIELDS as keys)."""
+    if queryset is None:
+        queryset = Animal.objects.all()
+    queryset = queryset.only(
+        "pk", "name", "age", "type_id", "favorite_activity_id",
+        "internal_notes")
+    activities = Prefetch(
+        "activities", queryset=Activity.objects.only("pk"))
+    for animals in queryset.chunks(chunk_size):
+        prefetch_related_objects(animals, activities)
+        yield [
+            {
+                "id": animal.pk,
+                "name": animal.name,
+                "age": animal.age,
+                "type": animal.type_id,
+                "favorite_activity": animal.favorite_activity_id,
+                "activities": [
+                    activity.pk for activity in animal.activities.all()],
+                "internal_notes": animal.internal_notes,
+            } for animal in animals
+        ]
+
+
+def iter_ndjson(chunks):
+    for rows in chunks:
+        yield "".join(json.dumps(row) + "\n" for row in rows)
+
+
+def iter_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for rows in chunks:
+        for row in rows:
+            writer.writerow([
+                row["id"], row["name"], row["age"], row["type"],
+                row["favorite_activity"],
+                ";".join(str(pk) for pk in row["activities"]),
+                row["internal_notes"]])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # No rows: the header alone
+        yield buffer.getvalue()
+
+
+WRITERS = {
+    "csv": (iter_csv, "text/csv"),
+    "ndjson": (iter_ndjson, "application/x-ndjson"),
+}
+"""Function producing the text and content type, by format."""
@@ -1,36 +1,317 @@
-from typing import TypeVar, List
+import copy
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, TypeVar
 
 from django import forms
-from django.db import models
-
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.urls import reverse
+
+from animal.bulk import AnimalRow, create_animals
+from animal.catalog import IndexedChoices, LookupChoices, bump, catalog
+from animal.display import refresh_display_columns
+from animal.editing import claim_version, update_activities, update_animal
+from animal.loader import fetch_by_pks, get_loader
 from animal.models import Animal, AnimalType, Activity
+from animal.profiling import ProfilingFormMixin
 
 
 M = TypeVar('M', bound=models.Model)      # Declare type variable
 
 
-def materialize_models(models: List[M]) -> List[M]:
+def _get_key(obj) -> Tuple[type, Any]:
+    """Returns (model class, pk) for an identity map. The pk is converted like
+    a DB value, e.g., the stub Activity(pk="3") gives the key of the pk 3.
+    """
+    Model = obj._meta.concrete_model
+    return Model, Model._meta.pk.to_python(obj.pk)
+
+
+def materialize_models(
+        models: List[M],
+        identity_map: Optional[Dict[Tuple[type, Any], M]] = None) -> List[M]:
     """Retrieves a list of models from the DB if the models did not come from a
     DB. This is useful if:
 
     1. You want to add the models to a m2m relationship
     2. The models were constructed like Model(pk=pk)
+
+    Only the models that did not come from a DB are fetched, and the order of
+    the list is kept. Raises Model.DoesNotExist if some models do not exist in
+    the DB, and a ValidationError if a pk is not valid.
+
+    If identity_map, a dict of instances by (model class, pk), is given, the
+    instances it contains are used instead of being fetched again and the
+    fetched instances are added to it.
     """
     if not models:
         return models
 
-    obj = models[0]
+    keys = [None if obj._state.db else _get_key(obj) for obj in models]
+    missing: Dict[type, set] = {}
+    for key in keys:
+        if key is not None and (
+                identity_map is None or key not in identity_map):
+            missing.setdefault(key[0], set()).add(key[1])
 
-    if not obj._state.db:
-        pks = [model.pk for model in models]
-        Model = obj._meta.model
-
-        return list(Model.objects.filter(pk__in=pks))
-    else:
+    if not missing and identity_map is None:
         return models
 
+    fetched = {}
+    for Model, pks in missing.items():
+        instances = fetch_by_pks(Model, pks)
+        not_found = pks.difference(instances)
+        if not_found:
+            raise Model.DoesNotExist(
+                "{0} with pks {1} do not exist".format(
+                    Model._meta.object_name, sorted(not_found)))
+        for pk, instance in instances.items():
+            fetched[(Model, pk)] = instance
+    if identity_map is not None:
+        identity_map.update(fetched)
+        fetched = identity_map
+
+    return [
+        obj if key is None else fetched[key]
+        for obj, key in zip(models, keys)]
+
+
+def _shallow_copy(obj):
+    # Same as copy.copy for plain objects, without the __reduce_ex__ overhead.
+    result = obj.__class__.__new__(obj.__class__)
+    result.__dict__.update(obj.__dict__)
+    return result
+
+
+def _copy_field(field):
+    """Same copy as Field.__deepcopy__ but the choices are shared."""
+    result = _shallow_copy(field)
+    result.widget = widget = _shallow_copy(field.widget)
+    widget.attrs = widget.attrs.copy()
+    result.validators = field.validators[:]
+    return result
+
+
+def _copy_model_choice_field(field):
+    result = _copy_field(field)
+    # The queryset is cloned because ModelChoiceIterator.__len__ fills its
+    # result cache. Setting it also binds a new iterator to the copy.
+    result.queryset = field.queryset.all()
+    return result
+
+
+def _get_field_copier(field_class, widget_class):
+    """Returns the function copying a field of field_class with a widget of
+    widget_class, or None if only a deep copy is known to be safe.
+    """
+    if widget_class.__deepcopy__ not in (
+            forms.Widget.__deepcopy__,
+            forms.widgets.ChoiceWidget.__deepcopy__):
+        return None
+    if hasattr(field_class, "__slots__") or hasattr(widget_class, "__slots__"):
+        return None
+    deepcopy = field_class.__deepcopy__
+    if deepcopy in (forms.Field.__deepcopy__, forms.ChoiceField.__deepcopy__):
+        return _copy_field
+    if deepcopy is forms.ModelChoiceField.__deepcopy__:
+        return _copy_model_choice_field
+    return None
+
+
+_field_copiers: Dict[Tuple[type, type], Any] = {}
+
+
+class FieldPrototypes(OrderedDict):
+    """base_fields of a PrototypeFormMixin form.
+
+    BaseForm deep-copies base_fields for each form instance. This copy only
+    copies what a form may modify on its fields: the field and widget
+    attributes, the widget attrs and the validators. Choices, error messages
+    and other attribute values are shared with the prototype fields.
+    """
+
+    def __deepcopy__(self, memo):
+        fields = OrderedDict()
+        for name, field in self.items():
+            key = (type(field), type(field.widget))
+            try:
+                copier = _field_copiers[key]
+            except KeyError:
+                copier = _field_copiers[key] = _get_field_copier(*key)
+            if copier is None:
+                fields[name] = copy.deepcopy(field, memo)
+            else:
+                fields[name] = copier(field)
+        return fields
+
+
+class PrototypeFormMixin:
+    """Builds the fields of each form instance from prototypes instead of deep
+    copies of base_fields. See FieldPrototypes.
+
+    Choices are shared between form instances: a form can replace the choices
+    of its fields (field.choices = ...) but must not modify them in place.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.get_prototypes()
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def get_prototypes(cls) -> FieldPrototypes:
+        prototypes = cls.__dict__.get("base_fields")
+        if not isinstance(prototypes, FieldPrototypes):
+            prototypes = cls.base_fields = FieldPrototypes(cls.base_fields)
+        return prototypes
+
+
+def _uses_loader(field):
+    """The loader can only replace the queryset if it is not filtered and if
+    the field selects instances by pk.
+    """
+    queryset = field.queryset
+    return (
+        field.to_field_name in (None, queryset.model._meta.pk.name) and
+        not queryset.query.has_filters())
+
+
+class LoaderModelChoiceField(forms.ModelChoiceField):
+    """Fetches the selected instance with the loader of the request.
+    """
+
+    def to_python(self, value):
+        if value in self.empty_values or not _uses_loader(self):
+            return super().to_python(value)
+        try:
+            instance = get_loader().load(self.queryset.model, value)
+        except ValidationError:
+            instance = None
+        if instance is None:
+            raise ValidationError(
+                self.error_messages['invalid_choice'], code='invalid_choice')
+        return instance
+
+
+class LoaderModelMultipleChoiceField(forms.ModelMultipleChoiceField):
+    """Fetches the selected instances with the loader of the request.
+    """
+
+    def _check_values(self, value):
+        if not _uses_loader(self):
+            return super()._check_values(value)
+        try:
+            value = frozenset(value)
+        except TypeError:
+            raise ValidationError(
+                self.error_messages['list'], code='list')
+        values = list(value)
+        try:
+            instances = get_loader().load_many(self.queryset.model, values)
+        except ValidationError:
+            raise ValidationError(
+                self.error_messages['invalid_choice'], code='invalid_choice',
+                params={'value': ", ".join(str(val) for val in values)})
+        for val, instance in zip(values, instances):
+            if instance is None:
+                raise ValidationError(
+                    self.error_messages['invalid_choice'],
+                    code='invalid_choice', params={'value': val})
+        return instances
+
+
+class LoaderFormMixin:
+    """Queues the submitted pks of loader_fields, and of the Loader*Field
+    fields, in the loader of the request. The first field fetching an
+    instance thus fetches the instances of all these fields with one query
+    per model.
+
+    Foreign keys fetched by the loader are not validated again by the model
+    validation.
+    """
 
-class ModelChoiceFieldWithEmptyLabel(forms.ModelChoiceField):
+    loader_fields: Dict[str, type] = {}
+    """Model of the instances selected by each field."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prime_loader()
+
+    def prime_loader(self):
+        if self.is_bound:
+            loader = get_loader()
+            for name, Model in self._get_loader_fields().items():
+                field = self.fields[name]
+                value = field.widget.value_from_datadict(
+                    self.data, self.files, self.add_prefix(name))
+                if value in field.empty_values:
+                    continue
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                loader.prime(Model, value)
+
+    def _get_loader_fields(self):
+        loader_fields = dict(self.loader_fields)
+        for name, field in self.fields.items():
+            if isinstance(field, (
+                    LoaderModelChoiceField, LoaderModelMultipleChoiceField)):
+                if _uses_loader(field):
+                    loader_fields[name] = field.queryset.model
+        return loader_fields
+
+    def _get_validation_exclusions(self):
+        exclude = super()._get_validation_exclusions()
+        for name in self._get_loader_fields():
+            value = self.cleaned_data.get(name)
+            if isinstance(value, models.Model) and value._state.db:
+                exclude.append(name)
+        return exclude
+
+
+class ActivitiesFormMixin:
+    """Saves the animal and its activities in one transaction. The activities
+    are saved by difference (see animal.editing.update_activities) instead of
+    with the m2m manager, which reads the stored activities twice and sends
+    m2m_changed for the added and for the removed ones.
+
+    An edited animal is only saved if it is still at the version of the
+    instance given to the form: save() raises ConcurrentUpdate otherwise.
+    """
+
+    def save(self, commit=True):
+        if not commit:
+            return super().save(commit=False)
+        self._adding = self.instance._state.adding
+        with transaction.atomic():
+            if not self._adding:
+                claim_version(self.instance.pk, self.instance.version)
+            return super().save()
+
+    def _save_m2m(self):
+        if "activities" not in self.cleaned_data:
+            return super()._save_m2m()
+        activities = self.cleaned_data.pop("activities")
+        try:
+            super()._save_m2m()
+        finally:
+            self.cleaned_data["activities"] = activities
+        animal = self.instance
+        added, removed = update_activities(
+            animal.pk, [activity.pk for activity in activities or []],
+            # A new animal has no activities yet.
+            () if getattr(self, "_adding", False) else None)
+        if added or removed:
+            refresh_display_columns([animal.pk])
+            bump(Animal)
+
+
+LOADER_FIELD_CLASSES = {
+    "type": LoaderModelChoiceField,
+    "favorite_activity": LoaderModelChoiceField,
+    "activities": LoaderModelMultipleChoiceField,
+}
+
+
+class ModelChoiceFieldWithEmptyLabel(LoaderModelChoiceField):
     """Adds an empty label to the choice even if the field is required.
     """
 
@@ -54,7 +335,29 @@ class TypedChoiceFieldNoValidation(forms.TypedChoiceField):
         pass
 
 
-class TypedMultipleChoiceFieldNoValidation(forms.TypedMultipleChoiceField):
+class CoerceManyMixin:
+    """Adds a coerce_many argument to TypedMultipleChoiceField.
+
+    coerce_many receives all the submitted values at once and returns the list
+    of coerced values, in the same order. It raises a ValidationError if some
+    values are invalid. This is useful to fetch all the values with a single
+    query instead of one query per value.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.coerce_many = kwargs.pop("coerce_many", None)
+        super().__init__(*args, **kwargs)
+
+    def _coerce(self, value):
+        if self.coerce_many is None:
+            return super()._coerce(value)
+        if value == self.empty_value or value in self.empty_values:
+            return self.empty_value
+        return self.coerce_many(value)
+
+
+class TypedMultipleChoiceFieldNoValidation(
+        CoerceManyMixin, forms.TypedMultipleChoiceField):
     """Does not validate the selected value in a list of choices.
 
     Effectively delegates validation to the coerce function and clean function.
@@ -67,16 +370,107 @@ class TypedMultipleChoiceFieldNoValidation(forms.TypedMultipleChoiceField):
         pass
 
 
-class Form1(forms.ModelForm):
+class IndexedChoiceFieldMixin:
+    """Validates the value with the hashed index of an IndexedChoices instead
+    of scanning the list of choices.
+
+    Plain lists of choices are wrapped in an IndexedChoices. The choices are
+    static: the index is shared by the copies of the field, so callables,
+    which Django calls again for each iteration, are rejected. Choices
+    changing per form are set on the form's fields, e.g., in setup_fields().
+    """
+
+    def _set_choices(self, value):
+        if not isinstance(value, IndexedChoices):
+            if callable(value):
+                raise TypeError(
+                    "%s choices must be static: set a list or an "
+                    "IndexedChoices on each form instead of a callable." %
+                    type(self).__name__)
+            value = IndexedChoices(list(value))
+        self._choices = self.widget.choices = value
+
+    choices = property(forms.ChoiceField._get_choices, _set_choices)
+
+    def valid_value(self, value):
+        return value in self._choices
+
+
+class IndexedChoiceField(IndexedChoiceFieldMixin, forms.TypedChoiceField):
+    """TypedChoiceField validating the value in O(1).
+    """
+
+
+class IndexedMultipleChoiceField(
+        CoerceManyMixin, IndexedChoiceFieldMixin,
+        forms.TypedMultipleChoiceField):
+    """TypedMultipleChoiceField validating each value in O(1).
+    """
+
+
+class SearchSelectMixin:
+    """Renders only the selected options of a LookupChoices, and a search box
+    filling the select with the results of search_url (see
+    animal/static/animal/search_select.js).
+
+    type_field is the id of a select restricting the search to an animal
+    type, if any.
+    """
+    template_name = "animal/widgets/search_select.html"
+
+    def __init__(self, attrs=None, choices=(),
+                 search_url="animal:activity_search", type_field=None):
+        super().__init__(attrs, choices)
+        self.search_url = search_url
+        self.type_field = type_field
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context["widget"]["search_url"] = reverse(self.search_url)
+        context["widget"]["type_field"] = self.type_field
+        return context
+
+    def optgroups(self, name, value, attrs=None):
+        choices = self.choices
+        if not isinstance(choices, LookupChoices):
+            return super().optgroups(name, value, attrs)
+        options = []
+        if choices.empty_label is not None:
+            options.append(("", choices.empty_label))
+        for option_value in value:
+            label = choices.label(option_value)
+            if label is not None and option_value != "":
+                options.append((option_value, label))
+        return [
+            (None, [self.create_option(
+                name, option_value, label, option_value in value, index,
+                attrs=attrs)], index)
+            for index, (option_value, label) in enumerate(options)]
+
+
+class SearchSelect(SearchSelectMixin, forms.Select):
+    pass
+
+
+class SearchSelectMultiple(SearchSelectMixin, forms.SelectMultiple):
+    pass
+
+
+class Form1(ProfilingFormMixin, PrototypeFormMixin,
+            LoaderFormMixin, ActivitiesFormMixin,
+            forms.ModelForm):
     """Basic ModelForm
     """
 
     class Meta:
         model = Animal
         fields = ["name", "age", "type", "favorite_activity", "activities"]
+        field_classes = LOADER_FIELD_CLASSES
 
 
-class DynamicRequired1(forms.ModelForm):
+class DynamicRequired1(ProfilingFormMixin, PrototypeFormMixin,
+                       LoaderFormMixin, ActivitiesFormMixin,
+                       forms.ModelForm):
     """Age required if type is cat. This is checked in clean().
 
     Adding an empty label, e.g., 'Please select this' to a modelchoicefield can
@@ -100,9 +494,12 @@ class DynamicRequired1(forms.ModelForm):
     class Meta:
         model = Animal
         fields = ["name", "age", "type", "favorite_activity", "activities"]
+        field_classes = LOADER_FIELD_CLASSES
 
 
-class DynamicRequired2(forms.ModelForm):
+class DynamicRequired2(ProfilingFormMixin, PrototypeFormMixin,
+                       LoaderFormMixin, ActivitiesFormMixin,
+                       forms.ModelForm):
     """Age is required if type is cat. This time, we set the required attribute
     in __init__. The required validation is more standard BUT we must work with
     unvalidated data instead of cleaned_data.
@@ -110,7 +507,10 @@ class DynamicRequired2(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.setup_fields()
 
+    def setup_fields(self):
+        """Customizes the fields of this instance."""
         # Alternative to ModelChoiceFieldWithEmptyLabel
         self.fields["type"].empty_label = "Select Animal Type"
         animal_type = self.data.get(self.add_prefix("type"))
@@ -120,6 +520,7 @@ class DynamicRequired2(forms.ModelForm):
     class Meta:
         model = Animal
         fields = ["name", "age", "type", "favorite_activity", "activities"]
+        field_classes = LOADER_FIELD_CLASSES
 
 
 def get_animal_type(value):
@@ -133,14 +534,52 @@ def get_animal_type(value):
 
 
 def get_activity(value):
-    """Fetches the activity from the DB.
+    """Fetches the activity from the DB, with the loader of the request.
+    """
+    # Not called when value is empty
+    activity = get_loader().load(Activity, value)
+    if activity is None:
+        # Will add a standard invalid choice error.
+        raise forms.ValidationError("Unknown activity")
+    return activity
+
+
+def _is_activity_pk(value):
+    try:
+        Activity._meta.pk.to_python(value)
+    except ValidationError:
+        return False
+    return True
+
+
+def get_activities(values):
+    """Fetches all the activities from the DB with a single query, with the
+    loader of the request. The activities are returned in the order of values.
+    """
+    # Not called when values is empty
+    valid = [value for value in values if _is_activity_pk(value)]
+    activities = dict(zip(valid, get_loader().load_many(Activity, valid)))
+    missing = [value for value in values if activities.get(value) is None]
+    if missing:
+        raise forms.ValidationError(
+            "Select valid choices. %(values)s are not available choices.",
+            code="invalid_choice",
+            params={"values": ", ".join(str(value) for value in missing)})
+    return [activities[value] for value in values]
+
+
+def get_catalog_activity(value):
+    """Builds the activity from the catalog: no fetch to DB. Unlike
+    get_lazy_activity, the pk is validated and animal_type_id is available.
     """
     # Not called when value is empty
     try:
-        return Activity.objects.get(pk=value)
-    except Activity.DoesNotExist:
+        pk = int(value)
+        label, type_id = catalog.snapshot().activity_index[pk]
+    except (ValueError, TypeError, KeyError):
         # Will add a standard invalid choice error.
-        raise forms.ValidationError()
+        raise forms.ValidationError("Unknown activity")
+    return Activity(pk=pk, label=label, animal_type_id=type_id)
 
 
 def get_lazy_activity(value):
@@ -153,11 +592,19 @@ def get_lazy_activity(value):
     return Activity(pk=value)
 
 
-class DynamicRequired3(forms.ModelForm):
+class DynamicRequired3(ProfilingFormMixin, PrototypeFormMixin,
+                       LoaderFormMixin, ActivitiesFormMixin,
+                       forms.ModelForm):
     """Demonstrates the use of TypedChoiceField to replace a ModelChoiceField.
     """
 
-    type = forms.TypedChoiceField(
+    loader_fields = {
+        "favorite_activity": Activity,
+        "activities": Activity,
+    }
+    """favorite_activity and activities are fetched with a single query."""
+
+    type = IndexedChoiceField(
         empty_value=None,  # Value given to empty choice
         coerce=get_animal_type,
         required=True)
@@ -177,31 +624,35 @@ class DynamicRequired3(forms.ModelForm):
         choices=[("", "Select Age"), ("1", "1"), ("2", "2")])
     """You can transform a standard field into a choice field."""
 
-    activities = forms.TypedMultipleChoiceField(
+    activities = IndexedMultipleChoiceField(
         empty_value=None,  # Value given to empty choice
-        coerce=get_lazy_activity,
+        coerce_many=get_activities,
         required=True)
-    """Will validate the value with a list of choices defined in __init__"""
+    """Will validate the value with a list of choices defined in __init__.
+    The list is indexed so each value is validated in O(1). All the activities
+    are then fetched with a single query."""
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.setup_fields()
+
+    def setup_fields(self):
+        """Sets the choices of this instance."""
+        snapshot = catalog.snapshot()
 
         # XXX Example how we can build a completely custom list of choices
         # for a FK in a model.
-        choices = [
-            (type.pk, type.label)
-            for type in AnimalType.objects.all()]
-        choices.insert(0, ("", "Select an animal"))
-        self.fields["type"].choices = choices
+        self.fields["type"].choices = snapshot.type_source(
+            empty_label="Select an animal")
 
-        # XXX Set activity choices for this animal type.
+        # XXX Set activity choices for this animal type. The snapshot keeps
+        # a source per type, so unknown types (e.g., any string posted) are
+        # left to the validation of the type field.
         animal_type = self.data.get(self.add_prefix("type"))
-        if animal_type:
-            choices = [
-                (activity.pk, activity.label) for activity in
-                Activity.objects.filter(animal_type_id=animal_type)
-            ]
-            self.fields["activities"].choices = choices
+        if isinstance(animal_type, str) and (
+                animal_type in snapshot.type_labels):
+            self.fields["activities"].choices = snapshot.activity_source(
+                animal_type)
 
     def clean(self):
         cleaned_data = super().clean()
@@ -214,12 +665,15 @@ class DynamicRequired3(forms.ModelForm):
     def save(self, *args, **kwargs):
         # XXX With m2m, lazy objects do not work :-(
         # Imagine if your list has thousands of choices and the user
-        # can select hundreds of choice. This method has very good performance,
-        # but it offers no validation (hence the choice computation in
-        # __init__).
+        # can select hundreds of choice. get_lazy_activity has very good
+        # performance, but it offers no validation (hence the choice
+        # computation in __init__). get_activities fetches all the activities
+        # in one query so there is nothing left to materialize here.
         activities = self.cleaned_data.get("activities")
         if activities:
-            new_activities = materialize_models(activities)
+            with self.profile_step("materialize"):
+                new_activities = materialize_models(
+                    activities, get_loader().identity_map)
             self.cleaned_data["activities"] = new_activities
         super().save(*args, **kwargs)
 
@@ -228,7 +682,7 @@ class DynamicRequired3(forms.ModelForm):
         fields = ["name", "age", "type", "favorite_activity", "activities"]
 
 
-class DynamicRequired4(forms.Form):
+class DynamicRequired4(ProfilingFormMixin, PrototypeFormMixin, forms.Form):
     """Replaces a ModelForm by a form when you have heavily customized fields.
     """
 
@@ -236,41 +690,50 @@ class DynamicRequired4(forms.Form):
         label="name")
     age = forms.IntegerField(
         label="age", required=False)
-    type = forms.ChoiceField(
+    type = IndexedChoiceField(
         label="Type")
-    favorite_activity = forms.TypedChoiceField(
+    favorite_activity = IndexedChoiceField(
         coerce=int,
         empty_value=None,
-        label="Favorite Activity")
-    activities = forms.TypedMultipleChoiceField(
+        label="Favorite Activity",
+        widget=SearchSelect(type_field="id_type"))
+    activities = IndexedMultipleChoiceField(
         coerce=int,
         empty_value=None,
-        label="Activities")
+        label="Activities",
+        widget=SearchSelectMultiple(type_field="id_type"))
+    """The searches of both activity fields are restricted to the selected
+    type."""
+
+    version = forms.IntegerField(
+        widget=forms.HiddenInput, required=False)
+    """Version of the edited animal, checked by save_instance."""
+
+    instance = None
+    """Edited animal. A new animal is created if None."""
 
     def __init__(self, *args, **kwargs):
         # Instance is not a valid keyword arg so we remove it
         instance = kwargs.pop("instance", None)
-        if instance:
-            initial = self.get_initial(instance)
-            kwargs["initial"] = initial
-            print(kwargs)
         super().__init__(*args, **kwargs)
-
-        choices = [
-            (type.pk, type.label)
-            for type in AnimalType.objects.all()]
-        choices.insert(0, ("", "Select an animal"))
-        choices.append(("tiger", "Tiger"))
-        self.fields["type"].choices = choices
-
-        choices = [
-            (activity.pk, activity.label)
-            for activity in Activity.objects.all()
-        ]
-        choices.insert(0, ("", "Select an activity"))
-        self.fields["favorite_activity"].choices = choices
-        new_choices = choices[1:]
-        self.fields["activities"].choices = new_choices
+        if instance is not None:
+            self.instance = instance
+            if not self.is_bound:
+                self.initial = self.get_initial(instance)
+            self.fields["version"].required = True
+        self.setup_fields()
+
+    def setup_fields(self):
+        """Sets the choices of this instance."""
+        snapshot = catalog.snapshot()
+
+        self.fields["type"].choices = snapshot.type_source(
+            empty_label="Select an animal", extra=[("tiger", "Tiger")])
+        # Only the selected activities are rendered: the others are searched
+        # (see SearchSelect).
+        self.fields["favorite_activity"].choices = (
+            snapshot.activity_lookup_source(empty_label="Select an activity"))
+        self.fields["activities"].choices = snapshot.activity_lookup_source()
 
     def get_initial(self, instance):
         initial = {
@@ -278,30 +741,87 @@ class DynamicRequired4(forms.Form):
             "age": instance.age,
             "type": instance.type_id,
             "favorite_activity": instance.favorite_activity_id,
-            "activities": [
-                activity.pk for activity in instance.activities.all()]
+            "activities": list(instance.activities.values_list(
+                "pk", flat=True)),
+            "version": instance.version,
         }
         if instance.internal_notes == "tiger":
             initial["type"] = "tiger"
         return initial
 
-    def save_instance(self):
-        type = self.cleaned_data["type"]
-        if type == "tiger":
+    def save_instance(self) -> int:
+        """Creates the animal, or updates the edited one, and returns its pk.
+
+        The pks were validated with the catalog choices, so nothing is
+        fetched: the animal and its activities are written in one transaction
+        with a constant number of queries (see animal.bulk.create_animals and
+        animal.editing.update_animal). Only the activities that changed are
+        written.
+
+        Raises ConcurrentUpdate if the edited animal changed since the
+        version of the form.
+        """
+        type_id = self.cleaned_data["type"]
+        if type_id == "tiger":
             internal_notes = "tiger"
-            type = AnimalType(pk="cat")
+            type_id = "cat"
         else:
             internal_notes = ""
 
-        animal = Animal(
-            type=type,
-            age=self.cleaned_data["age"],
+        row = AnimalRow(
             name=self.cleaned_data["name"],
-            favorite_activity=Activity(
-                pk=self.cleaned_data["favorite_activity"]),
-            internal_notes=internal_notes
-        )
-        animal.save()
-        activities = Activity.objects.filter(
-            pk__in=self.cleaned_data["activities"])
-        animal.activities.add(*activities)
+            age=self.cleaned_data["age"],
+            type_id=type_id,
+            favorite_activity_id=self.cleaned_data["favorite_activity"],
+            activity_ids=self.cleaned_data["activities"],
+            internal_notes=internal_notes)
+        if self.instance is None:
+            return create_animals([row])[0]
+        update_animal(self.instance.pk, self.cleaned_data["version"], row)
+        return self.instance.pk
+
+
+class AnimalImportForm(DynamicRequired3):
+    """Validates an animal created in bulk. Same rules as DynamicRequired3,
+    plus the age requirement of DynamicRequired1.
+
+    Everything is validated with the catalog so validating a form does not
+    query the DB.
+    """
+
+    favorite_activity = TypedChoiceFieldNoValidation(
+        empty_value=None,
+        coerce=get_catalog_activity,
+        required=True)
+
+    activities = IndexedMultipleChoiceField(
+        empty_value=None,
+        coerce=get_lazy_activity,
+        required=True)
+    """Values are already validated by the choices so lazy activities are
+    safe."""
+
+    age = forms.IntegerField(required=False)
+    """Any age, not only the choices of the DynamicRequired3 page."""
+
+    loader_fields = {}
+    """Nothing is fetched."""
+
+    def clean(self):
+        super().clean()
+        animal_type = self.cleaned_data.get("type")
+        if animal_type and animal_type.pk == "cat":
+            if self.cleaned_data.get("age") is None:
+                self.add_error("age", "Age is required when cat is selected")
+
+    def _get_validation_exclusions(self):
+        # Foreign keys are already validated with the catalog: skip the
+        # existence queries of the model validation. Missing values are still
+        # rejected by it.
+        exclude = super()._get_validation_exclusions()
+        return exclude + [
+            name for name in ("type", "favorite_activity")
+            if self.cleaned_data.get(name) is not None]
+
+    class Meta(DynamicRequired3.Meta):
+        fields = DynamicRequired3.Meta.fields + ["internal_notes"]
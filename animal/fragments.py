@@ -0,0 +1,111 @@
+"""Cache of rendered page fragments, keyed on the data versions of the models
+they display (see animal.catalog.versions).
+
+A fragment is rendered again when one of its models changed in this process,
+or when it is older than MAX_AGE seconds. Fragments are kept in an
+in-process LRU and, optionally, in a Django cache backend configured by the
+ANIMAL_FRAGMENT_CACHE setting::
+
+    ANIMAL_FRAGMENT_CACHE = {
+        "MAXSIZE": 256,        # Fragments kept in the in-process LRU
+        "MAX_AGE": 10,         # Seconds, None to never expire
+        "BACKEND": "default",  # Alias of a CACHES entry, None by default
+        "TIMEOUT": 300,
+    }
+
+The versions are per process: a change made by another worker is not seen
+by them. MAX_AGE bounds how long such a worker serves a stale fragment. Set
+it to None only if a single process writes to the database.
+
+For the same reason, the backend keys include the origin of the versions: a
+fragment cached by a process is never served by another one. A backend thus
+helps to keep more fragments than the LRU (e.g., a file based cache), not to
+share them.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from django.core.cache import caches
+from django.utils.safestring import SafeText, mark_safe
+
+from animal.catalog import versions
+
+
+class FragmentCache:
+
+    def __init__(self, maxsize: int = 256, max_age: Optional[float] = 10,
+                 backend: Optional[str] = None,
+                 timeout: Optional[int] = 300):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.backend = backend
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._fragments: OrderedDict = OrderedDict()
+
+    def configure(self, config: dict):
+        """Configures the cache from the ANIMAL_FRAGMENT_CACHE setting."""
+        self.maxsize = config.get("MAXSIZE", 256)
+        self.max_age = config.get("MAX_AGE", 10)
+        self.backend = config.get("BACKEND")
+        self.timeout = config.get("TIMEOUT", 300)
+        self.clear()
+
+    def get_or_render(self, name: str, models: tuple, params: Tuple,
+                      render: Callable[[], str]) -> SafeText:
+        """Returns the fragment called name for params, calling render if it
+        is not cached for the current versions of models.
+        """
+        key = (name, versions.get(*models), params)
+        fragments = self._fragments
+        with self._lock:
+            entry = fragments.get(key)
+            if entry is not None:
+                fragment, rendered_at = entry
+                if not self._is_expired(rendered_at):
+                    fragments.move_to_end(key)
+                    return fragment
+                del fragments[key]
+        entry = None
+        backend = caches[self.backend] if self.backend else None
+        if backend is not None:
+            backend_key = self._backend_key(key)
+            entry = backend.get(backend_key)
+            if entry is not None and self._is_expired(entry[1]):
+                entry = None
+        if entry is None:
+            fragment = mark_safe(render())
+            rendered_at = time.time()
+            if backend is not None:
+                backend.set(
+                    backend_key, (str(fragment), rendered_at), self.timeout)
+        else:
+            fragment, rendered_at = mark_safe(entry[0]), entry[1]
+        with self._lock:
+            fragments[key] = (fragment, rendered_at)
+            fragments.move_to_end(key)
+            while len(fragments) > self.maxsize:
+                fragments.popitem(last=False)
+        return fragment
+
+    def _is_expired(self, rendered_at: float) -> bool:
+        # Wall-clock time: also compared with the time of the fragments
+        # rendered before a restart, found in the backend.
+        return (self.max_age is not None and
+                time.time() - rendered_at >= self.max_age)
+
+    def _backend_key(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return "animal:fragment:{0}:{1}:{2}".format(
+            versions.origin, key[0], digest)
+
+    def clear(self):
+        """Empties the in-process LRU."""
+        with self._lock:
+            self._fragments.clear()
+
+
+fragments = FragmentCache()
@@ -0,0 +1,161 @@
+"""Generates synthetic animals, activities and animal types.
+
+The data only depends on the parameters and the seed: primary keys are
+assigned by the generator instead of the database. Rows are inserted with
+bulk_create, in batches, without sending signals, so the data versions are
+bumped once at the end.
+"""
+import random
+from typing import Callable, List, Optional
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+
+from animal.catalog import bump
+from animal.models import Animal, AnimalType, Activity, format_animal_label
+
+NAMES = [
+    "Bella", "Charlie", "Luna", "Max", "Lucy", "Cooper", "Daisy", "Milo",
+    "Oliver", "Rocky", "Nala", "Simba", "Coco", "Leo", "Zoe", "Toby",
+]
+
+MODELS = [Animal.activities.through, Animal, Activity, AnimalType]
+"""Models written by the generator, in deletion order."""
+
+
+def clear():
+    """Deletes all the animals, activities and animal types with one DELETE
+    per table.
+    """
+    tables = [Model._meta.db_table for Model in MODELS]
+    sequences = [
+        {"table": Model._meta.db_table, "column": Model._meta.pk.column}
+        for Model in MODELS if Model._meta.auto_field]
+    statements = connection.ops.sql_flush(no_style(), tables, sequences)
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def reset_sequences():
+    """Makes the database assign pks after the generated ones. Nothing to do
+    on SQLite: AUTOINCREMENT never reuses a pk.
+    """
+    statements = connection.ops.sequence_reset_sql(no_style(), MODELS)
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def _through_insert_sql():
+    Through = Animal.activities.through
+    quote_name = connection.ops.quote_name
+    return "INSERT INTO {0} ({1}, {2}) VALUES (%s, %s)".format(
+        quote_name(Through._meta.db_table),
+        quote_name(Through._meta.get_field("animal").column),
+        quote_name(Through._meta.get_field("activity").column))
+
+
+def create_types(count: int) -> List[AnimalType]:
+    """Creates count animal types. The first two are cat and dog."""
+    codes = ["cat", "dog"] + ["type%d" % i for i in range(2, count)]
+    types = [
+        AnimalType(code=code, label=code.capitalize())
+        for code in codes[:count]]
+    AnimalType.objects.bulk_create(types)
+    return types
+
+
+def create_activities(types: List[AnimalType],
+                      per_type: int) -> List[List[Activity]]:
+    """Creates per_type activities for each type and returns them by type.
+    """
+    by_type = []
+    pk = 1
+    for animal_type in types:
+        activities = []
+        for i in range(per_type):
+            activities.append(Activity(
+                pk=pk, animal_type_id=animal_type.code,
+                label="{0} activity {1}".format(animal_type.label, i + 1)))
+            pk += 1
+        by_type.append(activities)
+    Activity.objects.bulk_create(
+        [activity for activities in by_type for activity in activities])
+    return by_type
+
+
+def create_animals(types: List[AnimalType],
+                   activities_by_type: List[List[Activity]], count: int,
+                   activities_per_animal: int = 3, seed: int = 0,
+                   first_pk: Optional[int] = None, batch_size: int = 5000,
+                   progress: Optional[Callable[[int], None]] = None) -> int:
+    """Creates count animals, with pks starting at first_pk (by default, after
+    the last animal). Each animal has
+    activities_per_animal activities of its type (fewer if its type has
+    fewer), the first one being its favorite.
+
+    Returns the number of through rows created. progress, if given, is called
+    with the number of animals created after each batch. bulk_create splits
+    each batch further if the backend limits the size of a query.
+
+    The through rows are inserted with executemany: building millions of
+    through model instances would take most of the time.
+    """
+    if first_pk is None:
+        first_pk = (Animal.objects.aggregate(Max("pk"))["pk__max"] or 0) + 1
+    rng = random.Random(seed)
+    types_with_activities = [
+        (animal_type, activities)
+        for animal_type, activities in zip(types, activities_by_type)
+        if activities]
+    insert_through = _through_insert_sql()
+    through_count = 0
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        animals = []
+        through = []
+        for pk in range(first_pk + created, first_pk + created + size):
+            animal_type, activities = rng.choice(types_with_activities)
+            selected = rng.sample(
+                activities, min(activities_per_animal, len(activities)))
+            name = "{0} {1}".format(rng.choice(NAMES), pk)
+            age = rng.randint(1, 20)
+            animals.append(Animal(
+                pk=pk, name=name, age=age, type_id=animal_type.code,
+                favorite_activity_id=selected[0].pk,
+                activity_count=len(selected),
+                display_label=format_animal_label(
+                    animal_type.label, name, age, selected[0].label,
+                    len(selected), "")))
+            through.extend((pk, activity.pk) for activity in selected)
+        Animal.objects.bulk_create(animals)
+        with connection.cursor() as cursor:
+            cursor.executemany(insert_through, through)
+        through_count += len(through)
+        created += size
+        if progress is not None:
+            progress(created)
+    return through_count
+
+
+def generate(types: int = 10, activities_per_type: int = 10,
+             animals: int = 1000, activities_per_animal: int = 3,
+             seed: int = 0, batch_size: int = 5000,
+             progress: Optional[Callable[[int], None]] = None) -> int:
+    """Replaces all the animals, activities and animal types by generated
+    ones, in one transaction. Returns the number of through rows created.
+    """
+    with transaction.atomic():
+        clear()
+        animal_types = create_types(types)
+        activities = create_activities(animal_types, activities_per_type)
+        through_count = create_animals(
+            animal_types, activities, animals, activities_per_animal,
+            seed=seed, first_pk=1, batch_size=batch_size, progress=progress)
+        reset_sequences()
+        for Model in (AnimalType, Activity, Animal):
+            bump(Model)
+    return through_count
@@ -0,0 +1,112 @@
+"""Request-scoped identity map and batching loader, in the DataLoader style.
+
+Code that will need some instances queues their pks with prime(). The first
+load() then fetches everything queued with one query per model. Instances are
+cached for the rest of the request, so the same row is never fetched twice.
+
+The loader of the current request is installed by
+animal.middleware.LoaderMiddleware.
+"""
+import threading
+from typing import (  # noqa: F401 (only used in annotations)
+    Any, Dict, Iterable, List, Optional, Set, Tuple)
+
+from django.core.exceptions import ValidationError
+from django.db import connections, models, router
+
+
+def fetch_by_pks(Model, pks, using=None) -> Dict[Any, models.Model]:
+    """Fetches the instances of Model with the given pks and returns them by
+    pk. The pks are split in chunks so that a query never uses more parameters
+    than the backend allows (999 for SQLite).
+    """
+    pks = list(pks)
+    using = using or router.db_for_read(Model)
+    connection = connections[using]
+    size = connection.ops.bulk_batch_size([Model._meta.pk], pks) or 1
+    instances = {}
+    for start in range(0, len(pks), size):
+        queryset = Model._default_manager.using(using).filter(
+            pk__in=pks[start:start + size])
+        for instance in queryset:
+            instances[instance.pk] = instance
+    return instances
+
+
+class Loader:
+    """Identity map of instances by (model class, pk) with a queue of pks to
+    fetch.
+    """
+
+    def __init__(self):
+        self.identity_map: Dict[Tuple[type, Any], models.Model] = {}
+        self._missing: Set[Tuple[type, Any]] = set()
+        self._queue: Dict[type, Set[Any]] = {}
+
+    def _key(self, Model, pk):
+        """Raises a ValidationError if pk is not a valid pk for Model."""
+        Model = Model._meta.concrete_model
+        return Model, Model._meta.pk.to_python(pk)
+
+    def prime(self, Model, pks: Iterable[Any]):
+        """Queues pks to fetch at the next load. Invalid pks are ignored.
+        """
+        for pk in pks:
+            try:
+                key = self._key(Model, pk)
+            except ValidationError:
+                continue
+            if key not in self.identity_map and key not in self._missing:
+                self._queue.setdefault(key[0], set()).add(key[1])
+
+    def load(self, Model, pk) -> Optional[models.Model]:
+        """Returns the instance of Model with pk or None if it does not exist.
+        Raises a ValidationError if pk is not a valid pk.
+        """
+        return self.load_many(Model, [pk])[0]
+
+    def load_many(self, Model, pks) -> List[Optional[models.Model]]:
+        """Returns the instances of Model, in the order of pks. None replaces
+        the instances that do not exist.
+
+        Raises a ValidationError if a pk is not a valid pk.
+        """
+        keys = [self._key(Model, pk) for pk in pks]
+        for key in keys:
+            if key not in self.identity_map and key not in self._missing:
+                self._queue.setdefault(key[0], set()).add(key[1])
+        self.dispatch()
+        return [self.identity_map.get(key) for key in keys]
+
+    def dispatch(self):
+        """Fetches all the queued pks, with one query per model."""
+        queue, self._queue = self._queue, {}
+        for Model, pks in queue.items():
+            instances = fetch_by_pks(Model, pks)
+            for pk in pks:
+                instance = instances.get(pk)
+                if instance is None:
+                    self._missing.add((Model, pk))
+                else:
+                    self.identity_map[(Model, pk)] = instance
+
+
+_active = threading.local()
+
+
+def activate(loader: Loader):
+    _active.loader = loader
+
+
+def deactivate():
+    _active.loader = None
+
+
+def get_loader() -> Loader:
+    """Returns the loader of the current request. Outside of a request, a new
+    loader is returned so nothing is cached.
+    """
+    loader = getattr(_active, "loader", None)
+    if loader is None:
+        loader = Loader()
+    return loader
@@ -0,0 +1,96 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from animal.benchmarks import (
+    OPERATIONS, VARIANTS, compare, get_metadata, run_benchmarks)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def name_list(value):
+    return [item for item in value.split(",") if item]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the form variants and the coercion strategies for several "
+        "numbers of activities and animals. Runs in a test database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--activities", type=int_list, default=[10, 1000, 100000],
+            help="Comma separated numbers of activities.")
+        parser.add_argument(
+            "--animals", type=int_list, default=[1000, 1000000],
+            help="Comma separated numbers of animals.")
+        parser.add_argument("--types", type=int, default=10)
+        parser.add_argument(
+            "--variants", type=name_list,
+            default=[variant.name for variant in VARIANTS])
+        parser.add_argument(
+            "--operations", type=name_list, default=OPERATIONS)
+        parser.add_argument(
+            "--repeat", type=int, default=5,
+            help="Maximum number of timed runs per measurement.")
+        parser.add_argument(
+            "--max-time", type=float, default=1.0,
+            help="Stops timing a measurement after this many seconds.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--output", help="Writes the results to this JSON file.")
+        parser.add_argument(
+            "--compare",
+            help="Reports the regressions against this JSON file.")
+        parser.add_argument("--threshold", type=float, default=1.2)
+
+    def handle(self, *args, **options):
+        variants = [
+            variant for variant in VARIANTS
+            if variant.name in options["variants"]]
+        unknown = set(options["operations"]) - set(OPERATIONS)
+        if unknown:
+            raise CommandError(
+                "Unknown operations: %s" % ", ".join(sorted(unknown)))
+        if options["types"] < 2:
+            raise CommandError("At least 2 types are required.")
+
+        metadata = get_metadata()
+        results = run_benchmarks(
+            options["activities"], options["animals"], variants,
+            options["operations"], types=options["types"],
+            repeat=options["repeat"], max_time=options["max_time"],
+            seed=options["seed"], report=self._report)
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(
+                    {"metadata": metadata, "results": results}, output,
+                    indent=2)
+
+        if options["compare"]:
+            with open(options["compare"]) as previous:
+                previous_results = json.load(previous)["results"]
+            regressions = list(compare(
+                results, previous_results, options["threshold"]))
+            for result, old, ratio in regressions:
+                self.stdout.write(
+                    "Regression: {variant} {operation} ({activities} "
+                    "activities, {animals} animals): ".format(**result) +
+                    "x{0:.2f}, {1} -> {2} queries".format(
+                        ratio, old["queries"], result["queries"]))
+            if not regressions:
+                self.stdout.write("No regression")
+
+    def _report(self, result):
+        prefix = "{variant:<20} {operation:<13} {activities:>7} {animals:>8}"
+        if "error" in result:
+            self.stdout.write((prefix + " {error}").format(**result))
+        else:
+            self.stdout.write((
+                prefix + " {wall_time_min_ms:10.3f} ms {queries:4d} queries "
+                "{peak_memory_kb:10.1f} KiB").format(
+                    wall_time_min_ms=result["wall_time_min"] * 1000,
+                    peak_memory_kb=result["peak_memory"] / 1024, **result))
@@ -0,0 +1,69 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from animal.benchmarks import (
+    BenchmarkError, get_metadata, run_sqlite_benchmarks)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the queries of the main access patterns without and with "
+        "their indexes, and concurrent form POSTs with the default SQLite "
+        "settings and with the profile of animal.sqlite. Runs in a test "
+        "database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--activities", type=int, default=1000)
+        parser.add_argument("--animals", type=int, default=100000)
+        parser.add_argument("--types", type=int, default=10)
+        parser.add_argument(
+            "--threads", type=int, default=8,
+            help="Number of threads posting at the same time.")
+        parser.add_argument(
+            "--posts", type=int, default=25,
+            help="Number of POSTs per thread.")
+        parser.add_argument(
+            "--repeat", type=int, default=20,
+            help="Maximum number of timed runs per query.")
+        parser.add_argument(
+            "--max-time", type=float, default=1.0,
+            help="Stops timing a query after this many seconds.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--output", help="Writes the results to this JSON file.")
+
+    def handle(self, *args, **options):
+        if options["types"] < 2:
+            raise CommandError("At least 2 types are required.")
+        metadata = get_metadata()
+        try:
+            results = run_sqlite_benchmarks(
+                activities=options["activities"], animals=options["animals"],
+                types=options["types"], threads=options["threads"],
+                posts=options["posts"], repeat=options["repeat"],
+                max_time=options["max_time"], seed=options["seed"],
+                report=self._report)
+        except BenchmarkError as e:
+            raise CommandError(str(e))
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(
+                    {"metadata": metadata, "results": results}, output,
+                    indent=2)
+
+    def _report(self, result):
+        if result["operation"] == "concurrent_post":
+            self.stdout.write((
+                "{variant:<10} {operation:<20} {posts:5d} posts "
+                "{wall_time:8.3f} s {posts_per_second:8.1f}/s "
+                "{errors:4d} errors").format(**result))
+            for error in result["error_samples"]:
+                self.stdout.write("    " + error)
+        else:
+            self.stdout.write((
+                "{variant:<10} {operation:<20} {wall_time_min_ms:10.3f} ms "
+                "{plan}").format(
+                    wall_time_min_ms=result["wall_time_min"] * 1000,
+                    **result))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from animal.export import WRITERS, export_chunks
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports all the animals as CSV or NDJSON, in the format read by "
+        "import_animals.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format", choices=sorted(WRITERS), default="ndjson")
+        parser.add_argument(
+            "--output", help="Defaults to the standard output.")
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        iter_text = WRITERS[options["format"]][0]
+        chunks = export_chunks(chunk_size=options["chunk_size"])
+        if options["output"]:
+            with open(options["output"], "w", newline="",
+                      encoding="utf-8") as output:
+                for text in iter_text(chunks):
+                    output.write(text)
+        else:
+            for text in iter_text(chunks):
+                self.stdout.write(text, ending="")
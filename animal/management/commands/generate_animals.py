@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from animal.generate import generate
+
+
+class Command(BaseCommand):
+    help = (
+        "Replaces all the animals, activities and animal types by generated "
+        "ones. The data only depends on the parameters and the seed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--types", type=int, default=10)
+        parser.add_argument("--activities-per-type", type=int, default=10)
+        parser.add_argument("--animals", type=int, default=1000)
+        parser.add_argument("--activities-per-animal", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--batch-size", type=int, default=5000,
+            help="Number of animals inserted per bulk_create.")
+        parser.add_argument(
+            "--noinput", "--no-input", action="store_false",
+            dest="interactive",
+            help="Does not ask for confirmation before deleting the data.")
+
+    def handle(self, *args, **options):
+        if options["types"] < 1 and options["animals"] > 0:
+            raise CommandError("Animals need at least one type.")
+        if options["activities_per_type"] < 1 and options["animals"] > 0:
+            raise CommandError("Animals need at least one activity.")
+        if options["interactive"]:
+            answer = input(
+                "This will delete all the animals, activities and animal "
+                "types. Type 'yes' to continue: ")
+            if answer != "yes":
+                raise CommandError("Generation cancelled.")
+
+        start = time.monotonic()
+        through_count = generate(
+            types=options["types"],
+            activities_per_type=options["activities_per_type"],
+            animals=options["animals"],
+            activities_per_animal=options["activities_per_animal"],
+            seed=options["seed"], batch_size=options["batch_size"],
+            progress=self._progress if options["verbosity"] > 1 else None)
+        self.stdout.write(
+            "Generated {0} types, {1} activities, {2} animals and {3} animal "
+            "activities in {4:.1f}s".format(
+                options["types"],
+                options["types"] * options["activities_per_type"],
+                options["animals"], through_count, time.monotonic() - start))
+
+    def _progress(self, created):
+        self.stdout.write("{0} animals created".format(created))
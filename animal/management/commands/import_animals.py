@@ -0,0 +1,156 @@
+import collections
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from animal.bulk import create_animals, validate_rows
+from animal.catalog import catalog
+from animal.workers import close_connections, init_worker
+
+
+def read_csv(stream):
+    """Columns: name, age, type, favorite_activity, activities (pks
+    separated by semicolons) and internal_notes.
+    """
+    for row in csv.DictReader(stream):
+        activities = row.get("activities") or ""
+        row["activities"] = [
+            pk.strip() for pk in activities.split(";") if pk.strip()]
+        yield row
+
+
+def read_ndjson(stream):
+    """One JSON object per line, like the rows of the bulk endpoint."""
+    for line in stream:
+        line = line.strip()
+        if line:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield row if isinstance(row, dict) else {}
+
+
+READERS = {
+    "csv": read_csv,
+    "ndjson": read_ndjson,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports animals from a CSV or NDJSON file. The file is streamed, "
+        "rows are validated like AnimalImportForm in worker processes and "
+        "committed in bulk, one transaction per batch.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--format", choices=sorted(READERS),
+            help="Defaults to the extension of the file.")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of rows validated by a worker and committed in one "
+                 "transaction.")
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(),
+            help="Number of validation processes. 0 validates in this "
+                 "process.")
+        parser.add_argument(
+            "--checkpoint",
+            help="File recording the number of rows already handled. The "
+                 "import resumes after these rows.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or os.path.splitext(path)[1][1:]
+        if file_format not in READERS:
+            raise CommandError("Unknown format: {0}".format(file_format))
+        batch_size = options["batch_size"]
+        workers = options["workers"]
+        self.checkpoint = options["checkpoint"]
+
+        self.skipped = skip = self._read_checkpoint()
+        self.handled = skip
+        self.created = 0
+        self.invalid = 0
+        self.started = time.monotonic()
+
+        # Built before forking so workers validate without querying the DB.
+        catalog.snapshot()
+
+        with open(path, newline="", encoding="utf-8") as stream:
+            batches = self._batches(
+                READERS[file_format](stream), skip, batch_size)
+            if workers:
+                close_connections()
+                with multiprocessing.Pool(
+                        workers, initializer=init_worker) as pool:
+                    self._run_parallel(pool, batches, workers * 2)
+            else:
+                for batch in batches:
+                    self._commit(validate_rows(batch))
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(
+            "Imported {0} animals, {1} invalid rows in {2:.1f}s".format(
+                self.created, self.invalid, elapsed))
+
+    def _batches(self, rows, skip, batch_size):
+        batch = []
+        for number, row in enumerate(rows, start=1):
+            if number <= skip:
+                continue
+            batch.append((number, row))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _run_parallel(self, pool, batches, window):
+        # At most window batches are in memory: Pool.imap would read the
+        # whole file ahead of the workers.
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(validate_rows, (batch,)))
+            if len(pending) >= window:
+                self._commit(pending.popleft().get())
+        while pending:
+            self._commit(pending.popleft().get())
+
+    def _commit(self, results):
+        rows = []
+        for number, row, errors in results:
+            if errors:
+                self.invalid += 1
+                self.stderr.write("Row {0}: {1}".format(
+                    number, json.dumps(errors)))
+            else:
+                rows.append(row)
+        self.created += len(create_animals(rows))
+        self.handled = results[-1][0]
+        self._write_checkpoint()
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write("{0} rows handled, {1:.0f} rows/sec".format(
+            self.handled,
+            (self.handled - self.skipped) / elapsed if elapsed else 0))
+
+    def _read_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return 0
+        with open(self.checkpoint) as checkpoint:
+            return int(checkpoint.read().strip() or 0)
+
+    def _write_checkpoint(self):
+        if not self.checkpoint:
+            return
+        tmp_path = self.checkpoint + ".tmp"
+        with open(tmp_path, "w") as checkpoint:
+            checkpoint.write(str(self.handled))
+        os.replace(tmp_path, self.checkpoint)
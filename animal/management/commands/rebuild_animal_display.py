@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from animal.display import refresh_display_columns
+from animal.models import Animal
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the denormalized display columns of all the animals."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=5000,
+            help="Number of animals updated per transaction.")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        pks = Animal.objects.order_by("pk").values_list("pk", flat=True)
+        batch = []
+        total = 0
+        for pk in pks.iterator():
+            batch.append(pk)
+            if len(batch) >= batch_size:
+                total += self._refresh(batch)
+                batch = []
+        if batch:
+            total += self._refresh(batch)
+        self.stdout.write("Rebuilt {0} animals".format(total))
+
+    def _refresh(self, pks):
+        with transaction.atomic():
+            refresh_display_columns(pks)
+        return len(pks)
@@ -0,0 +1,249 @@
+"""Per-request timings and per-view histograms.
+
+MetricsMiddleware activates a RequestMetrics for each request. The queries
+of the request are counted and timed by a cursor wrapper, and code can time
+its own phases with timed(). The timings are sent in the Server-Timing
+header and aggregated per view in the registry, which is exposed in the
+Prometheus text format by the metrics view.
+
+The histograms are per process, like the data versions of animal.catalog.
+"""
+import bisect
+import functools
+import threading
+from time import perf_counter
+from typing import (  # noqa: F401 (only used in annotations)
+    Dict, List, Optional, Tuple)
+
+_active = threading.local()
+
+
+class RequestMetrics:
+    """Queries and timings (in seconds) of one request."""
+
+    __slots__ = ("queries", "sql_time", "spans")
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.spans: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float):
+        spans = self.spans
+        spans[name] = spans.get(name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """Returns the value of the Server-Timing header."""
+        timings = ['sql;dur={0:.3f};desc="{1} queries"'.format(
+            self.sql_time * 1000, self.queries)]
+        timings.extend(
+            "{0};dur={1:.3f}".format(name, seconds * 1000)
+            for name, seconds in self.spans.items())
+        return ", ".join(timings)
+
+
+def activate(metrics: RequestMetrics):
+    _active.metrics = metrics
+
+
+def deactivate():
+    _active.metrics = None
+
+
+def get_metrics() -> Optional[RequestMetrics]:
+    """Returns the metrics of the current request, if any."""
+    return getattr(_active, "metrics", None)
+
+
+class timed:
+    """Adds the time spent in a block, or in a function when used as a
+    decorator, to the span called name of the current request.
+    """
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        metrics = getattr(_active, "metrics", None)
+        if metrics is not None:
+            metrics.add(self.name, perf_counter() - self.start)
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class TimedCursor:
+    """Wraps a CursorWrapper to count and time its queries in the metrics of
+    the current request.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def _run(self, method, *args):
+        metrics = getattr(_active, "metrics", None)
+        if metrics is None:
+            return method(*args)
+        start = perf_counter()
+        try:
+            return method(*args)
+        finally:
+            metrics.sql_time += perf_counter() - start
+            metrics.queries += 1
+
+    def execute(self, sql, params=None):
+        return self._run(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._run(self.cursor.executemany, sql, param_list)
+
+    def callproc(self, procname, params=None):
+        return self._run(self.cursor.callproc, procname, params)
+
+
+def instrument(connection):
+    """Makes the cursors of connection (a DatabaseWrapper) TimedCursors.
+    Does nothing if already done.
+    """
+    if getattr(connection, "_metrics_instrumented", False):
+        return
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: TimedCursor(make_cursor(cursor))
+    connection.make_debug_cursor = lambda cursor: TimedCursor(
+        make_debug_cursor(cursor))
+    connection._metrics_instrumented = True
+
+
+TIME_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+"""Upper bounds of the duration buckets, in seconds."""
+
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+"""Upper bounds of the query count buckets."""
+
+
+class Histogram:
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels):
+    return ",".join(
+        '{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace(
+            '"', '\\"').replace("\n", "\\n"))
+        for name, value in labels)
+
+
+class MetricsRegistry:
+    """Histograms of the requests, by view."""
+
+    metrics = {
+        "animal_request_duration_seconds": (
+            "Time spent in each phase of the requests.", TIME_BUCKETS),
+        "animal_request_queries": (
+            "Number of queries of the requests.", QUERY_BUCKETS),
+        "animal_form_duration_seconds": (
+            "Time spent in each step of the profiled forms.", TIME_BUCKETS),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, tuple], Histogram] = {}
+
+    def _observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(
+                self.metrics[name][1])
+        histogram.observe(value)
+
+    def observe_request(self, view: str, metrics: RequestMetrics):
+        with self._lock:
+            for phase, seconds in metrics.spans.items():
+                self._observe(
+                    "animal_request_duration_seconds",
+                    (("view", view), ("phase", phase)), seconds)
+            self._observe(
+                "animal_request_duration_seconds",
+                (("view", view), ("phase", "sql")), metrics.sql_time)
+            self._observe(
+                "animal_request_queries", (("view", view),), metrics.queries)
+
+    def observe_form(self, form: str, timings: List[Tuple[str, float]]):
+        """Adds the timings of animal.profiling to the histograms."""
+        with self._lock:
+            for step, seconds in timings:
+                self._observe(
+                    "animal_form_duration_seconds",
+                    (("form", form), ("step", step)), seconds)
+
+    def render(self) -> str:
+        """Returns the histograms in the Prometheus text format."""
+        with self._lock:
+            histograms = sorted(
+                (key, (list(histogram.counts), histogram.sum,
+                       histogram.count, histogram.buckets))
+                for key, histogram in self._histograms.items())
+        lines: List[str] = []
+        for name, (help_text, buckets) in sorted(self.metrics.items()):
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} histogram".format(name))
+            for (metric, labels), (counts, total, count, bounds) in histograms:
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(
+                        list(bounds) + ["+Inf"], counts):
+                    cumulative += bucket_count
+                    lines.append("{0}_bucket{{{1}}} {2}".format(
+                        name, _format_labels(labels + (("le", bound),)),
+                        cumulative))
+                lines.append("{0}_sum{{{1}}} {2}".format(
+                    name, _format_labels(labels), total))
+                lines.append("{0}_count{{{1}}} {2}".format(
+                    name, _format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+registry = MetricsRegistry()
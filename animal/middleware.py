@@ -0,0 +1,55 @@
+from time import perf_counter
+
+from django.db import connections
+
+from animal import metrics
+from animal.loader import Loader, activate, deactivate
+
+
+class LoaderMiddleware:
+    """Installs a new animal.loader.Loader for each request. It is also
+    available as request.loader.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.loader = loader = Loader()
+        activate(loader)
+        try:
+            return self.get_response(request)
+        finally:
+            deactivate()
+
+
+class MetricsMiddleware:
+    """Counts and times the queries of each request, as well as the phases
+    timed with animal.metrics.timed. The timings are sent in the Server-Timing
+    header and added to the histograms of the view.
+
+    Should be the first middleware so that the total covers the others. The
+    content of a streamed response is produced after the timings are sent:
+    it is not included.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        for connection in connections.all():
+            metrics.instrument(connection)
+        request_metrics = metrics.RequestMetrics()
+        metrics.activate(request_metrics)
+        start = perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.deactivate()
+        request_metrics.add("total", perf_counter() - start)
+
+        response["Server-Timing"] = request_metrics.server_timing()
+        match = request.resolver_match
+        metrics.registry.observe_request(
+            match.view_name if match else "<unresolved>", request_metrics)
+        return response
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def format_animal_label(type_label, name, age, activity_label, count,
+                        internal_notes):
+    # Frozen copy of animal.models.format_animal_label: later changes of the
+    # display format are applied by the rebuild_animal_display command.
+    label = "{type}: {name} of age {age}. Favorite: {activity} "\
+        "({count} activities)".format(
+            type=type_label, name=name, age=age, activity=activity_label,
+            count=count)
+
+    if internal_notes:
+        label += " notes: {0}".format(internal_notes)
+
+    return label
+
+
+def fill_display_columns(apps, schema_editor):
+    Animal = apps.get_model("animal", "Animal")
+    animals = Animal.objects.select_related(
+        "type", "favorite_activity").annotate(
+            num_activities=models.Count("activities"))
+    for animal in animals.iterator():
+        Animal.objects.filter(pk=animal.pk).update(
+            activity_count=animal.num_activities,
+            display_label=format_animal_label(
+                animal.type.label, animal.name, animal.age,
+                animal.favorite_activity.label, animal.num_activities,
+                animal.internal_notes))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('animal', '0002_initial_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='animal',
+            name='activity_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='animal',
+            name='display_label',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(
+            fill_display_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 16:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+THROUGH_INDEXES = [
+    ("animal_anim_acts_animal_idx", ["animal_id", "activity_id"]),
+    ("animal_anim_acts_activity_idx", ["activity_id", "animal_id"]),
+]
+"""Indexes of the Animal.activities through table: activities of an animal
+and, in reverse, animals of an activity."""
+
+
+def add_through_indexes(apps, schema_editor):
+    # Some databases, e.g., SQLite ones created by 0001, have no index on the
+    # through table. An index starting with the same columns is enough.
+    Through = apps.get_model("animal", "Animal").activities.through
+    table = Through._meta.db_table
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    existing = [
+        constraint["columns"] for constraint in constraints.values()
+        if constraint["index"] or constraint["unique"]]
+    quote_name = schema_editor.quote_name
+    for name, columns in THROUGH_INDEXES:
+        if any(list(other[:len(columns)]) == columns for other in existing):
+            continue
+        schema_editor.execute("CREATE INDEX {0} ON {1} ({2})".format(
+            quote_name(name), quote_name(table),
+            ", ".join(quote_name(column) for column in columns)))
+
+
+def remove_through_indexes(apps, schema_editor):
+    Through = apps.get_model("animal", "Animal").activities.through
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(
+            cursor, Through._meta.db_table)
+    for name, columns in THROUGH_INDEXES:
+        if name in constraints:
+            schema_editor.execute(
+                "DROP INDEX {0}".format(schema_editor.quote_name(name)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('animal', '0003_animal_display_columns'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(
+                fields=['animal_type', 'label'],
+                name='animal_acti_type_label_idx'),
+        ),
+        migrations.RunPython(add_through_indexes, remove_through_indexes),
+    ]
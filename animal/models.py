@@ -14,10 +14,75 @@ class Activity(models.Model):
         AnimalType, related_name="activities")
     label = models.CharField(max_length=200)
 
+    class Meta:
+        indexes = [
+            # Activities of a type, ordered by label
+            models.Index(
+                fields=["animal_type", "label"],
+                name="animal_acti_type_label_idx"),
+        ]
+
     def __str__(self):
         return self.label
 
 
+def format_animal_label(type_label, name, age, activity_label, count,
+                        internal_notes):
+    label = "{type}: {name} of age {age}. Favorite: {activity} "\
+        "({count} activities)".format(
+            type=type_label, name=name, age=age, activity=activity_label,
+            count=count)
+
+    if internal_notes:
+        label += " notes: {0}".format(internal_notes)
+
+    return label
+
+
+class AnimalQuerySet(models.QuerySet):
+
+    def for_display(self):
+        """Fetches everything needed by Animal.__str__ in the same query.
+        """
+        return self.select_related("type", "favorite_activity").annotate(
+            num_activities=models.Count("activities"))
+
+    def display_page(self, after=None, size=50):
+        """Returns a page of animals ready to display, ordered by pk, and the
+        pk to give as after to get the next page (None on the last page).
+
+        Uses keyset pagination so the cost of a page does not depend on its
+        position. Only the animal table is read: the label comes from the
+        denormalized display_label column.
+        """
+        queryset = self.order_by("pk")
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        animals = list(queryset[:size + 1])
+        if len(animals) > size:
+            animals = animals[:size]
+            return animals, animals[-1].pk
+        return animals, None
+
+    def chunks(self, size=1000):
+        """Yields lists of at most size animals, ordered by pk.
+
+        Each chunk is fetched by its own keyset query: some backends (e.g.,
+        SQLite) cannot stream the rows of a single query so iterator() alone
+        would still load the whole table in memory.
+        """
+        after = None
+        while True:
+            queryset = self.order_by("pk")
+            if after is not None:
+                queryset = queryset.filter(pk__gt=after)
+            chunk = list(queryset[:size].iterator())
+            if not chunk:
+                return
+            yield chunk
+            after = chunk[-1].pk
+
+
 class Animal(models.Model):
     name = models.CharField(max_length=100)
     age = models.IntegerField(null=True, blank=True)
@@ -28,14 +93,30 @@ class Animal(models.Model):
         Activity, related_name="animals", blank=True)
     internal_notes = models.TextField(blank=True, default="")
 
-    def __str__(self):
-        label = "{type}: {name} of age {age}. Favorite: {activity} "\
-            "({count} activities)".format(
-                type=self.type.label, name=self.name, age=self.age,
-                activity=self.favorite_activity.label,
-                count=self.activities.count())
+    activity_count = models.PositiveIntegerField(default=0, editable=False)
+    """Denormalized number of activities. Maintained by animal.display."""
+    display_label = models.TextField(blank=True, default="", editable=False)
+    """Denormalized __str__. Maintained by animal.display."""
+
+    version = models.PositiveIntegerField(default=0, editable=False)
+    """Incremented by each save. Used by animal.editing to detect concurrent
+    edits."""
 
-        if self.internal_notes:
-            label += " notes: {0}".format(self.internal_notes)
+    objects = AnimalQuerySet.as_manager()
 
-        return label
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.version += 1
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None:
+                kwargs["update_fields"] = set(update_fields) | {"version"}
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        # num_activities is annotated by AnimalQuerySet.for_display
+        count = getattr(self, "num_activities", None)
+        if count is None:
+            count = self.activities.count()
+        return format_animal_label(
+            self.type.label, self.name, self.age,
+            self.favorite_activity.label, count, self.internal_notes)
@@ -0,0 +1,342 @@
+"""Sampled profiling of form validation and saving.
+
+Forms using ProfilingFormMixin time, for a sample of their instances, the
+clean() of each field, each clean_<field> method, the form clean(), the model
+validation and save()/save_instance(). The timings are attached to the form
+(form.profile) and reported to the sinks of the profiler.
+
+The profiler is configured by the ANIMAL_FORM_PROFILING setting. Nothing is
+profiled by default: the test project enables the configuration below when
+the ANIMAL_FORM_PROFILING environment variable is 1::
+
+    ANIMAL_FORM_PROFILING = {
+        "SAMPLE_RATE": 0.01,
+        "SINKS": [
+            "animal.profiling.metrics_sink",
+            ("animal.profiling.ProfilerTrigger", {"threshold": 0.1}),
+        ],
+    }
+
+A sink is a callable taking the profile and the timings recorded since the
+last report, or a (dotted path, keyword arguments) tuple building one. When
+a form is not sampled, profiling costs one random() call per validation.
+"""
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+Timings = List[Tuple[str, float]]
+
+
+def total_time(timings: Timings) -> float:
+    """Returns the time of the top-level steps (nested steps are included in
+    their parent step)."""
+    return sum(seconds for name, seconds in timings if "." not in name)
+
+
+class FormProfile:
+    """Timings (in seconds) of one form instance, in the order they were
+    recorded. A step run several times is recorded each time. A step run
+    within another one is named after it, e.g., save.materialize.
+    """
+
+    def __init__(self, form_name: str, cprofile=None):
+        self.form_name = form_name
+        self.timings: Timings = []
+        self.cprofile: Optional[cProfile.Profile] = cprofile
+        """Set when the profiler was armed for this form (see arm)."""
+        self._reported = 0
+        self._running: List[str] = []
+
+    @property
+    def total(self) -> float:
+        return total_time(self.timings)
+
+    def as_dict(self) -> Dict[str, float]:
+        """Returns the total time of each step."""
+        totals: Dict[str, float] = {}
+        for name, seconds in self.timings:
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def is_running(self, name: str) -> bool:
+        return name in self._running
+
+    @contextmanager
+    def step(self, name: str):
+        """Times a block. Blocks nested in a step of the same name are not
+        recorded again, e.g., a save() calling super().save().
+        """
+        running = self._running
+        if name in running:
+            yield
+            return
+        full_name = ".".join(running + [name])
+        cprofile = self.cprofile if not running else None
+        running.append(name)
+        if cprofile is not None:
+            cprofile.enable()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((full_name, perf_counter() - start))
+            if cprofile is not None:
+                cprofile.disable()
+            running.pop()
+
+    def pop_new_timings(self) -> Timings:
+        timings = self.timings[self._reported:]
+        self._reported = len(self.timings)
+        return timings
+
+
+Sink = Callable[[FormProfile, Timings], None]
+
+
+class FormProfiler:
+    """Decides which forms are profiled and reports their timings."""
+
+    def __init__(self, sample_rate: float = 0.0, sinks: List[Sink] = ()):
+        self.sample_rate = sample_rate
+        self.sinks = list(sinks)
+        self._lock = threading.Lock()
+        self._armed: Dict[str, int] = {}
+
+    def configure(self, config: dict):
+        """Configures the profiler from the ANIMAL_FORM_PROFILING setting."""
+        self.sample_rate = config.get("SAMPLE_RATE", 0.0)
+        self.sinks = [_build_sink(sink) for sink in config.get("SINKS", [])]
+
+    def arm(self, form_name: str, count: int = 1):
+        """Runs cProfile on the next count sampled instances of the form."""
+        with self._lock:
+            self._armed[form_name] = max(self._armed.get(form_name, 0), count)
+
+    def _take_armed(self, form_name):
+        if form_name not in self._armed:
+            return False
+        with self._lock:
+            count = self._armed.get(form_name, 0)
+            if count <= 1:
+                self._armed.pop(form_name, None)
+            else:
+                self._armed[form_name] = count - 1
+            return count > 0
+
+    def start(self, form) -> Optional[FormProfile]:
+        """Returns a new profile if form is sampled, None otherwise."""
+        sample_rate = form.profile_sample_rate
+        if sample_rate is None:
+            sample_rate = self.sample_rate
+        if not sample_rate or random.random() >= sample_rate:
+            return None
+        form_name = type(form).__name__
+        cprofile = (
+            cProfile.Profile() if self._take_armed(form_name) else None)
+        return FormProfile(form_name, cprofile)
+
+    def report(self, profile: FormProfile):
+        """Gives the timings recorded since the last report to the sinks."""
+        timings = profile.pop_new_timings()
+        if not timings:
+            return
+        for sink in self.sinks:
+            try:
+                sink(profile, timings)
+            except Exception:
+                logger.exception("Form profiling sink %r failed", sink)
+
+
+def _build_sink(sink) -> Sink:
+    if isinstance(sink, (list, tuple)):
+        path, kwargs = sink
+        return import_string(path)(**kwargs)
+    if isinstance(sink, str):
+        return import_string(sink)
+    return sink
+
+
+profiler = FormProfiler()
+
+
+def log_sink(profile: FormProfile, timings: Timings):
+    """Logs the timings at the DEBUG level."""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s: %s", profile.form_name, ", ".join(
+            "{0}={1:.3f}ms".format(name, seconds * 1000)
+            for name, seconds in timings))
+
+
+def metrics_sink(profile: FormProfile, timings: Timings):
+    """Adds the timings to the histograms of animal.metrics."""
+    from animal.metrics import registry
+    registry.observe_form(profile.form_name, timings)
+
+
+class ProfilerTrigger:
+    """Arms cProfile for the next count instances of a form when the reported
+    timings of one of its instances exceed threshold seconds, and writes the
+    statistics collected for the armed instances.
+
+    The statistics are written to directory (one .prof file per form
+    instance, readable with pstats or snakeviz) or, if directory is None,
+    logged at the WARNING level.
+    """
+
+    def __init__(self, threshold: float, count: int = 1,
+                 directory: Optional[str] = None, limit: int = 25):
+        self.threshold = threshold
+        self.count = count
+        self.directory = directory
+        self.limit = limit
+
+    def __call__(self, profile: FormProfile, timings: Timings):
+        if profile.cprofile is not None:
+            self.write_stats(profile)
+            return
+        total = total_time(timings)
+        if total >= self.threshold:
+            logger.warning(
+                "%s took %.3fms (%s), profiling the next %d instance(s)",
+                profile.form_name, total * 1000, ", ".join(
+                    "{0}={1:.3f}ms".format(name, seconds * 1000)
+                    for name, seconds in timings), self.count)
+            profiler.arm(profile.form_name, self.count)
+
+    def write_stats(self, profile: FormProfile):
+        # The statistics of an instance are written after validation, then
+        # again, cumulated, after saving.
+        if self.directory is not None:
+            path = os.path.join(self.directory, "{0}-{1}-{2}.prof".format(
+                profile.form_name, time.strftime("%Y%m%d%H%M%S"),
+                id(profile)))
+            profile.cprofile.dump_stats(path)
+            logger.warning("Profile of %s written to %s", profile.form_name,
+                           path)
+        else:
+            output = io.StringIO()
+            stats = pstats.Stats(profile.cprofile, stream=output)
+            stats.sort_stats("cumulative").print_stats(self.limit)
+            logger.warning("Profile of %s:\n%s", profile.form_name,
+                           output.getvalue())
+
+
+class ProfilingFormMixin:
+    """Times the validation and the save of a sample of the instances. See
+    the module documentation.
+
+    Methods can time their own steps with profile_step(), e.g., a step of
+    save().
+    """
+
+    profile_sample_rate: Optional[float] = None
+    """Overrides the sample rate of the profiler for this form class."""
+
+    profile: Optional[FormProfile] = None
+    """Timings of this instance, if it was sampled."""
+
+    profiled_methods = ("save", "save_instance")
+    """Methods timed as a whole, named after the method."""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls.profiled_methods:
+            method = getattr(cls, name, None)
+            if method is not None and not getattr(method, "profiled", False):
+                setattr(cls, name, _profile_method(name, method))
+
+    def profile_step(self, name: str):
+        """Returns a context manager timing a block if this instance is
+        profiled.
+        """
+        if self.profile is None:
+            return _NO_STEP
+        return self.profile.step(name)
+
+    def full_clean(self):
+        if self.profile is None:
+            self.profile = profiler.start(self)
+        if self.profile is None:
+            return super().full_clean()
+        try:
+            return super().full_clean()
+        finally:
+            profiler.report(self.profile)
+
+    def _clean_fields(self):
+        if self.profile is None:
+            return super()._clean_fields()
+        # Times the clean() of each field and each clean_<field> method by
+        # wrapping them, on this instance, around BaseForm._clean_fields.
+        step = self.profile.step
+        wrapped = []
+        for name, field in self.fields.items():
+            field.clean = _timed(step, "field:%s" % name, field.clean)
+            wrapped.append((field, "clean"))
+            clean_method = getattr(self, "clean_%s" % name, None)
+            if clean_method is not None:
+                setattr(self, "clean_%s" % name, _timed(
+                    step, "clean_%s" % name, clean_method))
+                wrapped.append((self, "clean_%s" % name))
+        try:
+            super()._clean_fields()
+        finally:
+            for obj, attribute in wrapped:
+                delattr(obj, attribute)
+
+    def _clean_form(self):
+        with self.profile_step("clean"):
+            super()._clean_form()
+
+    def _post_clean(self):
+        with self.profile_step("post_clean"):
+            super()._post_clean()
+
+
+class _NoStep:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_STEP = _NoStep()
+
+
+def _timed(step, name, function):
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        with step(name):
+            return function(*args, **kwargs)
+    return timed
+
+
+def _profile_method(name, method):
+    @functools.wraps(method)
+    def profiled_method(self, *args, **kwargs):
+        profile = self.profile
+        if profile is None or profile.is_running(name):
+            return method(self, *args, **kwargs)
+        try:
+            with profile.step(name):
+                return method(self, *args, **kwargs)
+        finally:
+            profiler.report(profile)
+    profiled_method.profiled = True
+    return profiled_method
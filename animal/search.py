@@ -0,0 +1,101 @@
+"""In-memory prefix search of labels, for typeahead widgets.
+
+A label matches a query if each word of the query starts a word of the label
+(case-insensitive): "sw lak" matches "Swimming in the lake". Matches are
+returned in label order, a page at a time.
+"""
+import bisect
+import re
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+_WORD = re.compile(r"\w+")
+
+BROAD_QUERY = 2000
+"""Above this number of candidate words, the labels are scanned in label
+order until the page is full instead of sorting all the candidates."""
+
+
+def words(text: str) -> List[str]:
+    return _WORD.findall(text.casefold())
+
+
+class LabelIndex:
+    """Sorted index of the words of labels. Built once, then read-only: it
+    can be shared by threads.
+    """
+
+    def __init__(self, items: Iterable[Tuple[int, str, Optional[str]]]):
+        """items are (pk, label, group) tuples. Searches can be restricted to
+        a group, e.g., the animal type of an activity.
+        """
+        ordered = sorted(items, key=lambda item: (item[1].casefold(), item[0]))
+        self.pks = [pk for pk, label, group in ordered]
+        self.labels = [label for pk, label, group in ordered]
+        self._words = [tuple(words(label)) for label in self.labels]
+        entries = sorted(
+            (word, position)
+            for position, label_words in enumerate(self._words)
+            for word in set(label_words))
+        self._keys = [word for word, position in entries]
+        self._positions = [position for word, position in entries]
+        self._groups = {}
+        for position, (pk, label, group) in enumerate(ordered):
+            self._groups.setdefault(group, []).append(position)
+        self._group_sets = {
+            group: frozenset(positions)
+            for group, positions in self._groups.items()}
+
+    def __len__(self):
+        return len(self.pks)
+
+    def _candidates(self, term, group) -> Optional[Sequence[int]]:
+        """Returns the sorted positions of the labels having a word starting
+        with term, or None if there are too many to sort them.
+        """
+        start = bisect.bisect_left(self._keys, term)
+        end = bisect.bisect_left(self._keys, term + "\U0010ffff", start)
+        if end - start > BROAD_QUERY:
+            return None
+        positions = set(self._positions[start:end])
+        if group is not None:
+            positions &= self._group_sets.get(group, frozenset())
+        return sorted(positions)
+
+    def _matches(self, position, terms):
+        label_words = self._words[position]
+        return all(
+            any(word.startswith(term) for word in label_words)
+            for term in terms)
+
+    def search(self, query: str, group: Optional[str] = None,
+               offset: int = 0, limit: int = 20
+               ) -> Tuple[List[Tuple[int, str]], bool]:
+        """Returns the (pk, label) of the matching labels from offset, at
+        most limit of them, and whether there are more.
+        """
+        terms = words(query)
+        # The longest term is usually the most selective.
+        terms.sort(key=len, reverse=True)
+        positions = None
+        for term in terms:
+            positions = self._candidates(term, group)
+            if positions is not None:
+                break
+        if positions is None:
+            # Scan in label order: broad queries match early.
+            if group is not None:
+                positions = self._groups.get(group, [])
+            else:
+                positions = range(len(self.pks))
+        page = []
+        skipped = 0
+        for position in positions:
+            if terms and not self._matches(position, terms):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            if len(page) == limit:
+                return page, True
+            page.append((self.pks[position], self.labels[position]))
+        return page, False
@@ -0,0 +1,64 @@
+"""Opt-in performance profile for SQLite.
+
+With the ANIMAL_SQLITE_PROFILE setting, every new SQLite connection switches
+to WAL mode and gets the PRAGMAS below: readers no longer block the writer
+(and the other way around), and commits do not wait for an fsync of the
+database file. Set CONN_MAX_AGE in DATABASES too so the connections, and
+their page cache, are kept between requests.
+
+Atomic blocks also start with BEGIN IMMEDIATE instead of BEGIN: a deferred
+transaction that read before writing fails with "database is locked" if
+another connection wrote in between, without waiting for busy_timeout. An
+immediate transaction waits for the write lock before reading anything.
+
+Compare the two profiles with the benchmark_sqlite command.
+"""
+from typing import List, Tuple
+
+PRAGMAS: List[Tuple[str, str]] = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),  # Durable enough with WAL: see the SQLite doc
+    ("busy_timeout", "20000"),  # Milliseconds to wait for the write lock
+    ("cache_size", "-16000"),  # 16 MB per connection
+    ("temp_store", "MEMORY"),
+    ("mmap_size", "134217728"),
+]
+"""Pragmas of the profile, applied in this order."""
+
+DEFAULT_PRAGMAS: List[Tuple[str, str]] = [
+    ("journal_mode", "DELETE"),
+    ("synchronous", "FULL"),
+    ("busy_timeout", "5000"),
+    ("cache_size", "-2000"),
+    ("temp_store", "DEFAULT"),
+    ("mmap_size", "0"),
+]
+"""The values SQLite and Django use without the profile."""
+
+
+def apply_pragmas(connection, pragmas=PRAGMAS):
+    """Applies pragmas to connection (a DatabaseWrapper) if it is an SQLite
+    connection. journal_mode is persistent: it stays in the database file.
+    """
+    if connection.vendor != "sqlite":
+        return
+    # Raw connection: no transaction is open and nothing is logged.
+    for name, value in pragmas:
+        connection.connection.execute("PRAGMA {0} = {1}".format(name, value))
+
+
+def use_immediate_transactions(connection):
+    """Makes the atomic blocks of connection start with BEGIN IMMEDIATE."""
+    if connection.vendor != "sqlite":
+        return
+
+    def start_transaction_under_autocommit():
+        connection.cursor().execute("BEGIN IMMEDIATE")
+    connection._start_transaction_under_autocommit = (
+        start_transaction_under_autocommit)
+
+
+def on_connection_created(sender, connection, **kwargs):
+    """connection_created receiver, connected when the profile is enabled."""
+    apply_pragmas(connection)
+    use_immediate_transactions(connection)
@@ -0,0 +1,68 @@
+// Typeahead of the SearchSelect widgets: the select only contains the
+// selected options, the others are searched on the server as the user types.
+(function () {
+    "use strict";
+
+    var DELAY = 150;  // Milliseconds without typing before searching
+
+    function setup(input) {
+        var select = document.getElementById(input.dataset.for);
+        var timer = null;
+        var last = 0;
+
+        function search(anyType) {
+            var params = new URLSearchParams({q: input.value, limit: 50});
+            var typeField = input.dataset.typeField &&
+                document.getElementById(input.dataset.typeField);
+            if (!anyType && typeField && typeField.value) {
+                params.set("type", typeField.value);
+            }
+            var current = ++last;
+            fetch(input.dataset.searchUrl + "?" + params, {credentials: "same-origin"})
+                .then(function (response) {
+                    if (response.status === 400 && params.has("type")) {
+                        // A type the endpoint does not know (e.g., the
+                        // "tiger" choice of DynamicRequired4): search all.
+                        if (current === last) {
+                            search(true);
+                        }
+                        return null;
+                    }
+                    return response.json();
+                })
+                .then(function (data) {
+                    if (!data || current !== last || !data.results) {
+                        return;
+                    }
+                    // Keep the empty option and the selected ones.
+                    var kept = {};
+                    Array.prototype.slice.call(select.options).forEach(function (option) {
+                        if (option.value === "" || option.selected) {
+                            kept[option.value] = true;
+                        } else {
+                            select.removeChild(option);
+                        }
+                    });
+                    data.results.forEach(function (result) {
+                        var value = String(result.value);
+                        if (!kept[value]) {
+                            select.add(new Option(result.label, value));
+                        }
+                    });
+                });
+        }
+
+        input.addEventListener("input", function () {
+            clearTimeout(timer);
+            timer = setTimeout(function () { search(false); }, DELAY);
+        });
+        input.addEventListener("focus", function () {
+            if (select.options.length <= 1) {
+                search(false);
+            }
+        }, {once: true});
+    }
+
+    Array.prototype.slice.call(
+        document.querySelectorAll("input.search-select")).forEach(setup);
+})();
@@ -1,3 +1,1330 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django import forms
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.test import (
+    Client, TestCase, TransactionTestCase, override_settings)
+from django.urls import reverse
+
+from animal import sqlite
+from animal.benchmarks import INDEXES, SQLITE_QUERIES, _query_plan
+from animal.bulk import AnimalRow, create_animals, validate_rows
+from animal.catalog import IndexedChoices, catalog, versions
+from animal.compact import ActivityIndex, ActivityKeys, CompactCatalog, pack
+from animal.dictvalidation import dict_validator
+from animal.editing import (
+    ConcurrentUpdate, update_activities, update_animal)
+from animal.export import export_chunks, iter_csv, iter_ndjson
+from animal.forms import (
+    AnimalImportForm, DynamicRequired2, DynamicRequired3, DynamicRequired4,
+    FieldPrototypes, Form1, IndexedChoiceField, IndexedMultipleChoiceField,
+    PrototypeFormMixin, get_activities, materialize_models)
+from animal.fragments import FragmentCache
+from animal.loader import Loader, activate, deactivate
+from animal.management.commands.import_animals import read_csv
+from animal.models import Activity, Animal, AnimalType
+from animal.search import LabelIndex
+from animal.views import render_animals
+
+
+class CatalogTestMixin:
+    """Starts each test with an empty catalog: a snapshot built by a previous
+    test can contain rolled back rows.
+    """
+
+    def setUp(self):
+        super().setUp()
+        catalog.clear()
+
+
+class ChoiceCatalogTest(CatalogTestMixin, TestCase):
+
+    def test_snapshot_is_reused(self):
+        snapshot = catalog.snapshot()
+        with self.assertNumQueries(0):
+            self.assertIs(catalog.snapshot(), snapshot)
+
+    def test_snapshot_contents(self):
+        snapshot = catalog.snapshot()
+        self.assertIn(("cat", "Cat"), snapshot.types)
+        self.assertEqual(snapshot.type_labels["dog"], "Dog")
+        purring = Activity.objects.get(label="Purring")
+        self.assertEqual(
+            snapshot.activity_index[purring.pk], ("Purring", "cat"))
+        self.assertEqual(
+            [label for pk, label in snapshot.activity_choices_for_type(
+                "dog")],
+            ["Barking", "Walking"])
+        self.assertEqual(snapshot.activity_choices_for_type("unknown"), [])
+
+    def test_created_activity(self):
+        snapshot = catalog.snapshot()
+        activity = Activity.objects.create(
+            label="Digging", animal_type_id="dog")
+        new_snapshot = catalog.snapshot()
+        self.assertIsNot(new_snapshot, snapshot)
+        self.assertNotIn(activity.pk, snapshot.activity_index)
+        self.assertEqual(
+            new_snapshot.activity_index[activity.pk], ("Digging", "dog"))
+
+    def test_updated_and_deleted_rows(self):
+        catalog.snapshot()
+        AnimalType.objects.filter(pk="bird").update(label="Birdie")
+        # update() sends no signal: the catalog is not refreshed
+        self.assertEqual(catalog.snapshot().type_labels["bird"], "Bird")
+
+        animal_type = AnimalType.objects.get(pk="bird")
+        animal_type.save()
+        self.assertEqual(catalog.snapshot().type_labels["bird"], "Birdie")
+
+        activity = Activity.objects.get(label="Flying")
+        activity.delete()
+        self.assertNotIn(activity.pk, catalog.snapshot().activity_index)
+
+    def test_version_bumped_in_transaction(self):
+        version = versions.get(Activity)
+        with transaction.atomic():
+            Activity.objects.create(label="Digging", animal_type_id="dog")
+            # Bumped right away, so this thread sees its own writes
+            self.assertGreater(versions.get(Activity), version)
+
+
+class ChoicePayloadTest(CatalogTestMixin, TestCase):
+
+    def test_payload(self):
+        snapshot = catalog.snapshot()
+        self.assertEqual(
+            json.loads(snapshot.payload("types").decode("utf-8")),
+            [{"value": "cat", "label": "Cat"},
+             {"value": "dog", "label": "Dog"},
+             {"value": "bird", "label": "Bird"}])
+        self.assertEqual(
+            json.loads(snapshot.payload("types", "<Any>").decode("utf-8")),
+            [{"value": "", "label": "<Any>"},
+             {"value": "cat", "label": "Cat"},
+             {"value": "dog", "label": "Dog"},
+             {"value": "bird", "label": "Bird"}])
+        # Can be inlined in a <script> element
+        self.assertNotIn(b"<", snapshot.payload("types", "<Any>"))
+
+    def test_etag(self):
+        snapshot = catalog.snapshot()
+        etag = snapshot.etag("types")
+        self.assertEqual(catalog.snapshot().etag("types"), etag)
+        self.assertNotEqual(snapshot.etag("types", "Any"), etag)
+        self.assertNotEqual(
+            snapshot.etag("types", "Any"), snapshot.etag("types", "All"))
+        AnimalType.objects.create(code="fish", label="Fish")
+        self.assertNotEqual(catalog.snapshot().etag("types"), etag)
+
+    def test_view(self):
+        url = reverse("animal:choices", kwargs={"name": "types"})
+        response = self.client.get(url, {"empty": "Any"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf-8"))[0],
+                         {"value": "", "label": "Any"})
+        self.assertIn("no-cache", response["Cache-Control"])
+
+        response = self.client.get(
+            url, {"empty": "Any"}, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        etag = catalog.snapshot().etag("types", "Any")
+        response = self.client.get(url, {"empty": "Any", "v": etag})
+        self.assertIn("max-age=31536000", response["Cache-Control"])
+
+        response = self.client.get(
+            reverse("animal:choices", kwargs={"name": "unknown"}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_empty_labels_are_not_cached(self):
+        snapshot = catalog.snapshot()
+        url = reverse("animal:choices", kwargs={"name": "activity_choices"})
+        for number in range(10):
+            self.client.get(url, {"empty": str(number)})
+        self.assertEqual(list(snapshot._payloads), ["activity_choices"])
+        self.assertEqual(list(snapshot._etags), ["activity_choices"])
+
+
+class TypeActivitiesPayloadTest(CatalogTestMixin, TestCase):
+
+    def url(self, animal_type):
+        return reverse(
+            "animal:type_activities", kwargs={"animal_type": animal_type})
+
+    def test_view(self):
+        response = self.client.get(self.url("dog"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [choice["label"] for choice in json.loads(
+                response.content.decode("utf-8"))],
+            ["Barking", "Walking"])
+        self.assertIn("no-cache", response["Cache-Control"])
+        etag = response["ETag"]
+
+        response = self.client.get(self.url("dog"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # Each type has its own ETag
+        response = self.client.get(self.url("cat"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(
+            self.url("dog"), {"v": catalog.snapshot().activities_tag})
+        self.assertIn("max-age=31536000", response["Cache-Control"])
+
+    def test_activity_change(self):
+        etag = self.client.get(self.url("dog"))["ETag"]
+        Activity.objects.create(label="Fetching", animal_type_id="dog")
+        response = self.client.get(self.url("dog"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            {"value": Activity.objects.get(label="Fetching").pk,
+             "label": "Fetching"},
+            json.loads(response.content.decode("utf-8")))
+
+    def test_unknown_type(self):
+        response = self.client.get(self.url("fish"))
+        self.assertEqual(response.status_code, 404)
+
+        # A new type without activities
+        AnimalType.objects.create(code="fish", label="Fish")
+        response = self.client.get(self.url("fish"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf-8")), [])
+
+
+class IndexedChoicesTest(CatalogTestMixin, TestCase):
+
+    def test_choices(self):
+        calls = []
+
+        def get_choices():
+            calls.append(1)
+            return [(1, "One"), ("Group", [(2, "Two"), (3, "Three")])]
+        choices = IndexedChoices(get_choices, empty_label="None")
+        self.assertIn("", choices)
+        self.assertIn(1, choices)
+        self.assertIn("3", choices)
+        self.assertNotIn("4", choices)
+        self.assertEqual(list(choices)[:2], [("", "None"), (1, "One")])
+        self.assertEqual(len(calls), 1)
+        self.assertNotIn("", IndexedChoices([(1, "One")]))
+
+    def test_field(self):
+        field = IndexedChoiceField(choices=[("a", "A"), ("b", "B")])
+        self.assertIsInstance(field.choices, IndexedChoices)
+        self.assertEqual(field.clean("b"), "b")
+        with self.assertRaises(ValidationError):
+            field.clean("c")
+
+    def test_field_rejects_callables(self):
+        def get_choices():
+            return [("a", "A")]
+        with self.assertRaises(TypeError):
+            IndexedChoiceField(choices=get_choices)
+        field = IndexedChoiceField()
+        with self.assertRaises(TypeError):
+            field.choices = get_choices
+
+    def test_activities_of_posted_type(self):
+        snapshot = catalog.snapshot()
+        dog_activities = [
+            str(pk) for pk, label in snapshot.activity_choices_for_type("dog")]
+        cat_activity = Activity.objects.get(label="Purring")
+
+        form = DynamicRequired3(data={
+            "name": "Rex", "type": "dog",
+            "favorite_activity": dog_activities[0],
+            "activities": dog_activities})
+        self.assertTrue(form.is_valid(), form.errors)
+
+        form = DynamicRequired3(data={
+            "name": "Rex", "type": "dog",
+            "favorite_activity": dog_activities[0],
+            "activities": [str(cat_activity.pk)]})
+        self.assertEqual(list(form.errors), ["activities"])
+
+    def test_unknown_type_is_not_cached(self):
+        snapshot = catalog.snapshot()
+        DynamicRequired3(data={"type": "cat"})
+        sources = len(snapshot._sources)
+        for number in range(5):
+            form = DynamicRequired3(data={"type": "unknown%d" % number})
+            self.assertIn("type", form.errors)
+        self.assertEqual(len(snapshot._sources), sources)
+
+
+class DisplayColumnsTest(CatalogTestMixin, TestCase):
+
+    def test_columns_follow_changes(self):
+        walking = Activity.objects.get(label="Walking")
+        barking = Activity.objects.get(label="Barking")
+        animal = Animal.objects.create(
+            name="Rex", age=3, type_id="dog", favorite_activity=walking)
+        animal.activities.add(walking, barking)
+        animal.refresh_from_db()
+        self.assertEqual(animal.activity_count, 2)
+        self.assertEqual(
+            animal.display_label,
+            "Dog: Rex of age 3. Favorite: Walking (2 activities)")
+
+        walking.label = "Running"
+        walking.save()
+        animal.refresh_from_db()
+        self.assertEqual(
+            animal.display_label,
+            "Dog: Rex of age 3. Favorite: Running (2 activities)")
+
+    def test_rendering_uses_one_query(self):
+        walking = Activity.objects.get(label="Walking")
+        for number in range(5):
+            animal = Animal.objects.create(
+                name="Rex %d" % number, type_id="dog",
+                favorite_activity=walking)
+            animal.activities.add(walking)
+        with self.assertNumQueries(1):
+            html = render_animals(None)
+        self.assertIn("Dog: Rex 4 of age None", html)
+
+
+class BulkCreateTest(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("animal:animal_bulk_create")
+        self.walking = Activity.objects.get(label="Walking")
+        self.barking = Activity.objects.get(label="Barking")
+        self.purring = Activity.objects.get(label="Purring")
+
+    def post_json(self, rows):
+        return self.client.post(
+            self.url, json.dumps(rows), content_type="application/json")
+
+    def test_create_animals(self):
+        Animal.objects.create(
+            name="Existing", type_id="dog", favorite_activity=self.walking)
+        rows = [
+            AnimalRow("Rex", 3, "dog", self.walking.pk,
+                      [self.walking.pk, self.barking.pk, self.walking.pk]),
+            AnimalRow("Tom", 1, "cat", self.purring.pk, [], "tiger"),
+        ]
+        catalog.snapshot()
+        # Savepoint, animals, their pks, through rows, release
+        with self.assertNumQueries(6):
+            pks = create_animals(rows)
+        animals = Animal.objects.in_bulk(pks)
+        self.assertEqual([animals[pk].name for pk in pks], ["Rex", "Tom"])
+        rex = animals[pks[0]]
+        self.assertEqual(
+            set(rex.activities.values_list("pk", flat=True)),
+            {self.walking.pk, self.barking.pk})
+        self.assertEqual(rex.activity_count, 2)
+        self.assertEqual(rex.display_label, str(
+            Animal.objects.for_display().get(pk=rex.pk)))
+        self.assertEqual(animals[pks[1]].internal_notes, "tiger")
+        self.assertEqual(create_animals([]), [])
+
+    def test_create_animals_one_by_one(self):
+        # Backends where the pks of a bulk_create are unknown, e.g., MySQL
+        rows = [
+            AnimalRow("Rex", 7, "dog", self.walking.pk,
+                      [self.walking.pk, self.barking.pk, self.walking.pk]),
+            AnimalRow("Tom", 12, "cat", self.purring.pk, [], "tiger"),
+        ]
+        with mock.patch(
+                "animal.bulk._bulk_create_returns_pks", return_value=False):
+            pks = create_animals(rows)
+        self.assertEqual(
+            list(Animal.objects.order_by("pk").values_list("pk", flat=True)),
+            pks)
+        for pk, animal in zip(pks, Animal.objects.for_display().order_by(
+                "pk")):
+            self.assertEqual(animal.pk, pk)
+            self.assertEqual(animal.display_label, str(animal))
+            self.assertEqual(animal.activity_count, animal.num_activities)
+        animals = Animal.objects.in_bulk(pks)
+        self.assertEqual(
+            [animals[pk].activity_count for pk in pks], [2, 0])
+
+    def test_json(self):
+        response = self.post_json([
+            {"name": "Rex", "type": "dog",
+             "favorite_activity": self.walking.pk,
+             "activities": [self.walking.pk, self.barking.pk]},
+            {"name": "Tom", "type": "cat", "age": 7,
+             "favorite_activity": self.purring.pk,
+             "activities": [self.purring.pk]},
+        ])
+        self.assertEqual(response.status_code, 201)
+        pks = json.loads(response.content.decode("utf-8"))["created"]
+        self.assertEqual(
+            list(Animal.objects.filter(pk__in=pks).order_by("pk")
+                 .values_list("name", "age")),
+            [("Rex", None), ("Tom", 7)])
+
+    def test_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        body = json.dumps([
+            {"name": "Rex", "type": "dog", "age": 12,
+             "favorite_activity": self.walking.pk,
+             "activities": [self.walking.pk]}])
+        response = client.post(
+            self.url, body, content_type="application/json")
+        self.assertEqual(response.status_code, 403)
+
+        # The token of the cookie set by a page, sent back in the header
+        client.get(reverse("animal:home"))
+        token = client.cookies["csrftoken"].value
+        response = client.post(
+            self.url, body, content_type="application/json",
+            HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            list(Animal.objects.values_list("name", "age")), [("Rex", 12)])
+
+    def test_json_errors(self):
+        response = self.post_json([
+            {"name": "Rex", "type": "dog",
+             "favorite_activity": self.walking.pk,
+             "activities": [self.walking.pk]},
+            # Cats need an age, and cat activities
+            {"name": "Tom", "type": "cat",
+             "favorite_activity": self.purring.pk,
+             "activities": [self.walking.pk]},
+            {"name": "Nobody", "type": "dog",
+             "activities": [self.walking.pk]},
+        ])
+        self.assertEqual(response.status_code, 400)
+        errors = json.loads(response.content.decode("utf-8"))["errors"]
+        self.assertEqual(
+            [(error["row"], sorted(error["errors"])) for error in errors],
+            [(1, ["activities", "age"]), (2, ["favorite_activity"])])
+        self.assertFalse(Animal.objects.exists())
+
+        for body in ["{", "{}", "[1]"]:
+            response = self.client.post(
+                self.url, body, content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+
+    def form_data(self, total, rows):
+        data = {
+            "form-TOTAL_FORMS": str(total),
+            "form-INITIAL_FORMS": "0",
+        }
+        for index, row in enumerate(rows):
+            for key, value in row.items():
+                data["form-%d-%s" % (index, key)] = value
+        return data
+
+    def test_formset(self):
+        response = self.client.post(self.url, self.form_data(2, [{
+            "name": "Rex", "type": "dog", "age": "7",
+            "favorite_activity": str(self.walking.pk),
+            "activities": [str(self.walking.pk)],
+        }]))
+        # The blank extra form is skipped
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            list(Animal.objects.values_list("name", "age")), [("Rex", 7)])
+
+    def test_formset_errors(self):
+        response = self.client.post(self.url, {"form-0-name": "Rex"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("error", json.loads(response.content.decode("utf-8")))
+
+        response = self.client.post(self.url, self.form_data(1, [{
+            "name": "Rex", "type": "dog",
+            "activities": [str(self.walking.pk)],
+        }]))
+        self.assertEqual(response.status_code, 400)
+        errors = json.loads(response.content.decode("utf-8"))["errors"]
+        self.assertEqual(list(errors[0]["errors"]), ["favorite_activity"])
+        self.assertFalse(Animal.objects.exists())
+
+
+class MaterializeModelsTest(TestCase):
+
+    def setUp(self):
+        self.activities = list(Activity.objects.order_by("-pk")[:3])
+
+    def test_stubs_from_form_data(self):
+        stubs = [Activity(pk=str(activity.pk)) for activity in self.activities]
+        with self.assertNumQueries(1):
+            materialized = materialize_models(stubs)
+        self.assertEqual(materialized, self.activities)
+        self.assertTrue(all(
+            activity._state.db for activity in materialized))
+        self.assertEqual(
+            [activity.label for activity in materialized],
+            [activity.label for activity in self.activities])
+
+    def test_fetched_models_are_kept(self):
+        stub = Activity(pk=self.activities[1].pk)
+        models = [self.activities[0], stub, self.activities[2]]
+        materialized = materialize_models(models)
+        self.assertIs(materialized[0], self.activities[0])
+        self.assertIs(materialized[2], self.activities[2])
+        self.assertEqual(materialized[1].label, self.activities[1].label)
+
+        with self.assertNumQueries(0):
+            self.assertIs(materialize_models(self.activities),
+                          self.activities)
+
+    def test_identity_map(self):
+        identity_map = {}
+        stubs = [Activity(pk=activity.pk) for activity in self.activities]
+        first = materialize_models(stubs[:2], identity_map)
+        with self.assertNumQueries(1):
+            second = materialize_models(stubs, identity_map)
+        self.assertIs(second[0], first[0])
+        self.assertEqual(len(identity_map), 3)
+
+    def test_missing_models(self):
+        stubs = [Activity(pk=self.activities[0].pk), Activity(pk="999999")]
+        with self.assertRaisesMessage(
+                Activity.DoesNotExist, "Activity with pks [999999]"):
+            materialize_models(stubs)
+        with self.assertRaises(ValidationError):
+            materialize_models([Activity(pk="x")])
+
+
+class LoaderTest(TestCase):
+
+    def setUp(self):
+        self.activities = list(Activity.objects.order_by("pk"))
+
+    def test_batching(self):
+        loader = Loader()
+        loader.prime(Activity, [self.activities[0].pk, "x"])
+        loader.prime(Activity, [str(self.activities[1].pk)])
+        with self.assertNumQueries(1):
+            first = loader.load(Activity, self.activities[0].pk)
+            second = loader.load(Activity, str(self.activities[1].pk))
+        self.assertEqual(first, self.activities[0])
+        self.assertEqual(second, self.activities[1])
+
+        with self.assertNumQueries(0):
+            self.assertIs(loader.load(Activity, self.activities[0].pk), first)
+
+    def test_load_many(self):
+        loader = Loader()
+        pks = [self.activities[2].pk, 999999, self.activities[0].pk]
+        with self.assertNumQueries(1):
+            instances = loader.load_many(Activity, pks)
+        self.assertEqual(
+            instances, [self.activities[2], None, self.activities[0]])
+        # Missing pks are remembered too
+        with self.assertNumQueries(0):
+            self.assertIsNone(loader.load(Activity, 999999))
+        with self.assertRaises(ValidationError):
+            loader.load(Activity, "x")
+
+    def test_form(self):
+        walking = Activity.objects.get(label="Walking")
+        barking = Activity.objects.get(label="Barking")
+        activate(Loader())
+        try:
+            form = Form1(data={
+                "name": "Rex", "type": "dog",
+                "favorite_activity": str(walking.pk),
+                "activities": [str(walking.pk), str(barking.pk)]})
+            # One query per model
+            with self.assertNumQueries(2):
+                self.assertTrue(form.is_valid(), form.errors)
+            favorite = form.cleaned_data["favorite_activity"]
+            self.assertIn(
+                id(favorite), map(id, form.cleaned_data["activities"]))
+
+            form = Form1(data={
+                "name": "Rex", "type": "dog",
+                "favorite_activity": "999999", "activities": ["x"]})
+            self.assertEqual(
+                sorted(form.errors), ["activities", "favorite_activity"])
+        finally:
+            deactivate()
+
+
+class ExportTest(CatalogTestMixin, TestCase):
+
+    def test_empty(self):
+        self.assertEqual(
+            "".join(iter_csv(export_chunks())),
+            "id,name,age,type,favorite_activity,activities,"
+            "internal_notes\r\n")
+        self.assertEqual("".join(iter_ndjson(export_chunks())), "")
+
+    def test_round_trip(self):
+        purring = Activity.objects.get(label="Purring")
+        napping = Activity.objects.get(label="Napping")
+        walking = Activity.objects.get(label="Walking")
+        barking = Activity.objects.get(label="Barking")
+        exported_rows = [
+            AnimalRow("Tom", 7, "cat", purring.pk, [purring.pk, napping.pk],
+                      "tiger, \"striped\""),
+            # Activities in the order of the export: by pk
+            AnimalRow("Rex", 13, "dog", walking.pk,
+                      sorted([walking.pk, barking.pk])),
+            AnimalRow("Kit", None, "dog", barking.pk, [barking.pk]),
+        ]
+        create_animals(exported_rows)
+        text = "".join(iter_csv(export_chunks(chunk_size=2)))
+        self.assertEqual(len(text.splitlines()), 4)
+
+        rows = validate_rows(enumerate(read_csv(io.StringIO(text))))
+        self.assertEqual([errors for _, _, errors in rows], [None] * 3)
+        imported_rows = [
+            # Lazy activities keep the pks as posted
+            row._replace(activity_ids=[int(pk) for pk in row.activity_ids])
+            for _, row, _ in rows]
+        self.assertEqual(imported_rows, exported_rows)
+
+        # Imported again, the animals are exported the same way
+        Animal.objects.all().delete()
+        create_animals(imported_rows)
+        self.assertEqual(
+            [line.split(",", 1)[1] for line in "".join(
+                iter_csv(export_chunks())).splitlines()],
+            [line.split(",", 1)[1] for line in text.splitlines()])
+
+        lines = "".join(iter_ndjson(export_chunks())).splitlines()
+        self.assertEqual(
+            [(animal["name"], animal["age"], animal["internal_notes"])
+             for animal in map(json.loads, lines)],
+            [("Tom", 7, 'tiger, "striped"'), ("Rex", 13, ""),
+             ("Kit", None, "")])
+
+
+class ImportAnimalsTest(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "animals.csv")
+        self.checkpoint = os.path.join(self.directory, "checkpoint")
+        purring = Activity.objects.get(label="Purring")
+        walking = Activity.objects.get(label="Walking")
+        with open(self.path, "w", newline="", encoding="utf-8") as stream:
+            stream.write(
+                "name,age,type,favorite_activity,activities,internal_notes\n")
+            for number in range(1, 8):
+                stream.write("Tom {0},{0},cat,{1},{1},\n".format(
+                    number, purring.pk))
+            # Cats need an age
+            stream.write("Ageless,,cat,{0},{0},\n".format(purring.pk))
+            stream.write("Rex,12,dog,{0},{0},good\n".format(walking.pk))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def import_animals(self, **options):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command(
+            "import_animals", self.path, batch_size=2,
+            checkpoint=self.checkpoint, stdout=stdout, stderr=stderr,
+            **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_workers(self):
+        stdout, stderr = self.import_animals(workers=2)
+        self.assertIn("Imported 8 animals, 1 invalid rows", stdout)
+        self.assertIn("Row 8: ", stderr)
+        self.assertEqual(
+            list(Animal.objects.order_by("pk").values_list("name", "age")),
+            [("Tom %d" % number, number) for number in range(1, 8)] +
+            [("Rex", 12)])
+        with open(self.checkpoint) as checkpoint:
+            self.assertEqual(checkpoint.read(), "9")
+
+    def test_resume(self):
+        with open(self.checkpoint, "w") as checkpoint:
+            checkpoint.write("6")
+        stdout, stderr = self.import_animals(workers=0)
+        self.assertIn("Imported 2 animals, 1 invalid rows", stdout)
+        self.assertEqual(
+            list(Animal.objects.order_by("pk").values_list("name", "age")),
+            [("Tom 7", 7), ("Rex", 12)])
+
+        # Everything was handled
+        stdout, stderr = self.import_animals(workers=0)
+        self.assertIn("Imported 0 animals, 0 invalid rows", stdout)
+        self.assertEqual(Animal.objects.count(), 2)
+
+
+class GenerateAnimalsTest(CatalogTestMixin, TestCase):
+
+    def generate(self, seed):
+        call_command(
+            "generate_animals", types=3, activities_per_type=4, animals=30,
+            seed=seed, batch_size=8, interactive=False,
+            stdout=io.StringIO())
+        return "".join(iter_csv(export_chunks()))
+
+    def test_seed(self):
+        text = self.generate(seed=7)
+        self.assertEqual(len(text.splitlines()), 31)
+        self.assertEqual(
+            list(AnimalType.objects.order_by("code").values_list(
+                "code", flat=True)),
+            ["cat", "dog", "type2"])
+        self.assertEqual(Activity.objects.count(), 12)
+        self.assertEqual(self.generate(seed=7), text)
+        self.assertNotEqual(self.generate(seed=8), text)
+
+    def test_valid_rows(self):
+        text = self.generate(seed=0)
+        rows = validate_rows(enumerate(read_csv(io.StringIO(text))))
+        self.assertEqual(
+            [(number, errors) for number, _, errors in rows if errors], [])
+        self.assertEqual(len(rows), 30)
+        # The display columns are the ones the signals would compute
+        for animal in Animal.objects.for_display():
+            self.assertEqual(animal.display_label, str(animal))
+
+
+class CopyCountingInput(forms.TextInput):
+    """A widget with its own deep copy."""
+
+    copies = 0
+
+    def __deepcopy__(self, memo):
+        CopyCountingInput.copies += 1
+        return super().__deepcopy__(memo)
+
+
+class CustomWidgetForm(PrototypeFormMixin, forms.Form):
+    name = forms.CharField(widget=CopyCountingInput)
+    age = forms.IntegerField(required=False)
+
+
+class PrototypeFormTest(CatalogTestMixin, TestCase):
+
+    def test_instance_changes_do_not_leak(self):
+        cat_form = DynamicRequired2(data={"type": "cat"})
+        self.assertTrue(cat_form.fields["age"].required)
+        cat_form.fields["name"].widget.attrs["class"] = "cat"
+        cat_form.fields["name"].validators.append(lambda value: None)
+
+        prototypes = DynamicRequired2.base_fields
+        self.assertIsInstance(prototypes, FieldPrototypes)
+        self.assertFalse(prototypes["age"].required)
+        self.assertNotIn("class", prototypes["name"].widget.attrs)
+        # Set on each instance by setup_fields
+        self.assertEqual(
+            cat_form.fields["type"].empty_label, "Select Animal Type")
+        self.assertNotEqual(
+            prototypes["type"].empty_label, "Select Animal Type")
+
+        for data in (None, {"type": "dog"}):
+            form = DynamicRequired2(data=data)
+            self.assertFalse(form.fields["age"].required)
+            self.assertNotIn("class", form.fields["name"].widget.attrs)
+            self.assertEqual(
+                len(form.fields["name"].validators),
+                len(prototypes["name"].validators))
+
+    def test_custom_deepcopy(self):
+        CopyCountingInput.copies = 0
+        first, second = CustomWidgetForm(), CustomWidgetForm()
+        # The field with the widget is deep copied, the other one is not
+        self.assertEqual(CopyCountingInput.copies, 2)
+        self.assertIsNot(
+            first.fields["name"].widget, second.fields["name"].widget)
+        first.fields["name"].widget.attrs["class"] = "first"
+        self.assertEqual(second.fields["name"].widget.attrs, {})
+        self.assertEqual(
+            CustomWidgetForm.base_fields["name"].widget.attrs, {})
+        self.assertTrue(CustomWidgetForm(data={"name": "Rex"}).is_valid())
+
+
+class DictValidatorTest(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        walking = Activity.objects.get(label="Walking")
+        purring = Activity.objects.get(label="Purring")
+        self.datas = [
+            {},
+            {"name": "Rex", "type": "dog", "favorite_activity": walking.pk,
+             "activities": [str(walking.pk)]},
+            {"name": "Tom", "type": "cat", "favorite_activity": walking.pk,
+             "activities": [str(purring.pk), "x"]},
+            {"name": "Tom", "type": ["cat"], "age": "7"},
+        ]
+
+    def test_same_as_form(self):
+        for form_class in (
+                Form1, DynamicRequired3, DynamicRequired4, AnimalImportForm):
+            validate = dict_validator(form_class)
+            for data in self.datas:
+                form = form_class(data=data)
+                form.is_valid()
+                cleaned_data, errors = validate(data)
+                self.assertEqual(errors, form.errors, (form_class, data))
+                if not errors:
+                    self.assertEqual(cleaned_data, form.cleaned_data)
+
+    def test_separate_forms(self):
+        validate = dict_validator(DynamicRequired4)
+        cleaned_data, errors = validate(self.datas[1])
+        self.assertEqual(errors, {})
+        # Another validation does not share the state of the first one
+        other_data, other_errors = validate(self.datas[2])
+        self.assertEqual(list(other_errors), ["activities"])
+        self.assertEqual(cleaned_data["name"], "Rex")
+        self.assertEqual(errors, {})
+
+
+class MetricsTest(TestCase):
+
+    def get(self, **headers):
+        return self.client.get(reverse("animal:metrics"), **headers)
+
+    @override_settings(ANIMAL_METRICS_TOKEN="", INTERNAL_IPS=[])
+    def test_denied(self):
+        self.assertEqual(self.get().status_code, 403)
+        self.assertEqual(
+            self.get(HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+
+    @override_settings(INTERNAL_IPS=["127.0.0.1"])
+    def test_internal_ip(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+    @override_settings(ANIMAL_METRICS_TOKEN="secret", INTERNAL_IPS=[])
+    def test_token(self):
+        self.assertEqual(
+            self.get(HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+        self.assertEqual(
+            self.get(HTTP_AUTHORIZATION="Bearer other").status_code, 403)
+
+
+class ProfiledForm(DynamicRequired4):
+    profile_sample_rate = 1.0
+
+    def clean_name(self):
+        return self.cleaned_data["name"].upper()
+
+
+class ProfilingFormTest(CatalogTestMixin, TestCase):
+
+    def test_steps(self):
+        walking = Activity.objects.get(label="Walking")
+        form = ProfiledForm(data={
+            "name": "Rex", "type": "dog", "favorite_activity": walking.pk,
+            "activities": [str(walking.pk)]})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data["name"], "REX")
+        steps = form.profile.as_dict()
+        for name in form.fields:
+            self.assertIn("field:%s" % name, steps)
+        self.assertIn("clean_name", steps)
+        self.assertIn("clean", steps)
+        # The wrappers are removed after validation
+        for field in form.fields.values():
+            self.assertNotIn("clean", vars(field))
+        self.assertNotIn("clean_name", vars(form))
+
+    def test_not_sampled(self):
+        form = DynamicRequired4(data={})
+        self.assertFalse(form.is_valid())
+        self.assertIsNone(form.profile)
+
+
+class FragmentCacheTest(TestCase):
+
+    def setUp(self):
+        self.renders = 0
+
+    def render(self):
+        self.renders += 1
+        return "<p>%d</p>" % self.renders
+
+    def get(self, cache):
+        return cache.get_or_render(
+            "test", (AnimalType,), (1,), self.render)
+
+    def test_versions(self):
+        cache = FragmentCache()
+        self.assertEqual(self.get(cache), "<p>1</p>")
+        self.assertEqual(self.get(cache), "<p>1</p>")
+        versions.bump(AnimalType)
+        self.assertEqual(self.get(cache), "<p>2</p>")
+
+    def test_max_age(self):
+        cache = FragmentCache(max_age=10)
+        with mock.patch("animal.fragments.time.time", return_value=100.0):
+            self.get(cache)
+        with mock.patch("animal.fragments.time.time", return_value=109.0):
+            self.assertEqual(self.get(cache), "<p>1</p>")
+        with mock.patch("animal.fragments.time.time", return_value=110.0):
+            self.assertEqual(self.get(cache), "<p>2</p>")
+
+        cache = FragmentCache(max_age=None)
+        with mock.patch("animal.fragments.time.time", return_value=100.0):
+            self.get(cache)
+        with mock.patch("animal.fragments.time.time", return_value=1e9):
+            self.assertEqual(self.get(cache), "<p>3</p>")
+
+    def test_backend(self):
+        cache = FragmentCache(max_age=10, backend="default")
+        with mock.patch("animal.fragments.time.time", return_value=100.0):
+            self.get(cache)
+            cache.clear()
+            self.assertEqual(self.get(cache), "<p>1</p>")
+        cache.clear()
+        # Expired in the backend too
+        with mock.patch("animal.fragments.time.time", return_value=110.0):
+            self.assertEqual(self.get(cache), "<p>2</p>")
+
+
+class EditingTest(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.purring, self.eating, self.napping = [
+            Activity.objects.get(label=label)
+            for label in ("Purring", "Eating", "Napping")]
+        self.pk = create_animals([AnimalRow(
+            "Tom", 2, "cat", self.purring.pk,
+            [self.purring.pk, self.eating.pk])])[0]
+
+    def activity_pks(self):
+        return set(Animal.objects.get(pk=self.pk).activities.values_list(
+            "pk", flat=True))
+
+    def test_update_activities(self):
+        added, removed = update_activities(
+            self.pk, [self.napping.pk, self.purring.pk, self.napping.pk])
+        self.assertEqual(added, [self.napping.pk])
+        self.assertEqual(removed, [self.eating.pk])
+        self.assertEqual(
+            self.activity_pks(), {self.purring.pk, self.napping.pk})
+
+        # Nothing to write
+        with self.assertNumQueries(0):
+            self.assertEqual(update_activities(
+                self.pk, [self.purring.pk], [self.purring.pk]), ([], []))
+
+    def test_update_animal(self):
+        catalog.snapshot()
+        row = AnimalRow("Tim", 1, "cat", self.napping.pk, [self.napping.pk])
+        self.assertEqual(update_animal(self.pk, 0, row), 1)
+        animal = Animal.objects.get(pk=self.pk)
+        self.assertEqual(
+            (animal.name, animal.version, animal.activity_count),
+            ("Tim", 1, 1))
+        self.assertEqual(animal.display_label, str(animal))
+        self.assertEqual(self.activity_pks(), {self.napping.pk})
+
+        with self.assertRaises(ConcurrentUpdate):
+            update_animal(self.pk, 0, row._replace(name="Old"))
+        self.assertEqual(Animal.objects.get(pk=self.pk).name, "Tim")
+
+    def test_model_form(self):
+        data = {
+            "name": "Tim", "age": "1", "type": "cat",
+            "favorite_activity": str(self.napping.pk),
+            "activities": [str(self.napping.pk)]}
+        animal = Animal.objects.get(pk=self.pk)
+        Animal.objects.filter(pk=self.pk).update(version=5)
+        form = DynamicRequired3(data=data, instance=animal)
+        self.assertTrue(form.is_valid(), form.errors)
+        with self.assertRaises(ConcurrentUpdate):
+            form.save()
+        self.assertEqual(Animal.objects.get(pk=self.pk).name, "Tom")
+
+        animal = Animal.objects.get(pk=self.pk)
+        form = DynamicRequired3(data=data, instance=animal)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        animal = Animal.objects.get(pk=self.pk)
+        self.assertEqual((animal.name, animal.version), ("Tim", 6))
+        self.assertEqual(self.activity_pks(), {self.napping.pk})
+
+
+class DynamicRequired4SaveTest(CatalogTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.walking = Activity.objects.get(label="Walking")
+        self.barking = Activity.objects.get(label="Barking")
+        self.purring = Activity.objects.get(label="Purring")
+
+    def save(self, data):
+        form = DynamicRequired4(data=data)
+        self.assertTrue(form.is_valid(), form.errors)
+        catalog.snapshot()
+        # Savepoint, animal, its pk, through rows, release
+        with self.assertNumQueries(5):
+            pk = form.save_instance()
+        return Animal.objects.for_display().get(pk=pk)
+
+    def test_create(self):
+        animal = self.save({
+            "name": "Rex", "age": "7", "type": "dog",
+            "favorite_activity": str(self.walking.pk),
+            "activities": [str(self.walking.pk), str(self.barking.pk)],
+        })
+        self.assertEqual(
+            (animal.name, animal.age, animal.type_id, animal.version),
+            ("Rex", 7, "dog", 0))
+        self.assertEqual(animal.favorite_activity, self.walking)
+        self.assertEqual(
+            set(animal.activities.values_list("pk", flat=True)),
+            {self.walking.pk, self.barking.pk})
+        self.assertEqual(animal.activity_count, 2)
+        self.assertEqual(animal.display_label, str(animal))
+
+    def test_create_tiger(self):
+        animal = self.save({
+            "name": "Shere Khan", "type": "tiger",
+            "favorite_activity": str(self.purring.pk),
+            "activities": [str(self.purring.pk), str(self.purring.pk)],
+        })
+        self.assertEqual(
+            (animal.type_id, animal.internal_notes, animal.activity_count),
+            ("cat", "tiger", 1))
+        self.assertEqual(animal.display_label, str(animal))
+
+
+class LabelIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = LabelIndex([
+            (1, "Swimming in the lake", "dog"),
+            (2, "Swinging", "cat"),
+            (3, "Lake walk", "dog"),
+            (4, "Sleeping", "cat"),
+        ])
+
+    def test_search(self):
+        self.assertEqual(
+            self.index.search("sw lak"),
+            ([(1, "Swimming in the lake")], False))
+        self.assertEqual(
+            self.index.search("SW"),
+            ([(1, "Swimming in the lake"), (2, "Swinging")], False))
+        self.assertEqual(self.index.search("sw", group="cat"),
+                         ([(2, "Swinging")], False))
+        self.assertEqual(self.index.search("sw", group="bird"), ([], False))
+        self.assertEqual(self.index.search("xyz"), ([], False))
+
+    def test_pages(self):
+        self.assertEqual(
+            self.index.search("", limit=2),
+            ([(3, "Lake walk"), (4, "Sleeping")], True))
+        self.assertEqual(
+            self.index.search("", offset=2, limit=2),
+            ([(1, "Swimming in the lake"), (2, "Swinging")], False))
+
+    def test_broad_query(self):
+        with mock.patch("animal.search.BROAD_QUERY", 0):
+            self.assertEqual(
+                self.index.search("s", group="cat", limit=1),
+                ([(4, "Sleeping")], True))
+
+
+class ActivitySearchTest(CatalogTestMixin, TestCase):
+
+    def search(self, **params):
+        return self.client.get(reverse("animal:activity_search"), params)
+
+    def test_search(self):
+        response = self.search(q="pl", type="cat")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            "results": [{
+                "value": Activity.objects.get(label="Playing").pk,
+                "label": "Playing"}],
+            "next_offset": None})
+
+        data = self.search(limit=2).json()
+        self.assertEqual(len(data["results"]), 2)
+        self.assertEqual(data["next_offset"], 2)
+        data = self.search(offset=6, limit=2).json()
+        self.assertEqual(len(data["results"]), 1)
+        self.assertIsNone(data["next_offset"])
+
+    def test_errors(self):
+        self.assertEqual(self.search(type="tiger").status_code, 400)
+        self.assertEqual(self.search(limit="x").status_code, 400)
+
+    def test_widget(self):
+        walking = Activity.objects.get(label="Walking")
+        html = str(DynamicRequired4(
+            initial={"favorite_activity": walking.pk})["favorite_activity"])
+        self.assertIn('data-type-field="id_type"', html)
+        # Only the empty and the selected options are rendered
+        self.assertEqual(html.count("<option"), 2)
+        self.assertIn(">Walking</option>", html)
+
+
+class CompactCatalogTest(TestCase):
+
+    def setUp(self):
+        self.compact = CompactCatalog(pack(
+            [("cat", "Cat"), ("dog", "Dog")],
+            [(5, "Eating", "cat"), (2, "Barking", "dog"),
+             (3, "Eating", "dog")]))
+
+    def test_read(self):
+        compact = self.compact
+        self.assertEqual(compact.types, [("cat", "Cat"), ("dog", "Dog")])
+        self.assertEqual(list(compact.pks), [2, 3, 5])
+        number = compact.find(5)
+        self.assertEqual(
+            (compact.label(number), compact.type_code(number)),
+            ("Eating", "cat"))
+        self.assertEqual(compact.find(4), -1)
+        self.assertEqual(
+            list(compact.entries(compact.of_type("dog"))),
+            [(2, "Barking", "dog"), (3, "Eating", "dog")])
+        self.assertIsNone(compact.of_type("bird"))
+
+    def test_lookups(self):
+        index = ActivityIndex(self.compact)
+        self.assertEqual(index[3], ("Eating", "dog"))
+        self.assertNotIn("3", index)
+        keys = ActivityKeys(self.compact, "dog")
+        self.assertIn("3", keys)
+        self.assertNotIn("03", keys)
+        self.assertNotIn("5", keys)
+
+    def test_invalid(self):
+        data = pack([("cat", "Cat")], [(1, "Eating", "cat")])
+        for buffer in (b"", b"garbage" * 20, data[:-4]):
+            with self.assertRaises(ValueError):
+                CompactCatalog(buffer)
+
+
+class SharedCatalogTest(CatalogTestMixin, TransactionTestCase):
+    serialized_rollback = True
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        catalog.configure({"DIRECTORY": self.directory, "CHECK_INTERVAL": 0})
+
+    def tearDown(self):
+        catalog.configure({})
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def read_file(self):
+        with open(catalog.path(), "rb") as file:
+            return CompactCatalog(file.read())
+
+    def test_publish_once_per_transaction(self):
+        count = len(catalog.snapshot().activities)
+        with mock.patch.object(
+                catalog, "publish", wraps=catalog.publish) as publish:
+            with transaction.atomic():
+                for label in ("Running", "Digging", "Sleeping"):
+                    Activity.objects.create(label=label, animal_type_id="dog")
+            self.assertEqual(publish.call_count, 1)
+        self.assertEqual(len(self.read_file()), count + 3)
+        self.assertEqual(len(catalog.snapshot().activities), count + 3)
+
+    def test_matching_file_is_mapped(self):
+        count = len(catalog.snapshot().activities)
+        catalog.clear()
+        # The fingerprint queries only
+        with self.assertNumQueries(2):
+            self.assertEqual(len(catalog.snapshot().activities), count)
+
+    def test_stale_file_is_replaced(self):
+        count = len(catalog.snapshot().activities)
+        # Not published: bulk_create sends no signal
+        Activity.objects.bulk_create([
+            Activity(label="Running", animal_type_id="dog")])
+        catalog.clear()
+        self.assertEqual(len(catalog.snapshot().activities), count + 1)
+        self.assertEqual(len(self.read_file()), count + 1)
+
+
+class CatalogRefreshTest(CatalogTestMixin, TestCase):
+    """Writes made by another process do not bump the versions of this one:
+    bulk_create and update() send no signal either.
+    """
+
+    def snapshot(self, now):
+        with mock.patch("animal.catalog.time.monotonic", return_value=now):
+            return catalog.snapshot()
+
+    def test_fingerprint(self):
+        snapshot = self.snapshot(100.0)
+        version = versions.get(Activity)
+        Activity.objects.bulk_create([
+            Activity(label="Running", animal_type_id="dog")])
+        with self.assertNumQueries(0):
+            self.assertIs(self.snapshot(100.5), snapshot)
+
+        snapshot = self.snapshot(101.0)
+        self.assertIn("Running", [
+            label for _, label, _ in snapshot.activities])
+        self.assertNotEqual(versions.get(Activity), version)
+
+    def test_max_age(self):
+        snapshot = self.snapshot(100.0)
+        version = versions.get(Activity)
+        # Same fingerprint: the check of the tables only
+        with self.assertNumQueries(2):
+            self.assertIs(self.snapshot(101.0), snapshot)
+        # Nothing changed
+        self.assertIs(self.snapshot(160.0), snapshot)
+        self.assertEqual(versions.get(Activity), version)
+
+        Activity.objects.filter(label="Walking").update(label="Strolling")
+        self.assertIs(self.snapshot(180.0), snapshot)
+        snapshot = self.snapshot(221.0)
+        self.assertIn("Strolling", [
+            label for _, label, _ in snapshot.activities])
+        self.assertNotEqual(versions.get(Activity), version)
+
+
+class CoerceManyTest(TestCase):
+
+    def test_coerce_many(self):
+        calls = []
+
+        def coerce_many(values):
+            calls.append(values)
+            return [int(value) * 10 for value in values]
+        field = IndexedMultipleChoiceField(
+            choices=[("1", "One"), ("2", "Two")], coerce_many=coerce_many,
+            empty_value=None, required=False)
+        self.assertEqual(field.clean(["2", "1"]), [20, 10])
+        self.assertEqual(calls, [["2", "1"]])
+        self.assertIsNone(field.clean([]))
+        self.assertEqual(len(calls), 1)
+        with self.assertRaises(ValidationError):
+            field.clean(["3"])
+
+    def test_get_activities(self):
+        walking = Activity.objects.get(label="Walking")
+        barking = Activity.objects.get(label="Barking")
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                get_activities([str(walking.pk), barking.pk]),
+                [walking, barking])
+
+        # Only the invalid values are reported
+        for values, message in (
+                ([str(walking.pk), "x"], "x"),
+                ([walking.pk, 999999, "x"], "999999, x")):
+            with self.assertRaises(ValidationError) as context:
+                get_activities(values)
+            self.assertEqual(context.exception.messages, [
+                "Select valid choices. %s are not available choices." %
+                message])
+
+
+class AnimalListTest(CatalogTestMixin, TestCase):
+
+    def test_streamed(self):
+        walking = Activity.objects.get(label="Walking")
+        create_animals([
+            AnimalRow("Dog %d" % number, number, "dog", walking.pk,
+                      [walking.pk])
+            for number in range(5)])
+        labels = list(Animal.objects.order_by("pk").values_list(
+            "display_label", flat=True))
+
+        with mock.patch("animal.views.ANIMAL_LIST_CHUNK_SIZE", 2):
+            response = self.client.get(reverse("animal:animal_list"))
+            self.assertTrue(response.streaming)
+            # One query per chunk of 2 animals, and one finding no more
+            with self.assertNumQueries(4):
+                content = b"".join(response.streaming_content).decode()
+        # The rows of the list, not of the latest animals beside it
+        listing = content.rsplit('<div class="col-12">', 1)[1]
+        listing = listing.split("</ul>", 1)[0]
+        rows = [
+            line.strip()[4:-5] for line in listing.splitlines()
+            if line.strip().startswith("<li>")]
+        self.assertEqual(rows, labels)
+
+
+@skipUnless(connection.vendor == "sqlite", "SQLite only")
+class SQLiteProfileTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        settings_dict = dict(connection.settings_dict)
+        settings_dict["NAME"] = os.path.join(self.directory, "db.sqlite3")
+        self.connection = DatabaseWrapper(settings_dict, alias="profile")
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def pragma(self, name):
+        return self.connection.connection.execute(
+            "PRAGMA {0}".format(name)).fetchone()[0]
+
+    def test_pragmas(self):
+        self.connection.ensure_connection()
+        self.assertEqual(self.pragma("journal_mode"), "delete")
+
+        self.connection.close()
+        connection_created.connect(
+            sqlite.on_connection_created, dispatch_uid="test_sqlite_profile")
+        try:
+            self.connection.ensure_connection()
+        finally:
+            connection_created.disconnect(dispatch_uid="test_sqlite_profile")
+        self.assertEqual(self.pragma("journal_mode"), "wal")
+        self.assertEqual(self.pragma("busy_timeout"), 20000)
+        self.assertEqual(self.pragma("synchronous"), 1)  # NORMAL
+
+    def test_immediate_transactions(self):
+        self.connection.ensure_connection()
+        sqlite.use_immediate_transactions(self.connection)
+        other = sqlite3.connect(
+            self.connection.settings_dict["NAME"], timeout=0,
+            isolation_level=None)
+        try:
+            # Like the start of an atomic block
+            self.connection.set_autocommit(
+                False, force_begin_transaction_with_broken_autocommit=True)
+            # The write lock is taken before anything is read or written
+            with self.assertRaisesMessage(
+                    sqlite3.OperationalError, "database is locked"):
+                other.execute("BEGIN IMMEDIATE")
+            self.connection.rollback()
+            self.connection.set_autocommit(True)
+            other.execute("BEGIN IMMEDIATE")
+            other.execute("ROLLBACK")
+        finally:
+            other.close()
+
+
+@skipUnless(connection.vendor == "sqlite", "SQLite only")
+class AccessPatternIndexesTest(TestCase):
+
+    def test_query_plans(self):
+        walking = Activity.objects.get(label="Walking")
+        animal = Animal.objects.create(
+            name="Rex", type_id="dog", favorite_activity=walking)
+        expected = {
+            "activities_of_type": "animal_acti_type_label_idx",
+            "animals_of_activity": "animal_anim_acts_activity_idx",
+            "activities_of_animal": "animal_anim_acts_animal_idx",
+        }
+        self.assertEqual(set(expected), set(SQLITE_QUERIES))
+        self.assertEqual(set(expected.values()), set(INDEXES))
+        for name, query in SQLITE_QUERIES.items():
+            plan = _query_plan(query("dog", walking.pk, animal.pk))
+            self.assertIn("COVERING INDEX " + expected[name], plan)
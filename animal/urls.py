@@ -13,4 +13,18 @@ urlpatterns = [
         name='dynamic_required_3'),
     url(r'^dynamic-required-4$', views.DynamicRequired4.as_view(),
         name='dynamic_required_4'),
+    url(r'^dynamic-required-4/(?P<pk>\d+)$', views.DynamicRequired4.as_view(),
+        name='dynamic_required_4_edit'),
+    url(r'^animals$', views.AnimalList.as_view(), name='animal_list'),
+    url(r'^animals/export\.(?P<file_format>csv|ndjson)$',
+        views.AnimalExport.as_view(), name='animal_export'),
+    url(r'^animals/bulk$', views.AnimalBulkCreate.as_view(),
+        name='animal_bulk_create'),
+    url(r'^metrics$', views.Metrics.as_view(), name='metrics'),
+    url(r'^choices/(?P<name>[a-z_]+)\.json$', views.ChoicePayload.as_view(),
+        name='choices'),
+    url(r'^choices/activities/(?P<animal_type>[^/]+)\.json$',
+        views.TypeActivitiesPayload.as_view(), name='type_activities'),
+    url(r'^search/activities\.json$', views.ActivitySearch.as_view(),
+        name='activity_search'),
 ]
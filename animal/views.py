@@ -1,37 +1,138 @@
+import functools
 import json
 
-from django.shortcuts import render, redirect
+from django.conf import settings
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.forms import ModelChoiceField, formset_factory
+from django.http import (
+    Http404, HttpResponse, JsonResponse, StreamingHttpResponse)
+from django.shortcuts import get_object_or_404, render, redirect
+from django.template.loader import get_template, render_to_string
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.utils.http import urlquote
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import condition
 from django.views.generic import View
-from django.urls import reverse
+from django.urls import get_script_prefix, reverse
 
 from animal import forms
-from animal.models import Animal, Activity, AnimalType
+from animal.bulk import AnimalRow, create_animals, validate_rows
+from animal.catalog import PAYLOADS, IndexedChoices, catalog, encode_json
+from animal.editing import ConcurrentUpdate
+from animal.export import WRITERS, export_chunks
+from animal.fragments import fragments
+from animal.metrics import registry, timed
+from animal.models import Animal, AnimalType, Activity
+
+
+CATALOG_PAYLOADS = {
+    AnimalType: "types",
+    Activity: "activity_choices",
+}
+"""Catalog payload equivalent to the choices of an unfiltered
+ModelChoiceField."""
+
+
+@functools.lru_cache(maxsize=128)
+def _encode_choices(choices):
+    return encode_json([
+        {
+            "value": choice[0],
+            "label": choice[1]
+        } for choice in choices])
+
+
+def choices_json(field):
+    """Returns the choices of a field as JSON, for Vue. Choices coming from the
+    catalog and static choices are only encoded once.
+    """
+    choices = getattr(field, "choices", None)
+    if isinstance(choices, IndexedChoices) and choices.payload:
+        return mark_safe(choices.payload().decode("utf-8"))
+    if isinstance(field, ModelChoiceField):
+        name = CATALOG_PAYLOADS.get(field.queryset.model)
+        if name and not field.queryset.query.has_filters():
+            payload = catalog.snapshot().payload(name, field.empty_label)
+            return mark_safe(payload.decode("utf-8"))
+    payload = _encode_choices(tuple(field.choices))
+    return mark_safe(payload.decode("utf-8"))
+
+
+def choices_url(name, empty_label=None):
+    """Returns the URL of a catalog payload. The URL changes with the payload
+    so it can be cached by the browser.
+    """
+    snapshot = catalog.snapshot()
+    url = reverse("animal:choices", kwargs={"name": name})
+    url += "?v=" + snapshot.etag(name, empty_label)
+    if empty_label is not None:
+        url += "&empty=" + urlquote(empty_label)
+    return url
+
+
+def type_activities_url():
+    """Returns the URL of the activities of a type, with __type__ in place of
+    the type code. The URL changes with the activities so it can be cached by
+    the browser.
+    """
+    snapshot = catalog.snapshot()
+    url = reverse(
+        "animal:type_activities", kwargs={"animal_type": "__type__"})
+    return url + "?v=" + snapshot.activities_tag
+
+
+MENU = [
+    ("home", "animal:home", "Model Form"),
+    ("dynamic1", "animal:dynamic_required_1", "Dynamic Required 1"),
+    ("dynamic2", "animal:dynamic_required_2", "Dynamic Required 2"),
+    ("dynamic3", "animal:dynamic_required_3", "Dynamic Required 3"),
+    ("dynamic4", "animal:dynamic_required_4", "Dynamic Required 4"),
+    ("animal_list", "animal:animal_list", "Animal List"),
+]
+"""(page_name, url name, title) of the menu items."""
+
+
+@functools.lru_cache(maxsize=None)
+def _get_menu_items(script_prefix):
+    return tuple(
+        {
+            "page_name": page_name,
+            "url": reverse(url_name),
+            "title": title,
+        } for page_name, url_name, title in MENU)
 
 
 def get_menu_items():
-    return [
-        {
-            "page_name": "home",
-            "url": reverse("animal:home"),
-            "title": "Model Form",
-        }, {
-            "page_name": "dynamic1",
-            "url": reverse("animal:dynamic_required_1"),
-            "title": "Dynamic Required 1",
-        }, {
-            "page_name": "dynamic2",
-            "url": reverse("animal:dynamic_required_2"),
-            "title": "Dynamic Required 2",
-        }, {
-            "page_name": "dynamic3",
-            "url": reverse("animal:dynamic_required_3"),
-            "title": "Dynamic Required 3",
-        }, {
-            "page_name": "dynamic4",
-            "url": reverse("animal:dynamic_required_4"),
-            "title": "Dynamic Required 4",
-        },
-    ]
+    """Returns the menu items. The URLs are reversed once per script prefix
+    (i.e., once per process in practice). The items must not be modified.
+    """
+    return _get_menu_items(get_script_prefix())
+
+
+ANIMALS_PER_PAGE = 50
+
+ANIMAL_LIST_CHUNK_SIZE = 500
+
+MAX_BULK_ANIMALS = 10000
+
+AnimalImportFormSet = formset_factory(
+    forms.AnimalImportForm, max_num=MAX_BULK_ANIMALS, validate_max=True)
+
+ROWS_MARKER = mark_safe("<!-- animal rows -->")
+"""Where the rows are inserted in a streamed page."""
+
+
+def render_animals(after):
+    """Renders the page of animals after the given pk, with its links."""
+    animals, next_after = Animal.objects.display_page(
+        after=after, size=ANIMALS_PER_PAGE)
+    return render_to_string("animal/animals.html", {
+        "animals": animals,
+        "animals_after": after,
+        "animals_next": next_after,
+    })
 
 
 class AnimalView(View):
@@ -45,49 +146,40 @@ class AnimalView(View):
         self.context["menu_items"] = get_menu_items()
 
     def _add_form_context(self, form):
-        form_types = [
-            {
-                "value": choice[0],
-                "label": choice[1]
-            } for choice in form.fields["type"].choices
-        ]
-        form_activities = [
-            {
-                "value": choice[0],
-                "label": choice[1]
-            } for choice in form.fields["favorite_activity"].choices
-        ]
+        # Callables are only evaluated if the template uses them.
         self.context.update({
             "form": form,
-            "form_types_json": json.dumps(form_types),
-            "form_activities_json": json.dumps(form_activities),
+            "form_types_json": functools.partial(
+                choices_json, form.fields["type"]),
+            "form_activities_json": functools.partial(
+                choices_json, form.fields["favorite_activity"]),
         })
 
+    @timed("animals")
+    def _add_animals_context(self, request):
+        try:
+            after = int(request.GET["after"])
+        except (KeyError, ValueError):
+            after = None
+        # Rendered again only when an animal, type or activity changed.
+        self.context["animals_html"] = fragments.get_or_render(
+            "animals", (Animal, AnimalType, Activity),
+            (after, ANIMALS_PER_PAGE),
+            functools.partial(render_animals, after))
+
     def dispatch(self, request, *args, **kwargs):
-        activities = [
-            {
-                "value": activity.pk,
-                "label": activity.label,
-                "for_type": activity.animal_type.pk
-            } for activity in Activity.objects.all()
-        ]
-        types = [
-            {
-                "value": type.pk,
-                "label": type.label
-            } for type in AnimalType.objects.all()
-        ]
-        types.insert(0, {
-            "value": "",
-            "label": "Select animal type"
-        })
+        self._add_animals_context(request)
+        # The full lists are fetched by the page from ChoicePayload.
         self.context.update({
-            "animals": Animal.objects.order_by("pk"),
-            "activities_json": json.dumps(activities),
-            "types_json": json.dumps(types),
+            "activities_url": choices_url("activities"),
+            "types_url": choices_url("types", "Select animal type"),
         })
         return super().dispatch(request, *args, **kwargs)
 
+    @timed("render")
+    def render_page(self, request):
+        return render(request, self.template_file, self.context)
+
 
 class Home(AnimalView):
 
@@ -98,19 +190,25 @@ class Home(AnimalView):
         self.context.update({
             "success": request.GET.get("success") == "success",
         })
-        self._add_form_context(forms.Form1())
-        return render(request, self.template_file, self.context)
+        with timed("form"):
+            form = forms.Form1()
+        self._add_form_context(form)
+        return self.render_page(request)
 
     def post(self, request):
-        form = forms.Form1(data=request.POST)
-        if form.is_valid():
-            form.save()
+        with timed("form"):
+            form = forms.Form1(data=request.POST)
+        with timed("is_valid"):
+            is_valid = form.is_valid()
+        if is_valid:
+            with timed("save"):
+                form.save()
             url = reverse("animal:home") + "?success=success"
             return redirect(url)
         else:
             self.context.update({"success": False})
             self._add_form_context(form)
-            return render(request, self.template_file, self.context)
+            return self.render_page(request)
 
 
 class DynamicRequired1(AnimalView):
@@ -122,19 +220,25 @@ class DynamicRequired1(AnimalView):
         self.context.update({
             "success": request.GET.get("success") == "success",
         })
-        self._add_form_context(forms.DynamicRequired1())
-        return render(request, self.template_file, self.context)
+        with timed("form"):
+            form = forms.DynamicRequired1()
+        self._add_form_context(form)
+        return self.render_page(request)
 
     def post(self, request):
-        form = forms.DynamicRequired1(data=request.POST)
-        if form.is_valid():
-            form.save()
+        with timed("form"):
+            form = forms.DynamicRequired1(data=request.POST)
+        with timed("is_valid"):
+            is_valid = form.is_valid()
+        if is_valid:
+            with timed("save"):
+                form.save()
             url = reverse("animal:dynamic_required_1") + "?success=success"
             return redirect(url)
         else:
             self.context.update({"success": False})
             self._add_form_context(form)
-            return render(request, self.template_file, self.context)
+            return self.render_page(request)
 
 
 class DynamicRequired2(AnimalView):
@@ -146,19 +250,25 @@ class DynamicRequired2(AnimalView):
         self.context.update({
             "success": request.GET.get("success") == "success",
         })
-        self._add_form_context(forms.DynamicRequired2())
-        return render(request, self.template_file, self.context)
+        with timed("form"):
+            form = forms.DynamicRequired2()
+        self._add_form_context(form)
+        return self.render_page(request)
 
     def post(self, request):
-        form = forms.DynamicRequired2(data=request.POST)
-        if form.is_valid():
-            form.save()
+        with timed("form"):
+            form = forms.DynamicRequired2(data=request.POST)
+        with timed("is_valid"):
+            is_valid = form.is_valid()
+        if is_valid:
+            with timed("save"):
+                form.save()
             url = reverse("animal:dynamic_required_2") + "?success=success"
             return redirect(url)
         else:
             self.context.update({"success": False})
             self._add_form_context(form)
-            return render(request, self.template_file, self.context)
+            return self.render_page(request)
 
 
 class DynamicRequired3(AnimalView):
@@ -170,30 +280,33 @@ class DynamicRequired3(AnimalView):
         self.context.update({
             "success": request.GET.get("success") == "success",
         })
-        self._add_form_context(forms.DynamicRequired3())
+        with timed("form"):
+            form = forms.DynamicRequired3()
+        self._add_form_context(form)
         self._add_age_choices()
-        return render(request, self.template_file, self.context)
+        self.context["type_activities_url"] = type_activities_url()
+        return self.render_page(request)
 
     def post(self, request):
-        form = forms.DynamicRequired3(data=request.POST)
-        if form.is_valid():
-            form.save()
+        with timed("form"):
+            form = forms.DynamicRequired3(data=request.POST)
+        with timed("is_valid"):
+            is_valid = form.is_valid()
+        if is_valid:
+            with timed("save"):
+                form.save()
             url = reverse("animal:dynamic_required_3") + "?success=success"
             return redirect(url)
         else:
             self.context.update({"success": False})
             self._add_form_context(form)
             self._add_age_choices()
-            return render(request, self.template_file, self.context)
+            self.context["type_activities_url"] = type_activities_url()
+            return self.render_page(request)
 
     def _add_age_choices(self):
         form = self.context["form"]
-        age_choices = [
-            {
-                "value": choice[0],
-                "label": choice[1]
-            } for choice in form.fields["age"].choices]
-        self.context["form_age_json"] = json.dumps(age_choices)
+        self.context["form_age_json"] = choices_json(form.fields["age"])
 
 
 class DynamicRequired4(AnimalView):
@@ -201,26 +314,256 @@ class DynamicRequired4(AnimalView):
     page_name = "dynamic4"
     template_file = "animal/dynamic_required_4.html"
 
-    def get(self, request):
-        # animal = Animal.objects.order_by("-pk").first()
-        # form = forms.DynamicRequired4(instance=animal)
-        form = forms.DynamicRequired4()
+    def get(self, request, pk=None):
+        instance = self._get_instance(pk)
+        with timed("form"):
+            form = forms.DynamicRequired4(instance=instance)
         self.context.update({
             "success": request.GET.get("success") == "success",
             "form": form,
         })
-        return render(request, self.template_file, self.context)
+        return self.render_page(request)
+
+    def post(self, request, pk=None):
+        instance = self._get_instance(pk)
+        with timed("form"):
+            form = forms.DynamicRequired4(data=request.POST, instance=instance)
+        with timed("is_valid"):
+            is_valid = form.is_valid()
+        if is_valid:
+            try:
+                # Notice the custom method!
+                with timed("save"):
+                    pk = form.save_instance()
+            except ConcurrentUpdate:
+                form.add_error(None, (
+                    "This animal was changed by someone else. Reload the "
+                    "page to edit the latest version."))
+            else:
+                if instance is None:
+                    url = reverse("animal:dynamic_required_4")
+                else:
+                    url = reverse(
+                        "animal:dynamic_required_4_edit", kwargs={"pk": pk})
+                return redirect(url + "?success=success")
+        self.context.update({
+            "success": False,
+            "form": form
+        })
+        return self.render_page(request)
+
+    def _get_instance(self, pk):
+        self.context["editing"] = pk is not None
+        if pk is None:
+            return None
+        return get_object_or_404(Animal, pk=pk)
+
+
+class AnimalList(AnimalView):
+    """Lists all the animals. The page is streamed: the shell is sent first
+    and the rows are rendered chunk by chunk, so memory usage does not depend
+    on the number of animals.
+    """
+
+    page_name = "animal_list"
+    template_file = "animal/animal_list.html"
+
+    def get(self, request):
+        self.context["rows"] = ROWS_MARKER
+        shell = render_to_string(self.template_file, self.context, request)
+        head, tail = shell.split(ROWS_MARKER, 1)
+        return StreamingHttpResponse(self._stream(head, tail))
+
+    def _stream(self, head, tail):
+        yield head
+        template = get_template("animal/animal_rows.html")
+        for animals in Animal.objects.chunks(ANIMAL_LIST_CHUNK_SIZE):
+            yield template.render({"animals": animals})
+        yield tail
+
+
+class AnimalExport(View):
+    """Streams all the animals as CSV or NDJSON.
+    """
+
+    def get(self, request, file_format):
+        iter_text, content_type = WRITERS[file_format]
+        response = StreamingHttpResponse(
+            iter_text(export_chunks()), content_type=content_type)
+        response["Content-Disposition"] = \
+            'attachment; filename="animals.{0}"'.format(file_format)
+        return response
+
+
+class AnimalBulkCreate(View):
+    """Creates many animals in one transaction.
+
+    The body is either a JSON array of animals or an AnimalImportFormSet.
+    Nothing is created if a row is invalid: the response then lists the errors
+    of each invalid row.
+
+    The view is CSRF protected like the forms: clients send the csrftoken
+    cookie set by any page back in the X-CSRFToken header.
+    """
 
     def post(self, request):
-        form = forms.DynamicRequired4(data=request.POST)
-        if form.is_valid():
-            # Notice the custom method!
-            form.save_instance()
-            url = reverse("animal:dynamic_required_4") + "?success=success"
-            return redirect(url)
+        if request.content_type == "application/json":
+            try:
+                rows = json.loads(request.body.decode("utf-8"))
+            except ValueError:
+                return JsonResponse({"error": "Invalid JSON"}, status=400)
+            if not isinstance(rows, list) or not all(
+                    isinstance(row, dict) for row in rows):
+                return JsonResponse(
+                    {"error": "Expected an array of objects"}, status=400)
+            if len(rows) > MAX_BULK_ANIMALS:
+                return JsonResponse({"error": "Too many animals"}, status=400)
+            # JSON rows skip the HTML form machinery.
+            with timed("is_valid"):
+                results = validate_rows(enumerate(rows))
+        else:
+            with timed("form"):
+                formset = AnimalImportFormSet(data=request.POST)
+            with timed("is_valid"):
+                try:
+                    is_valid = formset.is_valid()
+                except ValidationError as e:
+                    # The management form is missing or invalid
+                    return JsonResponse(
+                        {"error": " ".join(e.messages)}, status=400)
+            if not is_valid and formset.non_form_errors():
+                return JsonResponse(
+                    {"error": " ".join(formset.non_form_errors())},
+                    status=400)
+            # Blank extra forms are valid (they are empty_permitted) but
+            # describe no animal.
+            results = [
+                (index, AnimalRow.from_cleaned_data(form.cleaned_data), None)
+                if form.is_valid() else
+                (index, None, {
+                    field: list(messages)
+                    for field, messages in form.errors.items()
+                }) for index, form in enumerate(formset.forms)
+                if form.has_changed()
+            ]
+
+        errors = [
+            {"row": index, "errors": row_errors}
+            for index, row, row_errors in results if row_errors
+        ]
+        if errors:
+            return JsonResponse({"errors": errors}, status=400)
+
+        with timed("save"):
+            pks = create_animals([row for index, row, row_errors in results])
+        return JsonResponse({"created": pks}, status=201)
+
+
+class Metrics(View):
+    """Serves the request histograms in the Prometheus text format.
+
+    Only in DEBUG, to INTERNAL_IPS, or to requests with the
+    ANIMAL_METRICS_TOKEN setting as bearer token.
+    """
+
+    def has_access(self, request):
+        if settings.DEBUG:
+            return True
+        if request.META.get("REMOTE_ADDR") in settings.INTERNAL_IPS:
+            return True
+        token = getattr(settings, "ANIMAL_METRICS_TOKEN", "")
+        return bool(token) and constant_time_compare(
+            request.META.get("HTTP_AUTHORIZATION", ""), "Bearer " + token)
+
+    def get(self, request):
+        if not self.has_access(request):
+            raise PermissionDenied
+        return HttpResponse(
+            registry.render(),
+            content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _choices_etag(request, name):
+    if name not in PAYLOADS:
+        raise Http404("Unknown choices")
+    return catalog.snapshot().etag(name, request.GET.get("empty"))
+
+
+class ChoicePayload(View):
+    """Serves the catalog payloads with a strong ETag. Conditional requests
+    get a 304 when the payload did not change.
+
+    Pages link to the payload with its ETag in the query string so the
+    response can be cached for a long time.
+    """
+
+    @method_decorator(condition(etag_func=_choices_etag))
+    def get(self, request, name):
+        snapshot = catalog.snapshot()
+        empty_label = request.GET.get("empty")
+        response = HttpResponse(
+            snapshot.payload(name, empty_label),
+            content_type="application/json")
+        if request.GET.get("v") == snapshot.etag(name, empty_label):
+            patch_cache_control(response, public=True, max_age=31536000)
+        else:
+            patch_cache_control(response, public=True, no_cache=True)
+        return response
+
+
+def _type_activities_etag(request, animal_type):
+    snapshot = catalog.snapshot()
+    if animal_type not in snapshot.type_labels:
+        raise Http404("Unknown animal type")
+    return snapshot.type_activities_payload(animal_type)[1]
+
+
+class TypeActivitiesPayload(View):
+    """Serves the activities of one animal type, for dependent selects. Same
+    caching as ChoicePayload.
+    """
+
+    @method_decorator(condition(etag_func=_type_activities_etag))
+    def get(self, request, animal_type):
+        snapshot = catalog.snapshot()
+        payload, etag = snapshot.type_activities_payload(animal_type)
+        response = HttpResponse(payload, content_type="application/json")
+        if request.GET.get("v") == snapshot.activities_tag:
+            patch_cache_control(response, public=True, max_age=31536000)
         else:
-            self.context.update({
-                "success": False,
-                "form": form
-            })
-            return render(request, self.template_file, self.context)
+            patch_cache_control(response, public=True, no_cache=True)
+        return response
+
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+class ActivitySearch(View):
+    """Typeahead search of the activities, for the SearchSelect widgets.
+
+    Parameters: q (the words to search, prefixes are enough), type (optional
+    animal type), offset and limit. Answered from the in-memory index of the
+    catalog snapshot, without querying the database.
+    """
+
+    def get(self, request):
+        snapshot = catalog.snapshot()
+        animal_type = request.GET.get("type") or None
+        if animal_type is not None and animal_type not in snapshot.type_labels:
+            return JsonResponse({"error": "Unknown animal type"}, status=400)
+        try:
+            offset = max(int(request.GET.get("offset", 0)), 0)
+            limit = min(max(int(request.GET.get("limit", SEARCH_LIMIT)), 1),
+                        MAX_SEARCH_LIMIT)
+        except ValueError:
+            return JsonResponse(
+                {"error": "offset and limit must be integers"}, status=400)
+        with timed("search"):
+            results, has_more = snapshot.activity_search.search(
+                request.GET.get("q", ""), animal_type, offset, limit)
+        return JsonResponse({
+            "results": [
+                {"value": pk, "label": label} for pk, label in results],
+            "next_offset": offset + len(results) if has_more else None,
+        })
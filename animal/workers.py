@@ -0,0 +1,23 @@
+"""Initialization of the worker processes of commands, e.g., import_animals.
+
+Importable before Django is set up: a spawned worker imports this module to
+find its initializer, before anything else.
+"""
+import django
+from django.db import connections
+
+
+def close_connections():
+    # Workers must not share the connections inherited from the parent.
+    for connection in connections.all():
+        connection.close()
+
+
+def init_worker():
+    """Sets Django up in a spawned worker and builds the catalog snapshot.
+    Forked workers already have both.
+    """
+    django.setup()
+    close_connections()
+    from animal.catalog import catalog
+    catalog.snapshot()
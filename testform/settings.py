@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'animal.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'animal.middleware.LoaderMiddleware',
 ]
 
 ROOT_URLCONF = 'testform.urls'
@@ -81,6 +83,14 @@ DATABASES = {
     }
 }
 
+# SQLite performance profile (WAL, pragmas, immediate transactions and
+# persistent connections), see animal/sqlite.py. Opt-in: set the
+# ANIMAL_SQLITE_PROFILE environment variable to 1.
+ANIMAL_SQLITE_PROFILE = os.environ.get('ANIMAL_SQLITE_PROFILE') == '1'
+
+if ANIMAL_SQLITE_PROFILE:
+    DATABASES['default']['CONN_MAX_AGE'] = 600
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -119,3 +129,36 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Form profiling, see animal.profiling. Opt-in: set the ANIMAL_FORM_PROFILING
+# environment variable to 1.
+
+ANIMAL_FORM_PROFILING = {}
+
+if os.environ.get('ANIMAL_FORM_PROFILING') == '1':
+    ANIMAL_FORM_PROFILING = {
+        'SAMPLE_RATE': 0.01,
+        'SINKS': [
+            'animal.profiling.metrics_sink',
+            ('animal.profiling.ProfilerTrigger', {'threshold': 0.1}),
+        ],
+    }
+
+
+# Access to /metrics when DEBUG is False, besides INTERNAL_IPS, see
+# animal.views.Metrics. Set the ANIMAL_METRICS_TOKEN environment variable
+# and send it as bearer token.
+
+ANIMAL_METRICS_TOKEN = os.environ.get('ANIMAL_METRICS_TOKEN', '')
+
+
+# Catalog shared by the worker processes through a memory-mapped file, see
+# animal.catalog.ChoiceCatalog. Opt-in: set the ANIMAL_SHARED_CATALOG
+# environment variable to the directory of the file. Without it, the catalog
+# of each process is checked every CHECK_INTERVAL seconds (1 by default).
+
+ANIMAL_SHARED_CATALOG = {}
+
+if os.environ.get('ANIMAL_SHARED_CATALOG'):
+    ANIMAL_SHARED_CATALOG['DIRECTORY'] = os.environ['ANIMAL_SHARED_CATALOG']